@@ -1 +1,2 @@
 from .cancelable_timer import CancelableTimer
+from .scheduler import Cron, Interval, Job, Once, Scheduler
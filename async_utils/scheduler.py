@@ -0,0 +1,335 @@
+import asyncio
+import datetime
+import heapq
+import inspect
+import itertools
+import logging
+import math
+
+from .cancelable_timer import CancelableTimer
+
+
+class Interval:
+    """
+    Runs every `seconds` after the previous run has finished.
+    :param first: Delay before the first run, `seconds` by default
+    """
+    __slots__ = ('seconds', 'first')
+
+    uses_clock = False  # The scheduler passes None as now
+
+    def __init__(self, seconds, first=None):
+        self.seconds = seconds
+        self.first = seconds if first is None else first
+
+    def next_delay(self, now, first):
+        return self.first if first else self.seconds
+
+
+class Once:
+    """
+    Runs once, after `delay` seconds or at the `at` datetime.
+    """
+    __slots__ = ('delay', 'at')
+
+    def __init__(self, delay=0, at=None):
+        self.delay = delay
+        self.at = at
+
+    @property
+    def uses_clock(self):
+        return self.at is not None
+
+    def next_delay(self, now, first):
+        if not first:
+            return None
+        if self.at is not None:
+            return max(0.0, (self.at - now).total_seconds())
+        return self.delay
+
+
+def parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        value, _, step = part.partition('/')
+        if value == '*':
+            start, end = low, high
+        elif '-' in value:
+            start, end = map(int, value.split('-'))
+        else:
+            start = end = int(value)
+            if step:
+                end = high
+
+        if not low <= start <= end <= high:
+            raise ValueError(f"{part!r} is out of range {low}-{high}")
+        values.update(range(start, end + 1, int(step) if step else 1))
+
+    return sorted(values)
+
+
+class Cron:
+    """
+    Cron-like schedule "minute hour day month weekday" in local time.
+    Fields are `*`, numbers, ranges `a-b`, steps `*/n` or `a-b/n` and lists of them. Weekday 0 and 7 are Sunday.
+    As in cron, a day matches either field when both the day and the weekday are restricted.
+    """
+    __slots__ = ('spec', 'minutes', 'hours', 'days', 'months', 'weekdays', '_any_day', '_any_weekday')
+
+    def __init__(self, spec):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron schedule {spec!r} must have 5 fields")
+
+        self.spec = spec
+        self.minutes = parse_cron_field(fields[0], 0, 59)
+        self.hours = parse_cron_field(fields[1], 0, 23)
+        self.days = set(parse_cron_field(fields[2], 1, 31))
+        self.months = set(parse_cron_field(fields[3], 1, 12))
+        self.weekdays = {i % 7 for i in parse_cron_field(fields[4], 0, 7)}
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def matches_date(self, date):
+        if date.month not in self.months:
+            return False
+
+        day = date.day in self.days
+        weekday = (date.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_time(self, now):
+        start = now.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        date = start.date()
+
+        # Four years include February 29
+        for _ in range(4 * 366):
+            if self.matches_date(date):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        time = datetime.datetime.combine(date, datetime.time(hour, minute))
+                        if time >= start:
+                            return time
+
+            date += datetime.timedelta(days=1)
+
+        return None
+
+    def next_delay(self, now, first):
+        time = self.next_time(now)
+        return None if time is None else (time - now).total_seconds()
+
+
+class Job:
+    # Kept small, since most jobs are one-shot reminders waiting in the heap. The due time is in the heap entry
+    __slots__ = ('name', 'func', 'trigger', 'args', 'kwargs', 'runs', 'entry', 'task', 'run_kwargs')
+
+    def __init__(self, name, func, trigger, args, kwargs):
+        self.name = name
+        self.func = func
+        self.trigger = trigger
+        self.args = args
+        self.kwargs = kwargs or None
+        self.runs = 0
+        self.entry = None  # Sequence number of the valid heap entry, None when not scheduled
+        self.task = None  # Current run
+        self.run_kwargs = None  # Extra arguments of a forced run
+
+    @property
+    def running(self):
+        return self.task is not None
+
+    def __repr__(self):
+        return f"Job({self.name!r}, {self.trigger!r}, runs={self.runs})"
+
+
+class Scheduler:
+    """
+    Named jobs in one heap, served by a single task that sleeps until the earliest one.
+    Only running jobs have asyncio tasks, scheduled ones are heap entries, so many one-shot jobs are cheap.
+    The wall clock is only read for triggers with `uses_clock`, e.g. not for an Interval or a Once with a delay.
+    A job does not overlap with itself: the next run is scheduled after the current one has finished.
+    :param clock: Wall clock passed to triggers
+    :param tick: Jobs due within the same tick (in seconds) are run on one wake-up
+    """
+    COMPACT_MIN_STALE = 1024
+
+    def __init__(self, clock=datetime.datetime.now, tick=1.0):
+        self.LOG = logging.getLogger(type(self).__name__)
+        self.clock = clock
+        self.tick = tick
+        self._jobs = {}
+        self._heap = []  # (due, entry, job), entries of cancelled and rescheduled jobs are skipped
+        self._stale = 0
+        self._seq = itertools.count()
+        self._timer = CancelableTimer()
+        self._wakeup = None
+        self._running = set()
+        self._stopping = False
+        self._task = None
+        self._loop = None
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, name):
+        return name in self._jobs
+
+    def get(self, name):
+        return self._jobs.get(name)
+
+    def add(self, name, func, trigger, *args, **kwargs):
+        """
+        Schedules `func(*args, **kwargs)`, replacing a job with the same name.
+        :param func: Function or coroutine function
+        :param trigger: Object with `next_delay(now, first)` returning seconds until the next run or None to finish
+        """
+        old = self._jobs.get(name)
+        if old is not None:
+            self._invalidate(old)
+
+        job = self._jobs[name] = Job(name, func, trigger, args, kwargs)
+        self._schedule(job)
+        return job
+
+    def cancel(self, name):
+        """
+        Removes the job, its current run is not interrupted.
+        :return: False if there is no such job
+        """
+        job = self._jobs.pop(name, None)
+        if job is None:
+            return False
+
+        self._invalidate(job)
+        return True
+
+    def run_now(self, name, **kwargs):
+        """
+        Runs the job on the next wake-up, or right after its current run. Keyword arguments are added to this run only.
+        :return: False if there is no such job
+        """
+        job = self._jobs.get(name)
+        if job is None:
+            return False
+
+        job.run_kwargs = kwargs
+        if not job.running:
+            self._invalidate(job)
+            self._push(job, 0)
+        return True
+
+    def _loop_time(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop.time()
+
+    def _schedule(self, job):
+        trigger = job.trigger
+        delay = trigger.next_delay(self.clock() if getattr(trigger, 'uses_clock', True) else None, job.runs == 0)
+        if delay is None:
+            del self._jobs[job.name]
+            return
+
+        self._push(job, delay)
+
+    def _push(self, job, delay):
+        due = self._loop_time() + delay
+        if self.tick and delay > 0:
+            due = math.ceil(due / self.tick) * self.tick
+
+        job.entry = next(self._seq)
+        heapq.heappush(self._heap, (due, job.entry, job))
+
+        if self._wakeup is not None and due < self._wakeup:
+            self._timer.cancel()
+
+    def _invalidate(self, job):
+        if job.entry is None:
+            return
+
+        job.entry = None
+        self._stale += 1
+        if self._stale > self.COMPACT_MIN_STALE and self._stale * 2 > len(self._heap):
+            self._heap = [i for i in self._heap if i[2].entry == i[1]]
+            heapq.heapify(self._heap)
+            self._stale = 0
+
+    def _pop_due(self, now):
+        while self._heap and self._heap[0][0] <= now:
+            _, entry, job = heapq.heappop(self._heap)
+            if job.entry != entry:
+                self._stale -= 1
+                continue
+
+            job.entry = None
+            yield job
+
+    def _start_job(self, job):
+        kwargs, job.run_kwargs = job.run_kwargs or {}, None
+
+        try:
+            result = job.func(*job.args, **(job.kwargs or {}), **kwargs)
+        except Exception:
+            self.LOG.exception("Job %s failed", job.name)
+            result = None
+
+        # Plain functions run in place, only coroutines get a task
+        if inspect.isawaitable(result):
+            job.task = asyncio.create_task(self._await_job(job, result),
+                                           name=f"{type(self).__name__}:{job.name}")
+            self._running.add(job.task)
+        else:
+            self._finish_job(job)
+
+    async def _await_job(self, job, result):
+        try:
+            await result
+        except Exception:
+            self.LOG.exception("Job %s failed", job.name)
+        finally:
+            self._running.discard(job.task)
+            job.task = None
+
+        self._finish_job(job)
+
+    def _finish_job(self, job):
+        job.runs += 1
+        if self._jobs.get(job.name) is not job:
+            return
+
+        if job.run_kwargs is not None:
+            self._push(job, 0)
+        else:
+            self._schedule(job)
+
+    async def run(self):
+        while not self._stopping:
+            now = self._loop_time()
+            # Collected first, so jobs scheduled by the ones run now wait for the next wake-up
+            for job in list(self._pop_due(now)):
+                self._start_job(job)
+
+            # Without jobs it sleeps until one is added
+            self._wakeup = self._heap[0][0] if self._heap else math.inf
+            await self._timer.sleep(min(self._wakeup - self._loop_time(), 86400))
+            self._wakeup = None
+
+        running = list(self._running)
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+    def start(self):
+        self._loop = asyncio.get_event_loop()
+        self._task = self._loop.create_task(self.run(), name=type(self).__name__)
+        return self._task
+
+    def stop(self):
+        """
+        Stops the scheduler, running jobs are cancelled.
+        """
+        self._stopping = True
+        self._timer.cancel()
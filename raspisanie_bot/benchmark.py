@@ -0,0 +1,878 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import functools
+import http.server
+import inspect
+import json
+import multiprocessing
+import pathlib
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+from async_utils import Once, Scheduler
+from . import schedule
+from .database import DATA_VERSION, MODELS, Cabinet, CVPItem, Generation, Group, Pair, PairTime, Teacher, db, \
+    preload_persistent
+from .db_executor import DatabaseExecutor
+from .parsing import dates, pair_names
+from .parsing.database import DatabaseFinder, DatabaseHandler, BufferedDatabaseHandler
+from .parsing.parsers import DocumentParser, Finder, Handler, LinesConverter, SnapshotFinder, \
+    TextLinesConverter, TimetableUpdater, map_content
+from .render_cache import RenderCache
+
+# kind -> (parser method, instrumented stages)
+CORPUS_KINDS = {
+    "timetable": ("parse_timetable", ((DocumentParser, "parse_html"), (DocumentParser, "iter_timetable_page"),
+                                      (DocumentParser, "iter_table"), (DocumentParser, "parse_cell"),
+                                      (DocumentParser, "tokenize_cell"))),
+    "call_schedule": ("parse_call_schedule", ((DocumentParser, "parse_html"), (DocumentParser, "iter_pair_times"))),
+    "cvp": ("parse_cvp", ((DocumentParser, "iter_cvp"), (DocumentParser, "iter_cvp_page"),
+                          (LinesConverter, "receive_layout"), (TextLinesConverter, "get_lines"))),
+}
+CORPUS_HANDLERS = {i.__name__: i for i in (Handler, DatabaseHandler, BufferedDatabaseHandler)}
+COUNTED_HANDLERS = ("handle_parsed_pair", "handle_pair_time", "handle_cvp_item")
+
+
+def use_temp_database(directory):
+    db.init(str(pathlib.Path(directory) / "benchmark.sqlite"))
+    db.create_tables(MODELS)
+    preload_persistent()
+
+
+def load_documents(args):
+    documents = [("timetable", "parse_timetable", pathlib.Path(args.timetable).read_text(encoding=args.encoding))]
+
+    if args.call_schedule:
+        documents.append(("call_schedule", "parse_call_schedule",
+                          pathlib.Path(args.call_schedule).read_text(encoding=args.encoding)))
+
+    if args.cvp:
+        documents.append(("cvp", "parse_cvp", pathlib.Path(args.cvp).read_bytes()))
+
+    return documents
+
+
+def bench_update(args):
+    documents = load_documents(args)
+
+    for handler_class in (DatabaseHandler, BufferedDatabaseHandler):
+        timings = {name: [] for name, _, _ in documents}
+
+        with tempfile.TemporaryDirectory() as directory:
+            use_temp_database(directory)
+            parser = DocumentParser(DatabaseFinder, handler_class)
+
+            for _ in range(args.repeat):
+                for name, method, content in documents:
+                    start = time.perf_counter()
+                    getattr(parser, method)(content)
+                    timings[name].append(time.perf_counter() - start)
+
+            db.close()
+
+        for name, values in timings.items():
+            print(f"{handler_class.__name__:<24} {name:<14} first {values[0]:8.3f} s   "
+                  f"min {min(values):8.3f} s   median {statistics.median(values):8.3f} s")
+
+
+async def measure_loop_lag(stop, interval=0.01):
+    loop = asyncio.get_running_loop()
+    lags = []
+
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - start - interval)
+
+    return lags
+
+
+async def measure_update_latency(documents, workers, repeat):
+    with tempfile.TemporaryDirectory() as directory:
+        use_temp_database(directory)
+        updater = TimetableUpdater(DatabaseFinder, BufferedDatabaseHandler, workers)
+
+        # Warm up worker processes and caches
+        for name, method, content in documents:
+            await updater.run_parser(method, content)
+
+        stop = asyncio.Event()
+        probe = asyncio.create_task(measure_loop_lag(stop))
+        await asyncio.sleep(0)
+        start = time.perf_counter()
+
+        for _ in range(repeat):
+            for name, method, content in documents:
+                await updater.run_parser(method, content)
+
+        total = time.perf_counter() - start
+        stop.set()
+        lags = await probe
+
+        await updater.close()
+        db.close()
+
+    return total, lags
+
+
+def bench_latency(args):
+    documents = load_documents(args)
+
+    for workers in sorted({0, args.workers}):
+        total, lags = asyncio.run(measure_update_latency(documents, workers, args.repeat))
+        p99 = statistics.quantiles(lags, n=100, method='inclusive')[98] if len(lags) > 1 else max(lags, default=0)
+        print(f"workers {workers:<3} update {total:8.3f} s   loop lag p99 {p99 * 1000:8.1f} ms   "
+              f"max {max(lags, default=0) * 1000:8.1f} ms")
+
+
+async def simulate_handlers(cache, storage, keys, stop, interval):
+    # A message arrives every interval and waits for its answer: the chat state, the /my message built anew and the
+    # state reset every command ends with, which is a write queued behind the update
+    latencies = []
+    while True:
+        arrived = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+
+        cache.clear()
+        await storage.get_state(chat=1, user=1)
+        await cache.render("my_group", keys[len(latencies) % len(keys)])
+        await storage.reset_state(chat=1, user=1)
+        latencies.append(time.perf_counter() - arrived)
+
+        # The message that waited for the end of the update is counted too
+        if stop.is_set():
+            return latencies
+
+
+async def measure_handler_latency(documents, readers, workers, repeat, interval):
+    from .commands.my import build_for_students
+    from .sqlite_storage import SQLiteStorage
+
+    with tempfile.TemporaryDirectory() as directory:
+        use_temp_database(directory)
+        executor = DatabaseExecutor(db, readers)
+        updater = TimetableUpdater(DatabaseFinder, BufferedDatabaseHandler, workers, db_executor=executor)
+        cache = RenderCache(executor=executor)
+        cache.register("my_group", build_for_students)
+        storage = SQLiteStorage(executor)
+
+        # Fills the database and warms up worker processes
+        for name, method, content in documents:
+            await updater.run_parser(method, content)
+        keys = await executor.read(lambda: [i for i, in Group.select(Group.rowid).tuples()])
+
+        stop = asyncio.Event()
+        handlers = asyncio.create_task(simulate_handlers(cache, storage, keys, stop, interval))
+        await asyncio.sleep(0)
+        start = time.perf_counter()
+
+        for _ in range(repeat):
+            for name, method, content in documents:
+                await updater.run_parser(method, content)
+
+        total = time.perf_counter() - start
+        stop.set()
+        latencies = await handlers
+
+        await updater.close()
+        executor.close()
+        db.close()
+
+    return total, latencies
+
+
+def bench_load(args):
+    documents = load_documents(args)
+
+    for readers in sorted({0, args.readers}):
+        total, latencies = asyncio.run(measure_handler_latency(documents, readers, args.workers, args.repeat,
+                                                               args.interval / 1000))
+        p99 = statistics.quantiles(latencies, n=100, method='inclusive')[98] if len(latencies) > 1 else latencies[0]
+        print(f"readers {readers:<3} update {total:8.3f} s   {len(latencies):5} handlers   "
+              f"p50 {statistics.median(latencies) * 1000:8.1f} ms   p99 {p99 * 1000:8.1f} ms   "
+              f"max {max(latencies) * 1000:8.1f} ms")
+
+
+def load_date_lines(paths):
+    lines = []
+
+    for path in map(pathlib.Path, paths):
+        if path.suffix in (".htm", ".html"):
+            parser = DocumentParser(Finder, Handler)
+            for p in parser.parse_html(path.read_bytes()).iter('p'):
+                text = parser.normalize_text(p.text_content()).lower()
+                lines.append(text.replace('знаменатель', '').replace('числитель', ''))
+        else:
+            lines.extend(path.read_text(encoding="utf-8").splitlines())
+
+    return [i for i in lines if i.strip()]
+
+
+def time_per_call(func, lines, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            func(line)
+    return (time.perf_counter() - start) / (repeat * len(lines))
+
+
+def bench_dates(args):
+    lines = load_date_lines(args.corpus)
+    today = datetime.date.today()
+
+    known = 0
+    for line in lines:
+        date = dates.parse_known_date(line, today)
+        if date is None:
+            continue
+
+        known += 1
+        expected = dates.parse_date_dateparser(line.replace('знаменатель', '').replace('числитель', ''))
+        if date != expected:
+            print(f"MISMATCH {line!r}: {date} != {expected} (dateparser)")
+
+    print(f"{len(lines)} lines, {known} parsed without dateparser")
+    print(f"dateparser {time_per_call(dates.parse_date_dateparser, lines, args.repeat) * 1e6:10.1f} us/call")
+    print(f"fast path  {time_per_call(lambda i: dates.parse_known_date(i, today), lines, args.repeat) * 1e6:10.1f} "
+          f"us/call")
+    time_per_call(dates.parse_date, lines, 1)
+    print(f"cached     {time_per_call(dates.parse_date, lines, args.repeat) * 1e6:10.1f} us/call")
+
+
+def synthetic_pair_name_rules(count):
+    # Half prefixes, half patterns (every other one with a group), none of them matching the names below
+    return [{"prefix": f"Префикс {i}", "replace": f"П{i}"} if i % 2 else
+            {"pattern": f"{chr(ord('А') + i % 32)}шаблон {i} (\\d+)", "replace": f"Ш{i}.\\1"} if i % 4 else
+            {"pattern": f"{chr(ord('А') + i % 32)}шаблон {i} \\d+", "replace": f"Ш{i}"} for i in range(count)]
+
+
+def naive_pair_name(rules, name):
+    prefixes = [i for i in rules if type(i) is pair_names.PrefixRule and name.startswith(i.prefix)]
+    if prefixes:
+        # The longest prefix, the last of the same length
+        rule = max(reversed(prefixes), key=lambda i: len(i.prefix))
+        rest = name[len(rule.prefix):]
+        name = rule.replace + (rest if rule.join is None else rule.join + rule.join.join(rest.split()))
+    for rule in rules:
+        if type(rule) is pair_names.PatternRule:
+            match = rule.pattern.fullmatch(name)
+            if match is not None:
+                return match.expand(rule.replace)
+    return name
+
+
+def bench_pair_names(args):
+    names = [f"МДК 0{i % 5} 0{i % 7}" if i % 3 == 0 else f"Дисциплина номер {i}" for i in range(args.names)]
+
+    for count in args.rules:
+        rules = (*pair_names.DEFAULT_RULES, *pair_names.parse_rules(synthetic_pair_name_rules(count)))
+        engine = pair_names.PairNameRules(rules)
+        naive = time_per_call(lambda i: naive_pair_name(rules, i), names, args.repeat)
+        compiled = time_per_call(engine.apply, names, args.repeat)
+        engine(names[0])
+        time_per_call(engine, names, 1)
+        cached = time_per_call(engine, names, args.repeat)
+        print(f"{count:5} rules   one by one {naive * 1e6:8.2f} us   compiled {compiled * 1e6:8.2f} us   "
+              f"cached {cached * 1e6:8.2f} us per name")
+
+
+def bench_cvp(args):
+    parser = DocumentParser(Finder, Handler)
+
+    for path in args.pdf:
+        content = pathlib.Path(path).read_bytes()
+        results = {}
+
+        for engine in ("layout", "text"):
+            results[engine] = collections.Counter(parser.iter_cvp(content, engine))
+            seconds = time_per_call(lambda i: list(parser.iter_cvp(i, engine)), [content], args.repeat)
+            print(f"{engine:<7} {seconds * 1000:10.1f} ms   {sum(results[engine].values()):6} records   {path}")
+
+        missing = results["layout"] - results["text"]
+        extra = results["text"] - results["layout"]
+        if missing or extra:
+            print(f"MISMATCH {path}: text engine misses {sum(missing.values())} records "
+                  f"(e.g. {next(iter(missing), None)}) and adds {sum(extra.values())} (e.g. {next(iter(extra), None)})")
+
+
+class QuietRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+async def download_and_parse(mode, url):
+    updater = TimetableUpdater(Finder, Handler)
+    start = time.perf_counter()
+
+    try:
+        if mode == "memory":
+            # What the updater did before streaming: the whole body in memory and another copy for pdfminer
+            async with updater._sess.get(url) as r:
+                content = await r.read()
+            records = sum(1 for _ in updater.iter_cvp(content))
+        else:
+            download = await updater.download_content(url)
+            with download.file, map_content(download.file) as content:
+                records = sum(1 for _ in updater.iter_cvp(content))
+    finally:
+        await updater.close()
+
+    return time.perf_counter() - start, records
+
+
+def measure_download(mode, url):
+    # Unix only, imported here so the other commands work on Windows
+    import resource
+
+    # Runs in a fresh process, so the peak RSS growth belongs to this download only
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    seconds, records = asyncio.run(download_and_parse(mode, url))
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before, seconds, records
+
+
+def bench_download(args):
+    paths = [pathlib.Path(i).resolve() for i in args.pdf]
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietRequestHandler, directory="/"))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    context = multiprocessing.get_context("spawn")
+
+    try:
+        for path in paths:
+            url = f"http://127.0.0.1:{server.server_port}{urllib.parse.quote(str(path))}"
+            print(f"{path} ({path.stat().st_size / 1024 / 1024:.1f} MiB)")
+
+            for mode in ("memory", "stream"):
+                peaks, times = [], []
+                for _ in range(args.repeat):
+                    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                        peak, seconds, records = executor.submit(measure_download, mode, url).result()
+                    peaks.append(peak)
+                    times.append(seconds)
+
+                print(f"  {mode:<7} {statistics.median(peaks) / 1024:8.1f} MiB peak RSS growth   "
+                      f"{statistics.median(times) * 1000:10.1f} ms   {records:6} records")
+    finally:
+        server.shutdown()
+
+
+def add_one_shot_jobs(mode, scheduler, jobs, spread, fired):
+    if mode == "scheduler":
+        for i in range(jobs):
+            scheduler.add(f"reminder-{i}", fired.append, Once(spread * i / jobs), i)
+        return None
+
+    loop = asyncio.get_running_loop()
+    return [loop.call_later(spread * i / jobs, fired.append, i) for i in range(jobs)]
+
+
+async def measure_one_shot_jobs(mode, jobs, spread, cancel_every):
+    loop = asyncio.get_running_loop()
+
+    # Memory is measured on jobs that are dropped, tracing would slow down the timed adding below
+    scheduler = Scheduler(tick=0.01)
+    tracemalloc.start()
+    handles = add_one_shot_jobs(mode, scheduler, jobs, spread, [])
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    for i in handles or ():
+        i.cancel()
+    del scheduler, handles
+
+    scheduler = Scheduler(tick=0.01)
+    task = scheduler.start()
+    fired = []
+
+    start = time.perf_counter()
+    handles = add_one_shot_jobs(mode, scheduler, jobs, spread, fired)
+    added = time.perf_counter() - start
+    # noinspection PyProtectedMember
+    timers = sum(not i.cancelled() for i in loop._scheduled)
+
+    if cancel_every:
+        for i in range(0, jobs, cancel_every):
+            if mode == "scheduler":
+                scheduler.cancel(f"reminder-{i}")
+            else:
+                handles[i].cancel()
+
+    stop = asyncio.Event()
+    probe = asyncio.create_task(measure_loop_lag(stop))
+    await asyncio.sleep(spread + 0.5)
+    stop.set()
+    lags = await probe
+
+    scheduler.stop()
+    await task
+    return added, memory, timers, len(fired), lags
+
+
+def bench_scheduler(args):
+    for mode in ("call_later", "scheduler"):
+        added, memory, timers, fired, lags = asyncio.run(
+            measure_one_shot_jobs(mode, args.jobs, args.spread, args.cancel_every))
+        print(f"{mode:<10} add {added * 1000:8.1f} ms   {memory / 1024 / 1024:6.1f} MiB   {timers:6} loop timers   "
+              f"{fired:6} fired   loop lag max {max(lags, default=0) * 1000:6.1f} ms")
+
+
+def fill_schedule_database(groups, teachers, cabinets, days, pairs_per_day):
+    Group.insert_many(((1 + i % 4, f"г{i}", 1) for i in range(groups)),
+                      fields=[Group.course, Group.group, Group.subgroup]).execute()
+    Teacher.insert_many(((f"Фамилия{i}", "Имя", "Отчество") for i in range(teachers)),
+                        fields=[Teacher.surname, Teacher.name, Teacher.patronymic]).execute()
+    Cabinet.insert_many(((100 + i, ) for i in range(cabinets)), fields=[Cabinet.number]).execute()
+    PairTime.insert_many(((i, 480 + i * 100, 570 + i * 100) for i in range(1, pairs_per_day + 1)),
+                         fields=[PairTime.pair_number, PairTime.start_time, PairTime.end_time]).execute()
+
+    today = datetime.date.today()
+    for day in range(days):
+        for group in range(1, groups + 1):
+            for number in range(1, pairs_per_day + 1):
+                n = day * groups * pairs_per_day + group * pairs_per_day + number
+                pair = Pair.create(date=today + datetime.timedelta(days=day), pair_number=number, group=group,
+                                   name=f"Дисциплина {n % 50}")
+                pair.teachers.add([1 + n % teachers, 1 + (n + 1) % teachers] if n % 5 == 0 else [1 + n % teachers])
+                pair.cabinets.add([100 + n % cabinets])
+
+        CVPItem.insert_many(((today + datetime.timedelta(days=day), i, 720, 740) for i in range(1, groups + 1)),
+                            fields=[CVPItem.date, CVPItem.group, CVPItem.start_time, CVPItem.end_time]).execute()
+
+
+def lazy_pairs(where, generation):
+    # Access pattern of the commands before the schedule module: queries per pair and per relation
+    rows = []
+    for pair in Pair.select().where(where & Pair.visible(generation)).order_by(Pair.date, Pair.pair_number):
+        pair_time = PairTime.get_or_none((PairTime.pair_number == pair.pair_number) &
+                                         (PairTime.source == pair.source) & PairTime.visible(generation))
+        rows.append(schedule.PairRow(pair.date, pair.pair_number, pair.name, pair.group.string_value,
+                                     tuple(i.short_name for i in pair.teachers), tuple(i.number for i in pair.cabinets),
+                                     pair_time and pair_time.start_time, pair_time and pair_time.end_time,
+                                     pair.source))
+    return rows
+
+
+@contextlib.contextmanager
+def count_queries():
+    counter = [0]
+    execute_sql = db.execute_sql
+
+    def wrapper(*args, **kwargs):
+        counter[0] += 1
+        return execute_sql(*args, **kwargs)
+
+    db.execute_sql = wrapper
+    try:
+        yield counter
+    finally:
+        del db.execute_sql
+
+
+def measure_queries(func, repeat):
+    with count_queries() as counter:
+        result = func()
+    queries = counter[0]
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return result, queries, statistics.median(times)
+
+
+def bench_queries(args):
+    from .commands.my import build_for_students, build_for_teachers
+    from .commands.search import build_search
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Without preloaded groups, teachers and cabinets, so the synthetic ones are numbered from 1
+        db.init(str(pathlib.Path(directory) / "benchmark.sqlite"))
+        db.create_tables(MODELS)
+        with db.atomic():
+            fill_schedule_database(args.groups, args.teachers, args.cabinets, args.days, args.pairs)
+        generation = Generation.current()
+        group, teacher, cabinet = Group.get_by_id(1), Teacher.get_by_id(1), Cabinet.get_by_id(100)
+
+        filters = (("group", schedule.group_filter(group)), ("teacher", schedule.teacher_filter(teacher)),
+                   ("cabinet", schedule.cabinet_filter(cabinet)))
+        for name, where in filters:
+            lazy, lazy_queries, lazy_time = measure_queries(lambda: lazy_pairs(where, generation), args.repeat)
+            rows, queries, seconds = measure_queries(lambda: schedule.get_pairs(where, generation), args.repeat)
+            print(f"{name:<8} {len(rows):5} pairs   lazy {lazy_queries:6} queries {lazy_time * 1000:8.2f} ms   "
+                  f"prefetched {queries:3} queries {seconds * 1000:8.2f} ms   {'same' if lazy == rows else 'DIFFER'}")
+
+        cache = RenderCache(args.groups * 2, executor=DatabaseExecutor(db, 0))
+        now = schedule.local_now()
+        pair_times = schedule.PAIR_TIMES.snapshot()
+        cache.register("my_group", build_for_students, lambda: range(1, args.groups + 1))
+        cache.register("my_teacher", build_for_teachers)
+        for search_type in ("group", "teacher", "cabinet"):
+            cache.register(f"search_{search_type}", functools.partial(build_search, search_type))
+
+        commands = (("/my student", "my_group", group.rowid), ("/my teacher", "my_teacher", teacher.rowid),
+                    ("/search group", "search_group", group.rowid),
+                    ("/search teacher", "search_teacher", teacher.rowid),
+                    ("/search cabinet", "search_cabinet", cabinet.number))
+        for name, kind, key in commands:
+            def render():
+                return cache.get(kind, key).render(lambda pair: schedule.is_current(pair, now, pair_times))
+
+            _, queries, seconds = measure_queries(lambda: (cache.clear(), render()), args.repeat)
+            _, cached_queries, cached = measure_queries(render, args.repeat)
+            print(f"{name:<16} built {queries:3} queries {seconds * 1000:8.2f} ms   "
+                  f"cached {cached_queries:3} queries {cached * 1000:8.3f} ms")
+
+        DATA_VERSION.bump()
+        start = time.perf_counter()
+        built = asyncio.run(cache.warm_up())
+        print(f"warm-up {built} messages {time.perf_counter() - start:8.3f} s   "
+              f"{cache.hits} hits, {cache.misses} misses, {cache.evictions} evictions")
+
+        db.close()
+
+
+def load_corpus(directory, encoding):
+    directory = pathlib.Path(directory)
+    documents = []
+
+    for path in sorted(directory.rglob("*")):
+        if path.suffix not in (".htm", ".html", ".pdf"):
+            continue
+
+        if path.parent.name in CORPUS_KINDS:
+            kind = path.parent.name
+        else:
+            kind = "cvp" if path.suffix == ".pdf" else "timetable"
+
+        content = path.read_bytes() if kind == "cvp" else path.read_text(encoding=encoding)
+        documents.append((path.relative_to(directory).as_posix(), kind, content))
+
+    return documents
+
+
+def timed_generator(generator, stage):
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(generator)
+        except StopIteration:
+            return
+        finally:
+            stage[0] += time.perf_counter() - start
+
+        yield item
+
+
+def timed(func, name, stats):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stage = stats[name]
+        stage[1] += 1
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            stage[0] += time.perf_counter() - start
+
+        # Record generators are timed while they produce records, without the consumer
+        if inspect.isgenerator(result):
+            return timed_generator(result, stage)
+        return result
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def instrument(targets, stats):
+    originals = []
+    for cls, name in targets:
+        originals.append((cls, name, cls.__dict__.get(name)))
+        setattr(cls, name, timed(getattr(cls, name), name, stats))
+
+    try:
+        yield
+    finally:
+        for cls, name, original in reversed(originals):
+            if original is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, original)
+
+
+def run_document(parser, method, content):
+    parser.finder.reset()
+    getattr(parser, method)(content)
+
+
+def bench_corpus_document(parser, kind, content, repeat):
+    method, stages = CORPUS_KINDS[kind]
+    handler_class = type(parser.handler)
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run_document(parser, method, content)
+        times.append(time.perf_counter() - start)
+
+    stats = collections.defaultdict(lambda: [0.0, 0])
+    targets = list(stages) + [(handler_class, i) for i in dir(handler_class) if i.startswith("handle_")]
+    with instrument(targets, stats):
+        run_document(parser, method, content)
+
+    tracemalloc.start()
+    try:
+        run_document(parser, method, content)
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    median = statistics.median(times)
+    cells = stats["parse_cell"][1] if "parse_cell" in stats else None
+    records = sum(stats[i][1] for i in COUNTED_HANDLERS if i in stats)
+
+    return {
+        "size": len(content),
+        "runs": repeat,
+        "total": {"min": min(times), "median": median},
+        # Inclusive time: nested stages (parse_cell in iter_table) are counted in both
+        "stages": {name: {"seconds": seconds, "calls": calls} for name, (seconds, calls) in stats.items() if calls},
+        "cells": cells,
+        "cells_per_second": cells / median if cells is not None and median else None,
+        "records": records,
+        "records_per_second": records / median if median else None,
+        "peak_bytes": peak,
+        "retained_bytes": retained,
+    }
+
+
+def compare_with_baseline(results, path):
+    baseline = json.loads(pathlib.Path(path).read_text(encoding="utf-8"))
+    previous = {(i["document"], i["handler"]): i["total"]["median"] for i in baseline["results"]}
+
+    for result in results:
+        old = previous.get((result["document"], result["handler"]))
+        if old:
+            print(f"{result['handler']:<24} {result['document']:<32} "
+                  f"{result['total']['median'] / old:6.2f}x ({old:.4f} s -> {result['total']['median']:.4f} s)",
+                  file=sys.stderr)
+
+
+def bench_corpus(args):
+    documents = load_corpus(args.corpus, args.encoding)
+    results = []
+
+    for handler_name in args.handler:
+        with tempfile.TemporaryDirectory() as directory:
+            use_temp_database(directory)
+            parser = DocumentParser(DatabaseFinder, CORPUS_HANDLERS[handler_name])
+
+            for name, kind, content in documents:
+                result = {"document": name, "kind": kind, "handler": handler_name}
+                result.update(bench_corpus_document(parser, kind, content, args.repeat))
+                results.append(result)
+
+            db.close()
+
+    report = {
+        "label": args.label,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "results": results,
+    }
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        pathlib.Path(args.output).write_text(text, encoding="utf-8")
+    else:
+        print(text)
+
+    if args.baseline:
+        compare_with_baseline(results, args.baseline)
+
+
+class RecordingHandler(Handler):
+    __slots__ = ('records', )
+
+    def __init__(self, parser):
+        super().__init__(parser)
+        self.records = []
+
+    def handle_link(self, name, link):
+        self.records.append(('handle_link', (name, link)))
+
+    def handle_new_cvp_date(self, date):
+        self.records.append(('handle_new_cvp_date', (date, )))
+
+    def handle_cvp_item(self, date, group, start, end):
+        self.records.append(('handle_cvp_item', (date, group, start, end)))
+
+    def handle_end_cvp(self):
+        self.records.append(('handle_end_cvp', ()))
+
+    def handle_new_call_schedule(self):
+        self.records.append(('handle_new_call_schedule', ()))
+
+    def handle_pair_time(self, pair, start, end):
+        self.records.append(('handle_pair_time', (pair, start, end)))
+
+    def handle_end_call_schedule(self):
+        self.records.append(('handle_end_call_schedule', ()))
+
+    def handle_new_date(self, new_date, old_date):
+        self.records.append(('handle_new_date', (new_date, old_date)))
+
+    def handle_parsed_pair(self, date, group, pair_number, pair, teachers, cabinets, subgroup, is_substitution):
+        self.records.append(('handle_parsed_pair', (date, group, pair_number, pair, tuple(teachers), tuple(cabinets),
+                                                    subgroup, is_substitution)))
+
+    def handle_end_timetable(self):
+        self.records.append(('handle_end_timetable', ()))
+
+
+def golden_records(documents, snapshot):
+    results = {}
+
+    for name, kind, content in documents:
+        parser = DocumentParser(SnapshotFinder, RecordingHandler)
+        parser.finder.load(snapshot)
+        getattr(parser, CORPUS_KINDS[kind][0])(content)
+        results[name] = parser.handler.records
+
+    return json.loads(json.dumps(results, ensure_ascii=False, default=str))
+
+
+def bench_golden(args):
+    documents = load_corpus(args.corpus, args.encoding)
+
+    with tempfile.TemporaryDirectory() as directory:
+        use_temp_database(directory)
+        snapshot = DocumentParser(DatabaseFinder, Handler).finder.snapshot()
+        db.close()
+
+    report = {str(create_missing): golden_records(documents, snapshot._replace(create_missing=create_missing))
+              for create_missing in (True, False)}
+
+    path = pathlib.Path(args.golden)
+    if args.write:
+        path.write_text(json.dumps(report, ensure_ascii=False, indent=1), encoding="utf-8")
+        print(f"{len(documents)} documents written to {path}")
+        return
+
+    expected = json.loads(path.read_text(encoding="utf-8"))
+    failed = 0
+
+    for create_missing, results in report.items():
+        for name, records in results.items():
+            old = expected.get(create_missing, {}).get(name)
+            if old is None:
+                print(f"NEW {name} (create_missing={create_missing})")
+                continue
+
+            if records != old:
+                failed += 1
+                index = next((i for i, (a, b) in enumerate(zip(records, old)) if a != b), min(len(records), len(old)))
+                print(f"DIFF {name} (create_missing={create_missing}) record {index}: "
+                      f"{records[index:index + 1]} != {old[index:index + 1]} (golden)")
+
+    print(f"{len(documents)} documents, {failed} differ from golden records")
+    sys.exit(1 if failed else 0)
+
+
+def add_document_arguments(p):
+    p.add_argument("timetable", help="Saved timetable page (html)")
+    p.add_argument("--call-schedule", help="Saved call schedule page (html)")
+    p.add_argument("--cvp", help="Saved canteen schedule (pdf)")
+    p.add_argument("--encoding", default="utf-8", help="Encoding of saved html pages")
+    p.add_argument("--repeat", type=int, default=5)
+
+
+def main():
+    ap = argparse.ArgumentParser(prog="python -m raspisanie_bot.benchmark")
+    sp = ap.add_subparsers(dest="command", required=True)
+
+    p = sp.add_parser("update", help="Compare database handlers on saved source documents")
+    add_document_arguments(p)
+    p.set_defaults(func=bench_update)
+
+    p = sp.add_parser("latency", help="Measure event loop lag while saved source documents are applied")
+    add_document_arguments(p)
+    p.add_argument("--workers", type=int, default=2, help="Number of parser processes to compare with")
+    p.set_defaults(func=bench_latency)
+
+    p = sp.add_parser("load", help="Measure handler latency while saved source documents are applied")
+    add_document_arguments(p)
+    p.add_argument("--workers", type=int, default=0, help="Number of parser processes")
+    p.add_argument("--readers", type=int, default=4, help="Number of database reader threads to compare with")
+    p.add_argument("--interval", type=float, default=5, help="Milliseconds between simulated messages")
+    p.set_defaults(func=bench_load)
+
+    p = sp.add_parser("dates", help="Check the fast date parser against dateparser and measure both")
+    p.add_argument("corpus", nargs="+", help="Saved timetable pages (html) or text files with one date per line")
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_dates)
+
+    p = sp.add_parser("pair_names", help="Measure pair name rules applied one by one, compiled and cached")
+    p.add_argument("--rules", type=int, nargs="+", default=[0, 10, 100, 1000])
+    p.add_argument("--names", type=int, default=500, help="Number of distinct pair names")
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_pair_names)
+
+    p = sp.add_parser("cvp", help="Compare CVP extraction engines on saved canteen schedules")
+    p.add_argument("pdf", nargs="+", help="Saved canteen schedules (pdf)")
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_cvp)
+
+    p = sp.add_parser("download", help="Compare peak memory of in-memory and streamed CVP downloads")
+    p.add_argument("pdf", nargs="+", help="Canteen schedules (pdf) served over local http")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_download)
+
+    p = sp.add_parser("scheduler", help="Compare one-shot jobs in the scheduler with one loop timer per job")
+    p.add_argument("--jobs", type=int, default=50000)
+    p.add_argument("--spread", type=float, default=2, help="Jobs are due evenly within this many seconds")
+    p.add_argument("--cancel-every", type=int, default=2, help="Cancel every n-th job before it is due, 0 - none")
+    p.set_defaults(func=bench_scheduler)
+
+    p = sp.add_parser("queries", help="Count queries of /my and /search on a synthetic database and measure them")
+    p.add_argument("--groups", type=int, default=30)
+    p.add_argument("--teachers", type=int, default=60)
+    p.add_argument("--cabinets", type=int, default=40)
+    p.add_argument("--days", type=int, default=14)
+    p.add_argument("--pairs", type=int, default=4, help="Pairs per day of every group")
+    p.add_argument("--repeat", type=int, default=10)
+    p.set_defaults(func=bench_queries)
+
+    p = sp.add_parser("corpus", help="Replay a directory of saved pages and PDFs, report stage timings as json")
+    p.add_argument("corpus", help="Directory with saved documents. Files in timetable/, call_schedule/ and cvp/ "
+                                  "subdirectories are parsed as such, others as timetables (html) or CVP (pdf)")
+    p.add_argument("--handler", nargs="+", choices=CORPUS_HANDLERS, default=["Handler", "DatabaseHandler"])
+    p.add_argument("--encoding", default="utf-8", help="Encoding of saved html pages")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--label", help="Version label stored in the report")
+    p.add_argument("--output", help="Write the report to file instead of stdout")
+    p.add_argument("--baseline", help="Previous report to compare median times with")
+    p.set_defaults(func=bench_corpus)
+
+    p = sp.add_parser("golden", help="Write or check parser records for a directory of saved documents")
+    p.add_argument("corpus", help="Directory with saved documents (see corpus)")
+    p.add_argument("golden", help="Json file with golden records")
+    p.add_argument("--write", action="store_true", help="Write records of the current version instead of checking")
+    p.add_argument("--encoding", default="utf-8", help="Encoding of saved html pages")
+    p.set_defaults(func=bench_golden)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,28 +5,35 @@ import signal
 import aiogram
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 
+from async_utils import Interval, Scheduler
 from raspisanie_bot.bot_errors import install_error_handlers
 from raspisanie_bot.commands import install_all_commands
-from raspisanie_bot.config import BOT_TOKEN
+from raspisanie_bot.config import BOT_TOKEN, LAST_SEEN_INTERVAL, feature_enabled
 from raspisanie_bot.database import preload_persistent
+from raspisanie_bot.db_executor import DB_EXECUTOR
 from raspisanie_bot.parsing import UpdateService
 from raspisanie_bot.sqlite_storage import SQLiteStorage
+from raspisanie_bot.users import USERS
 
 
-UPDATE_SERVICE = UpdateService()
+SCHEDULER = Scheduler()
+UPDATE_SERVICE = UpdateService(SCHEDULER)
 
 bot = aiogram.Bot(token=BOT_TOKEN, parse_mode="MarkdownV2")
 dp = aiogram.Dispatcher(bot, storage=SQLiteStorage())
 
 
 def stop(*_):
-    UPDATE_SERVICE.stop()
+    SCHEDULER.stop()
     dp.stop_polling()
 
 
 async def a_main():
     preload_persistent()
     UPDATE_SERVICE.start()
+    if feature_enabled("track_last_seen"):
+        SCHEDULER.add("flush_last_seen", USERS.flush, Interval(LAST_SEEN_INTERVAL))
+    scheduler_task = SCHEDULER.start()
 
     dp.setup_middleware(LoggingMiddleware())
 
@@ -35,6 +42,10 @@ async def a_main():
 
     await bot.set_my_commands(commands)
     await dp.start_polling(timeout=60)
+    await scheduler_task
+    await UPDATE_SERVICE.close()
+    await USERS.flush()
+    DB_EXECUTOR.close()
     await bot.close()
 
 
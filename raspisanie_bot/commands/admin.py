@@ -2,11 +2,13 @@ import aiogram
 from aiogram.dispatcher import FSMContext
 
 from ..bot_errors import bot_error
-from ..database import User
+from ..message_builder import MessageBuilder
+from ..render_cache import RENDER_CACHE
+from ..users import USERS
 
 
 async def cmd_admin(message: aiogram.types.Message, state: FSMContext):
-    user = User.from_telegram(message.from_user)
+    user = await USERS.get(message.from_user)
 
     if not user.is_admin:
         bot_error("NOT_ADMIN", user=user)
@@ -14,8 +16,26 @@ async def cmd_admin(message: aiogram.types.Message, state: FSMContext):
     arg = message.get_args()
     if arg == "update":
         from .. import bot_main
-        bot_main.UPDATE_SERVICE.force_update()
+        for pipeline in bot_main.UPDATE_SERVICE.sources.values():
+            bot_main.SCHEDULER.run_now(pipeline.job_name, force=True)
         await message.answer("Обновление инициировано")
+    elif arg == "schedule":
+        from .. import bot_main
+        decisions = sorted((i, pipeline.name) for pipeline in bot_main.UPDATE_SERVICE.sources.values()
+                           for i in pipeline.schedule.decisions)
+        res = MessageBuilder()
+        for i, source in decisions:
+            res.code(f"{i.time:%d.%m %H:%M}").text(f" {source} {i.kind} через {i.delay / 60:.0f} мин: {i.reason}").nl()
+
+        res.or_text("Обновлений ещё не было")
+        await message.answer(str(res))
+    elif arg == "cache":
+        total = RENDER_CACHE.hits + RENDER_CACHE.misses
+        await message.answer(str(MessageBuilder().text(
+            f"Сообщений в кэше: {len(RENDER_CACHE)} из {RENDER_CACHE.size}\n"
+            f"Попаданий: {RENDER_CACHE.hits}, промахов: {RENDER_CACHE.misses}"
+            f" ({RENDER_CACHE.hits / total if total else 0:.0%}), вытеснено: {RENDER_CACHE.evictions}\n"
+            f"Пользователей в кэше: {len(USERS)}, попаданий: {USERS.hits}, промахов: {USERS.misses}")))
     else:
         await message.answer("В разработке admin")
     await state.reset_state()
@@ -1,3 +1,4 @@
+import asyncio
 import io
 
 import aiogram
@@ -11,25 +12,33 @@ from ..bot_errors import bot_error
 from ..bot_utils import get_group_or_bot_error, get_teacher_or_bot_error
 from ..message_builder import MessageBuilder
 from ..config import INVITE_SIGN_KEY
-from ..database import Invite, User, Group, Teacher
+from ..database import Invite, Group, Teacher
+from ..db_executor import DB_EXECUTOR
 from ..encoded_invite import encode_invite
+from ..users import USERS
 
 
-def create_invite(user, data):
+def make_qr_code(link):
+    img = qrcode.make(link)
+    fp = io.BytesIO()
+    img.save(fp, format="PNG")
+    fp.seek(0)
+
+    return InputFile(fp, "qrcode.png")
+
+
+async def create_invite(user, data):
     set_admin = data.get("isa", False)
     if set_admin and not user.is_admin:
         bot_error("NOT_ADMIN", user=user)
 
-    invite = Invite.create(set_group=data.get("gri"), set_teacher=data.get("tei"), set_admin=set_admin)
+    invite = await DB_EXECUTOR.write(Invite.create, set_group=data.get("gri"), set_teacher=data.get("tei"),
+                                     set_admin=set_admin)
     code = encode_invite(INVITE_SIGN_KEY, invite.rowid)
     link = f"https://t.me/nkrp_bot?start={code}"
 
-    img = qrcode.make(link)
-    fp = io.BytesIO()
-    img.save(fp, format="PNG")
-    fp.seek(0)
-
-    return InputFile(fp, "qrcode.png"), link
+    # Rendered off the writer thread, which is kept for the writes of updates
+    return await asyncio.to_thread(make_qr_code, link), link
 
 
 class InviteStates(StatesGroup):
@@ -78,7 +87,7 @@ def make_invite_message(user, data=None):
 
 
 async def cmd_invite(message: aiogram.types.Message, state: FSMContext):
-    user = User.from_telegram(message.from_user)
+    user = await USERS.get(message.from_user)
     args = message.get_args().split()
 
     if args:
@@ -88,17 +97,17 @@ async def cmd_invite(message: aiogram.types.Message, state: FSMContext):
             data["isa"] = True
 
         if "group" in args:
-            data["gri"] = get_group_or_bot_error(user, args["group"]).rowid
+            data["gri"] = (await DB_EXECUTOR.read(get_group_or_bot_error, user, args["group"])).rowid
 
         if "teacher" in args:
-            data["tei"] = get_teacher_or_bot_error(user, args["teacher"]).rowid
+            data["tei"] = (await DB_EXECUTOR.read(get_teacher_or_bot_error, user, args["teacher"])).rowid
 
-        file, link = create_invite(user, data)
+        file, link = await create_invite(user, data)
         await message.answer_photo(file, link)
         await state.reset_state()
 
     else:
-        text, kb = make_invite_message(user)
+        text, kb = await DB_EXECUTOR.read(make_invite_message, user)
         msg = await message.answer(text, reply_markup=kb)
         async with state.proxy() as st:
             st["msg_id"] = msg.message_id
@@ -107,7 +116,7 @@ async def cmd_invite(message: aiogram.types.Message, state: FSMContext):
 
 
 async def cc_invite_set_admin(call: aiogram.types.CallbackQuery, state: FSMContext):
-    user = User.from_telegram(call.from_user)
+    user = await USERS.get(call.from_user)
 
     if not user.is_admin:
         bot_error("NOT_ADMIN", user=user)
@@ -117,7 +126,7 @@ async def cc_invite_set_admin(call: aiogram.types.CallbackQuery, state: FSMConte
 
         data = dict(st)
 
-    text, kb = make_invite_message(user, data)
+    text, kb = await DB_EXECUTOR.read(make_invite_message, user, data)
     await call.bot.edit_message_text(text, call.message.chat.id, data["msg_id"], reply_markup=kb)
 
     if data["isa"]:
@@ -141,8 +150,8 @@ async def cc_invite_set_teacher(call: aiogram.types.CallbackQuery):
 
 
 async def msg_invite_set_group(message: aiogram.types.Message, state: FSMContext):
-    user = User.from_telegram(message.from_user)
-    group = get_group_or_bot_error(user, message.text)
+    user = await USERS.get(message.from_user)
+    group = await DB_EXECUTOR.read(get_group_or_bot_error, user, message.text)
 
     async with state.proxy() as st:
         if "tei" in st:
@@ -153,13 +162,13 @@ async def msg_invite_set_group(message: aiogram.types.Message, state: FSMContext
 
         data = dict(st)
 
-    text, kb = make_invite_message(user, data)
+    text, kb = await DB_EXECUTOR.read(make_invite_message, user, data)
     await message.bot.edit_message_text(text, message.chat.id, data["msg_id"], reply_markup=kb)
 
 
 async def msg_invite_set_teacher(message: aiogram.types.Message, state: FSMContext):
-    user = User.from_telegram(message.from_user)
-    teacher = get_teacher_or_bot_error(user, message.text)
+    user = await USERS.get(message.from_user)
+    teacher = await DB_EXECUTOR.read(get_teacher_or_bot_error, user, message.text)
 
     async with state.proxy() as st:
         if "gri" in st:
@@ -170,17 +179,17 @@ async def msg_invite_set_teacher(message: aiogram.types.Message, state: FSMConte
 
         data = dict(st)
 
-    text, kb = make_invite_message(user, data)
+    text, kb = await DB_EXECUTOR.read(make_invite_message, user, data)
     await message.bot.edit_message_text(text, message.chat.id, data["msg_id"], reply_markup=kb)
 
 
 async def cc_invite_create(call: aiogram.types.CallbackQuery, state: FSMContext):
-    user = User.from_telegram(call.from_user)
+    user = await USERS.get(call.from_user)
 
     async with state.proxy() as st:
         data = dict(st)
 
-    file, link = create_invite(user, data)
+    file, link = await create_invite(user, data)
     await call.message.answer_photo(file, link, parse_mode="")
 
     await call.bot.delete_message(call.message.chat.id, data["msg_id"])
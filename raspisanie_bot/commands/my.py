@@ -1,31 +1,26 @@
-import datetime
-
 import aiogram
 from aiogram.dispatcher import FSMContext
 
 from ..bot_errors import bot_error
-from ..database import User, Group, Teacher, PairTime, Pair, CVPItem
+from ..database import Group, Generation
 from ..message_builder import MessageBuilder
+from ..render_cache import RENDER_CACHE
+from ..schedule import get_cvp_items, get_pairs, group_filter, teacher_filter
+from ..users import USERS
 
 
-async def my_for_students(message: aiogram.types.Message, user, group):
-    results = []
-
-    for pair in Pair.select().where(Pair.group == group).order_by(Pair.date, Pair.pair_number):
-        pair_time = PairTime.get_or_none(PairTime.pair_number == pair.pair_number)
-        results.append((pair.date, None, None, pair, pair_time))
-
-    for item in CVPItem.select().where(CVPItem.group == group).order_by(CVPItem.date):
-        results.append((item.date, item.start_time, item.end_time, None, None))
+def build_for_students(group):
+    generation = Generation.current()
+    results = [(pair.date, pair.start_time, pair.end_time, pair) for pair in get_pairs(group_filter(group), generation)]
+    results.extend((item.date, item.start_time, item.end_time, None) for item in get_cvp_items(group, generation))
 
-    results.sort(key=lambda x: (x[0], x[1], (None if x[2] is None else -x[2])))
+    # Pairs without a call schedule keep their order at the start of the day
+    results.sort(key=lambda x: (x[0], -1 if x[1] is None else x[1], 0 if x[2] is None else -x[2]))
 
     prev_date = None
     res = MessageBuilder()
 
-    today = datetime.datetime.now().date()
-
-    for date, start_time, end_time, pair, pair_time in results:
+    for date, start_time, end_time, pair in results:
         if date != prev_date:
             res.underline().date(date).no_underline().nl()
             prev_date = date
@@ -35,70 +30,49 @@ async def my_for_students(message: aiogram.types.Message, user, group):
             res.bold("Столовая").nl()
             continue
 
-        # pair_time = PairTime.get_or_none(PairTime.pair_number == pair.pair_number)
-        res.period(pair_time)
-
-        if pair.date == today and pair_time is not None and pair_time.is_current:
-            res.code(pair.pair_number)
-        else:
-            res.text(pair.pair_number)
-
+        res.period(pair.start_time, pair.end_time).pair_number(pair)
         res.raw(" ").bold(pair.name)
 
         for i in pair.teachers:
-            res.text(" ", i.short_name)
+            res.text(" ", i)
 
         for i in pair.cabinets:
-            res.text(" ", i.number)
+            res.text(" ", i)
 
         res.nl()
 
-    res.or_text("Нет пар")
-    await message.answer(str(res))
+    return res.or_text("Нет пар")
 
 
-async def my_for_teachers(message: aiogram.types.Message, user, teacher):
+def build_for_teachers(teacher):
     prev_date = None
     res = MessageBuilder()
 
-    today = datetime.datetime.now().date()
-
-    for pair in Pair.select().where(Pair.rowid.in_(
-            Pair.teachers.through_model.select(Pair.teachers.through_model.pair_id)
-                    .where(Pair.teachers.through_model.teacher_id == teacher.rowid)
-    )).order_by(Pair.date, Pair.pair_number):
+    for pair in get_pairs(teacher_filter(teacher)):
         if pair.date != prev_date:
             res.underline().date(pair.date).no_underline().nl()
             prev_date = pair.date
 
-        pair_time = PairTime.get_or_none(PairTime.pair_number == pair.pair_number)
-        res.period(pair_time)
-
-        if pair.date == today and pair_time is not None and pair_time.is_current:
-            res.code(pair.pair_number)
-        else:
-            res.text(pair.pair_number)
-
+        res.period(pair.start_time, pair.end_time).pair_number(pair)
         res.raw(' ').bold(pair.name)
-        res.text(" ", pair.group.string_value)
+        res.text(" ", pair.group)
 
         for i in pair.cabinets:
-            res.text(" ", i.number)
+            res.text(" ", i)
 
         res.nl()
 
-    res.or_text("Нет пар")
-    await message.answer(str(res))
+    return res.or_text("Нет пар")
 
 
 async def cmd_my(message: aiogram.types.Message, state: FSMContext):
-    user = User.from_telegram(message.from_user)
+    user = await USERS.get(message.from_user)
 
-    if user.group is not None:
-        await my_for_students(message, user, Group.get_by_id(user.group))
+    if user.group_id is not None:
+        await message.answer(await RENDER_CACHE.render("my_group", user.group_id))
 
-    elif user.teacher is not None:
-        await my_for_teachers(message, user, Teacher.get_by_id(user.teacher))
+    elif user.teacher_id is not None:
+        await message.answer(await RENDER_CACHE.render("my_teacher", user.teacher_id))
 
     else:
         bot_error("NOT_CONFIGURED", user=user)
@@ -108,4 +82,6 @@ async def cmd_my(message: aiogram.types.Message, state: FSMContext):
 
 def install_my(dp, all_commands):
     dp.register_message_handler(cmd_my, commands="my", state='*')
+    RENDER_CACHE.register("my_group", build_for_students, lambda: [i for i, in Group.select(Group.rowid).tuples()])
+    RENDER_CACHE.register("my_teacher", build_for_teachers)
     all_commands.append(aiogram.types.BotCommand("/my", "Мое расписание"))
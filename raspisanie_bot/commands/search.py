@@ -1,4 +1,4 @@
-import datetime
+import functools
 
 import aiogram
 from aiogram.dispatcher import FSMContext
@@ -6,8 +6,12 @@ from aiogram.dispatcher.filters.state import StatesGroup, State
 
 from ..bot_errors import bot_error
 from ..bot_utils import get_group_or_none, get_teacher_or_none
-from ..database import User, Group, Cabinet, Pair, PairTime
+from ..database import Cabinet, Pair, Generation
+from ..db_executor import DB_EXECUTOR
 from ..message_builder import MessageBuilder
+from ..render_cache import RENDER_CACHE
+from ..schedule import CabinetLink, TeacherLink, cabinet_filter, get_pairs, group_filter, teacher_filter
+from ..users import USERS
 
 
 def is_allow_hide_pair_comp(tm, gc, query):
@@ -20,64 +24,59 @@ def is_allow_hide_pair_comp(tm, gc, query):
     return count == 1
 
 
-async def do_search_query(message: aiogram.types.Message, user, search_type, target):
+def build_search(search_type, target):
+    generation = Generation.current()
+
     if search_type == 'group':
-        query = Pair.group == target
+        query = group_filter(target)
         allow_hide = True
 
     elif search_type == 'cabinet':
-        query = Pair.rowid.in_(Pair.cabinets.through_model.select(Pair.cabinets.through_model.pair_id)
-                               .where(Pair.cabinets.through_model.cabinet_id == target.number))
-        allow_hide = is_allow_hide_pair_comp(Pair.cabinets.through_model, Pair.cabinets.through_model.cabinet_id, query)
+        query = cabinet_filter(target)
+        allow_hide = is_allow_hide_pair_comp(CabinetLink, CabinetLink.cabinet_id, query & Pair.visible(generation))
 
     else:
         assert search_type == 'teacher'
-        query = Pair.rowid.in_(Pair.teachers.through_model.select(Pair.teachers.through_model.pair_id)
-                               .where(Pair.teachers.through_model.teacher_id == target.rowid))
-        allow_hide = is_allow_hide_pair_comp(Pair.teachers.through_model, Pair.teachers.through_model.teacher_id, query)
-
-    today = datetime.datetime.now().date()
+        query = teacher_filter(target)
+        allow_hide = is_allow_hide_pair_comp(TeacherLink, TeacherLink.teacher_id, query & Pair.visible(generation))
 
     prev_date = None
     res = MessageBuilder()
 
-    for pair in Pair.select(Pair, Group).join(Group).where(query).order_by(Pair.date, Pair.pair_number):
+    for pair in get_pairs(query, generation):
         if pair.date != prev_date:
             res.underline().date(pair.date).no_underline().nl()
             prev_date = pair.date
 
-        pair_time = PairTime.get_or_none(PairTime.pair_number == pair.pair_number)
-        res.period(pair_time)
-
-        if pair.date == today and pair_time is not None and pair_time.is_current:
-            res.code(pair.pair_number)
-        else:
-            res.text(pair.pair_number)
-
+        res.period(pair.start_time, pair.end_time).pair_number(pair)
         res.raw(' ').bold(pair.name)
 
         if search_type != 'group':
-            res.raw(' ').text(pair.group.string_value)
+            res.raw(' ').text(pair.group)
 
         if search_type != 'teacher' or not allow_hide:
             for i in pair.teachers:
                 res.raw(' ')
-                res.text(i.short_name)
+                res.text(i)
 
         if search_type != 'cabinet' or not allow_hide:
             for i in pair.cabinets:
                 res.raw(' ')
-                res.text(i.number)
+                res.text(i)
 
         res.nl()
 
-    res.or_text("Нет пар")
-    await message.answer(str(res))
+    return res.or_text("Нет пар")
 
 
-async def do_search(message: aiogram.types.Message, user, text):
-    text = text.lower().strip()
+async def do_search_query(message: aiogram.types.Message, user, search_type, target):
+    await message.answer(await RENDER_CACHE.render(f"search_{search_type}", target.get_id()))
+
 
+def find_search_target(text):
+    """
+    :return: (search type, Cabinet, Group or Teacher) or (None, None) if nothing is found
+    """
     try:
         if text == "спортзал":
             cabinet = 200
@@ -90,20 +89,27 @@ async def do_search(message: aiogram.types.Message, user, text):
     else:
         cabinet = Cabinet.get_or_none(Cabinet.number == cabinet)
         if cabinet is not None:
-            await do_search_query(message, user, 'cabinet', cabinet)
-            return
+            return 'cabinet', cabinet
 
     group = get_group_or_none(text)
     if group is not None:
-        await do_search_query(message, user, 'group', group)
-        return
+        return 'group', group
 
     teacher = get_teacher_or_none(text)
     if teacher is not None:
-        await do_search_query(message, user, 'teacher', teacher)
-        return
+        return 'teacher', teacher
+
+    return None, None
+
+
+async def do_search(message: aiogram.types.Message, user, text):
+    text = text.lower().strip()
+
+    search_type, target = await DB_EXECUTOR.read(find_search_target, text)
+    if target is None:
+        bot_error("NOT_FOUND", user=user, text=text)
 
-    bot_error("NOT_FOUND", user=user, text=text)
+    await do_search_query(message, user, search_type, target)
 
 
 class SearchStates(StatesGroup):
@@ -111,7 +117,7 @@ class SearchStates(StatesGroup):
 
 
 async def cmd_search(message: aiogram.types.Message, state: FSMContext):
-    user = User.from_telegram(message.from_user)
+    user = await USERS.get(message.from_user)
     args = message.get_args()
     if args:
         await do_search(message, user, args)
@@ -123,13 +129,15 @@ async def cmd_search(message: aiogram.types.Message, state: FSMContext):
 
 
 async def msg_search_text(message: aiogram.types.Message, state: FSMContext):
-    user = User.from_telegram(message.from_user)
+    user = await USERS.get(message.from_user)
     await do_search(message, user, message.text)
     await state.finish()
 
 
 def install_search(dp, all_commands):
     dp.register_message_handler(cmd_search, commands="search", state='*')
+    for search_type in ('group', 'cabinet', 'teacher'):
+        RENDER_CACHE.register(f"search_{search_type}", functools.partial(build_search, search_type))
     all_commands.append(aiogram.types.BotCommand("/search", "Найти группу, преподавателя или кабинет"))
 
     dp.register_message_handler(msg_search_text, state=SearchStates.waiting_for_text)
@@ -6,19 +6,13 @@ from aiogram.utils.callback_data import CallbackData
 
 from ..bot_utils import get_group_or_bot_error, get_teacher_or_bot_error
 from ..message_builder import MessageBuilder
-from ..database import User
+from ..db_executor import DB_EXECUTOR
+from ..users import USERS
 
 settings_cb = CallbackData("settings", "action")
 
 
-async def cmd_settings(message: aiogram.types.Message, state: FSMContext):
-    user = User.from_telegram(message.from_user)
-
-    kb = InlineKeyboardMarkup()
-
-    kb.add(InlineKeyboardButton("Студент", callback_data=settings_cb.new("set_group")),
-           InlineKeyboardButton("Преподаватель", callback_data=settings_cb.new("set_teacher")))
-
+def describe_user(user):
     res = MessageBuilder().text("Тип: ")
     if user.group:
         res.text("Студент\nГруппа: ", user.group.string_value)
@@ -32,7 +26,18 @@ async def cmd_settings(message: aiogram.types.Message, state: FSMContext):
     if user.is_admin:
         res.text("\nВы являетесь администратором.")
 
-    await message.answer(str(res), reply_markup=kb)
+    return str(res)
+
+
+async def cmd_settings(message: aiogram.types.Message, state: FSMContext):
+    user = await USERS.get(message.from_user)
+
+    kb = InlineKeyboardMarkup()
+
+    kb.add(InlineKeyboardButton("Студент", callback_data=settings_cb.new("set_group")),
+           InlineKeyboardButton("Преподаватель", callback_data=settings_cb.new("set_teacher")))
+
+    await message.answer(await DB_EXECUTOR.read(describe_user, user), reply_markup=kb)
     await state.reset_state()
 
 
@@ -53,23 +58,23 @@ async def cc_settings_set_group_teacher(call: aiogram.types.CallbackQuery, callb
 
 
 async def msg_settings_set_group(message: aiogram.types.Message, state: FSMContext):
-    user = User.from_telegram(message.from_user)
-    group = get_group_or_bot_error(user, message.text)
+    user = await USERS.get(message.from_user)
+    group = await DB_EXECUTOR.read(get_group_or_bot_error, user, message.text)
 
     user.teacher = None
     user.group = group
-    user.save()
+    await USERS.save(user)
     await message.answer("Группа успешно изменена")
     await state.finish()
 
 
 async def msg_settings_set_teacher(message: aiogram.types.Message, state: FSMContext):
-    user = User.from_telegram(message.from_user)
-    teacher = get_teacher_or_bot_error(user, message.text)
+    user = await USERS.get(message.from_user)
+    teacher = await DB_EXECUTOR.read(get_teacher_or_bot_error, user, message.text)
 
     user.group = None
     user.teacher = teacher
-    user.save()
+    await USERS.save(user)
     await message.answer("Сохранено успешно")
     await state.finish()
 
@@ -3,8 +3,10 @@ from aiogram.dispatcher import FSMContext
 
 from ..bot_errors import bot_error
 from ..config import INVITE_SIGN_KEY
-from ..database import Invite, User
+from ..database import Invite
+from ..db_executor import DB_EXECUTOR
 from ..encoded_invite import decode_invite
+from ..users import USERS
 
 
 HELP_TEXT = """\
@@ -16,26 +18,27 @@ HELP_TEXT = """\
 
 
 async def cmd_start(message: aiogram.types.Message, state: FSMContext):
-    user = User.from_telegram(message.from_user)
+    user = await USERS.get(message.from_user)
 
     args = message.get_args()
     if args:
         iid = decode_invite(INVITE_SIGN_KEY, args)
-        invite = Invite.get_or_none(Invite.rowid == iid)
+        invite = await DB_EXECUTOR.read(Invite.get_or_none, Invite.rowid == iid)
 
         if invite is None:
             bot_error("INVITE_NOT_EXIST", invite=iid, user=user)
 
+        # The user is shared by the messages of the registry, so it is changed on the event loop only
         if invite.set_admin:
             user.is_admin = True
 
-        if invite.set_group is not None:
-            user.group = invite.set_group
+        if invite.set_group_id is not None:
+            user.group_id = invite.set_group_id
 
-        elif invite.set_teacher is not None:
-            user.teacher = invite.set_teacher
+        elif invite.set_teacher_id is not None:
+            user.teacher_id = invite.set_teacher_id
 
-        user.save()
+        await USERS.save(user)
         await message.reply("Код приглашения активирован успешно")
 
     await message.answer(HELP_TEXT)
@@ -48,7 +51,7 @@ async def cmd_help(message: aiogram.types.Message, state: FSMContext):
 
 
 async def cmd_cancel(message: aiogram.types.Message, state: FSMContext):
-    User.from_telegram(message.from_user)
+    await USERS.get(message.from_user)
     await message.answer("Действие отменено")
     await state.reset_state()
 
@@ -1,18 +1,31 @@
 import aiogram
 from aiogram.dispatcher import FSMContext
 
-from ..database import PairTime
+from ..db_executor import DB_EXECUTOR
 from ..message_builder import MessageBuilder
+from ..schedule import PAIR_TIMES
 
 
 async def cmd_time(message: aiogram.types.Message, state: FSMContext):
     res = MessageBuilder()
-    for i in PairTime.select():
-        if i.is_current:
-            res.code(i.pair_number)
-        else:
-            res.text(i.pair_number)
-        res.text(". ").time(i.start_time).text(" - ").time(i.end_time).text("\n")
+    # Rows and the current pair are of the same build
+    snapshot = await DB_EXECUTOR.read(PAIR_TIMES.snapshot)
+    now = PAIR_TIMES.clock()
+
+    for source, rows in snapshot.pair_times.items():
+        if len(snapshot.pair_times) > 1:
+            res.bold(source).nl()
+
+        current, upcoming = snapshot.at(now, source)
+        for i in rows:
+            if i is current:
+                res.code(i.pair_number)
+            else:
+                res.text(i.pair_number)
+            res.text(". ").time(i.start_time).text(" - ").time(i.end_time).text("\n")
+
+        if current is None and upcoming is not None:
+            res.text("Следующая пара: ", upcoming.pair_number, " в ").time(upcoming.start_time).text("\n")
 
     res.or_text("Расписание звонков недоступно")
     await message.answer(str(res))
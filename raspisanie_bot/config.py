@@ -5,13 +5,33 @@ BOT_DIR = pathlib.Path(__file__).parent.parent
 
 config = json.loads((BOT_DIR / "config.json").read_text(encoding="utf8"))
 _features = None
-_replace_pair_names = None
+_pair_name_rules = None
 
 INVITE_SIGN_KEY = config.get("INVITE_SIGN_KEY", "").encode()
 JWT_KEY_FOR_ERRORS = config.get("JWT_KEY_FOR_ERRORS", "").encode()
 BOT_TOKEN = config.get("BOT_TOKEN")
 UPDATE_INTERVAL = config.get("UPDATE_INTERVAL", 3600)
+UPDATE_INTERVALS = {"timetable": UPDATE_INTERVAL, "cvp": UPDATE_INTERVAL, "call_schedule": 24 * 3600,
+                    **config.get("UPDATE_INTERVALS", {})}
+UPDATE_PROFILES = config.get("UPDATE_PROFILES", [])
+UPDATE_RETRY_DELAY = config.get("UPDATE_RETRY_DELAY", 30)
+UPDATE_RETRY_MAX = config.get("UPDATE_RETRY_MAX", 3600)
 TIMETABLE_URL = config.get("TIMETABLE_URL", "")
+DEFAULT_SOURCE = "main"
+SOURCES = config.get("SOURCES") or [{"name": DEFAULT_SOURCE, "url": TIMETABLE_URL}]
+HTTP_CONNECTIONS = config.get("HTTP_CONNECTIONS", 10)
+PARSE_WORKERS = config.get("PARSE_WORKERS", 0)
+PENDING_CONCURRENCY = config.get("PENDING_CONCURRENCY", 2)
+PENDING_TIMEOUT = config.get("PENDING_TIMEOUT", 600)
+CVP_ENGINE = config.get("CVP_ENGINE", "layout")
+MAX_DOWNLOAD_SIZE = config.get("MAX_DOWNLOAD_SIZE", 32 * 1024 * 1024)
+ARCHIVE_DIR = BOT_DIR / config.get("ARCHIVE_DIR", "archive")
+ARCHIVE_KEEP_DAYS = config.get("ARCHIVE_KEEP_DAYS", 90)
+RENDER_CACHE_SIZE = config.get("RENDER_CACHE_SIZE", 1024)
+TIMEZONE = config.get("TIMEZONE")
+DB_READERS = config.get("DB_READERS", 4)
+USER_CACHE_SIZE = config.get("USER_CACHE_SIZE", 4096)
+LAST_SEEN_INTERVAL = config.get("LAST_SEEN_INTERVAL", 60)
 
 
 def feature_enabled(name):
@@ -22,9 +42,15 @@ def feature_enabled(name):
     return bool(_features.get(name, False))
 
 
-def get_pair_name(name):
-    global _replace_pair_names
-    if _replace_pair_names is None:
-        _replace_pair_names = config.get("replace_pair_names", {})
+def get_pair_name_rules():
+    global _pair_name_rules
+    if _pair_name_rules is None:
+        from .parsing.pair_names import PairNameRules
+        _pair_name_rules = PairNameRules.from_config(config.get("pair_name_rules", []),
+                                                     config.get("replace_pair_names", {}))
+
+    return _pair_name_rules
 
-    return _replace_pair_names.get(name, name)
+
+def get_pair_name(name):
+    return get_pair_name_rules()(name)
@@ -1,10 +1,10 @@
-import datetime
 import pathlib
 
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 from playhouse.sqlite_ext import SqliteExtDatabase, RowIDField
 
-from .config import config
+from .config import DEFAULT_SOURCE, config
 
 db = SqliteExtDatabase(pathlib.Path(__file__).parent.parent / "database.sqlite", pragmas=(
     ('cache_size', -1024 * 64),  # 64MB page-cache.
@@ -40,7 +40,11 @@ class Teacher(BaseModel):
 
     @property
     def short_name(self):
-        return f"{self.surname} {self.name[0]}. {self.patronymic[0]}."
+        return self.format_short_name(self.surname, self.name, self.patronymic)
+
+    @staticmethod
+    def format_short_name(surname, name, patronymic):
+        return f"{surname} {name[0]}. {patronymic[0]}."
 
     class Meta:
         indexes = (
@@ -57,10 +61,14 @@ class Group(BaseModel):
 
     @property
     def string_value(self):
-        if self.course == 0:
-            return self.group.upper()
+        return self.format_string_value(self.course, self.group, self.subgroup)
+
+    @staticmethod
+    def format_string_value(course, group, subgroup):
+        if course == 0:
+            return group.upper()
 
-        return f"{self.course}-{self.group.upper()}-{self.subgroup}"
+        return f"{course}-{group.upper()}-{subgroup}"
 
     class Meta:
         indexes = (
@@ -74,12 +82,66 @@ class Cabinet(BaseModel):
 
 # #################################################################################################################### #
 #                                                                                                                      #
-#                             Базовые изменяемые компоненты через парсинг: pair, pair_time                             #
+#                       Базовые изменяемые компоненты через парсинг: generation, pair, pair_time                       #
 #                                                                                                                      #
 # #################################################################################################################### #
 
 
-class Pair(BaseModel):
+class Generation(BaseModel):
+    """
+    Number of the published generation of pair, pair_time and cvp_item rows of every source.
+    With staged_updates an update writes the next generation and publishes it when all documents are applied.
+    """
+    source = CharField(32, primary_key=True)
+    number = IntegerField()
+
+    @classmethod
+    def current(cls):
+        # source -> number, for visible() of rows from all sources
+        return dict(cls.select(cls.source, cls.number).tuples())
+
+    @classmethod
+    def of(cls, source):
+        return cls.select(cls.number).where(cls.source == source).scalar() or 0
+
+    @classmethod
+    def publish(cls, source, number):
+        cls.replace(source=source, number=number).execute()
+
+
+class DataVersion:
+    """
+    Number of parsed data changes visible in this process, stamps rendered messages in the render cache.
+    """
+    __slots__ = ('value', )
+
+    def __init__(self):
+        self.value = 0
+
+    def bump(self):
+        self.value += 1
+
+
+DATA_VERSION = DataVersion()
+
+
+class VersionedModel(BaseModel):
+    source = CharField(32, default=DEFAULT_SOURCE)  # Name of the timetable source in SOURCES
+    gen_from = IntegerField(default=0)
+    gen_to = IntegerField(null=True)  # Generation that no longer has the row
+
+    @classmethod
+    def visible(cls, generation):
+        """
+        :param generation: Number for rows of one source or Generation.current() for all of them
+        """
+        if isinstance(generation, dict):
+            generation = Case(cls.source, tuple(generation.items()), 0) if generation else 0
+
+        return (cls.gen_from <= generation) & (cls.gen_to.is_null() | (cls.gen_to > generation))
+
+
+class Pair(VersionedModel):
     rowid = RowIDField()
 
     date = DateField()
@@ -92,45 +154,21 @@ class Pair(BaseModel):
 
     class Meta:
         indexes = (
-            (('date', 'pair_number', 'group'), True),
+            (('date', 'pair_number', 'group', 'source', 'gen_from'), True),
         )
 
 
-class PairTime(BaseModel):
-    pair_number = IntegerField(primary_key=True)
+class PairTime(VersionedModel):
+    rowid = RowIDField()
+
+    pair_number = IntegerField()
     start_time = IntegerField()
     end_time = IntegerField()
 
-    @classmethod
-    def current(cls):
-        return cls.by_time(datetime.datetime.now())
-
-    @classmethod
-    def by_time(cls, curr_time):
-        # in_pair, non_prev_pair
-        curr_time = curr_time.hour * 60 + curr_time.minute
-
-        try:
-            pt = cls.select() \
-                .where(curr_time < cls.end_time) \
-                .order_by(cls.pair_number) \
-                .get()
-        except cls.DoesNotExist:
-            return False, None
-
-        return curr_time >= pt.start_time, pt
-
-    @property
-    def is_current(self):
-        curr_time = datetime.datetime.now()
-        curr_time = curr_time.hour * 60 + curr_time.minute
-        return self.start_time <= curr_time < self.end_time
-
-    @property
-    def is_next(self):
-        curr_time = datetime.datetime.now()
-        curr_time = curr_time.hour * 60 + curr_time.minute
-        return curr_time < self.start_time
+    class Meta:
+        indexes = (
+            (('source', 'pair_number', 'gen_from'), True),
+        )
 
 
 # #################################################################################################################### #
@@ -140,7 +178,7 @@ class PairTime(BaseModel):
 # #################################################################################################################### #
 
 
-class CVPItem(BaseModel):
+class CVPItem(VersionedModel):
     rowid = RowIDField()
 
     date = DateField()
@@ -149,6 +187,62 @@ class CVPItem(BaseModel):
     end_time = IntegerField()
 
 
+# #################################################################################################################### #
+#                                                                                                                      #
+#                    Загруженные документы: source_state, source_page, source_link, archived_source                    #
+#                                                                                                                      #
+# #################################################################################################################### #
+
+
+class SourceState(BaseModel):
+    # A document linked from several sources is parsed for each of them
+    source = CharField(32, default=DEFAULT_SOURCE)
+    url = CharField(512)
+    etag = CharField(256, null=True)
+    last_modified = CharField(64, null=True)
+    content_hash = CharField(64, null=True)
+
+    class Meta:
+        primary_key = CompositeKey('source', 'url')
+
+
+class SourcePage(BaseModel):
+    source = CharField(32, default=DEFAULT_SOURCE)
+    url = CharField(512)
+    page = IntegerField()
+    content_hash = CharField(64)
+    dates = TextField()  # Comma separated ISO dates found on the page
+
+    class Meta:
+        primary_key = CompositeKey('source', 'url', 'page')
+
+
+class SourceLink(BaseModel):
+    source = CharField(32, default=DEFAULT_SOURCE)
+    kind = CharField(16)  # cvp or call_schedule, as last linked from the timetable
+    url = CharField(512)
+
+    class Meta:
+        primary_key = CompositeKey('source', 'kind')
+
+
+class ArchivedSource(BaseModel):
+    rowid = RowIDField()
+
+    url = CharField(512)
+    kind = CharField(16)  # timetable, cvp or call_schedule
+    fetched_at = DateTimeField()
+    content_hash = CharField(64)  # Name of the compressed file in the archive directory
+    encoding = CharField(32, null=True)
+    etag = CharField(256, null=True)
+    last_modified = CharField(64, null=True)
+
+    class Meta:
+        indexes = (
+            (('url', 'fetched_at'), False),
+        )
+
+
 # #################################################################################################################### #
 #                                                                                                                      #
 #                                     Взаимодействие с пользователем: user, invite                                     #
@@ -164,15 +258,24 @@ class User(BaseModel):
     group = ForeignKeyField(Group, null=True)
     teacher = ForeignKeyField(Teacher, null=True)
 
+    last_seen = DateTimeField(null=True)  # Written in batches with the track_last_seen feature
+
+    class Meta:
+        # Saving a user without changes does not take the write lock
+        only_save_dirty = True
+
     @classmethod
-    def from_telegram(cls, telegram_user):
+    def from_telegram(cls, telegram_user, has_users=None):
+        """
+        :param has_users: Whether there are users already, queried if None. The first user becomes an admin
+        """
         user = User.get_or_none(User.rowid == telegram_user.id)
         if user is not None:
-            user.save()
             return user
 
-        count = User.select().count()
-        return User.create(rowid=telegram_user.id, is_admin=count == 0)
+        if has_users is None:
+            has_users = User.select().exists()
+        return User.create(rowid=telegram_user.id, is_admin=not has_users)
 
     def is_configured(self):
         return self.group is not None or self.teacher is not None
@@ -208,13 +311,35 @@ class StorageData(BaseModel):
 
 
 DeferredForeignKey.resolve(Invite)
-db.create_tables((
+MODELS = (
     Teacher, Group, Cabinet,
-    Pair, Pair.teachers.through_model, Pair.cabinets.through_model, PairTime,
-    CVPItem,
+    Generation, Pair, Pair.teachers.through_model, Pair.cabinets.through_model, PairTime,
+    CVPItem, SourceState, SourcePage, SourceLink, ArchivedSource,
     User, Invite,
     StorageState, StorageData
-))
+)
+VERSIONED_MODELS = (Pair, PairTime, CVPItem)
+
+
+def reset_outdated_tables():
+    # Parsed data is downloaded again, so tables written before sources are recreated instead of migrated
+    columns = db.get_columns(Pair._meta.table_name)
+    if not columns or any(i.name == 'source' for i in columns):
+        return
+
+    db.drop_tables((Generation, Pair, Pair.teachers.through_model, Pair.cabinets.through_model, PairTime, CVPItem,
+                    SourceState, SourcePage, SourceLink))
+
+
+def add_missing_columns():
+    columns = {i.name for i in db.get_columns(User._meta.table_name)}
+    if 'last_seen' not in columns:
+        migrate(SqliteMigrator(db).add_column(User._meta.table_name, 'last_seen', User.last_seen))
+
+
+reset_outdated_tables()
+db.create_tables(MODELS)
+add_missing_columns()
 
 
 def preload_persistent():
@@ -0,0 +1,61 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+
+from .config import DB_READERS
+from .database import db
+
+
+class DatabaseExecutor:
+    """
+    Runs database functions off the event loop: writes one at a time on the writer thread, reads on reader threads.
+    Peewee keeps a connection per thread and WAL lets readers run during a write, so reads never wait for an update.
+    With no readers everything runs in place, as before.
+    """
+    __slots__ = ('LOG', 'database', 'readers', '_writer', '_readers')
+
+    def __init__(self, database=db, readers=DB_READERS):
+        self.LOG = logging.getLogger(type(self).__name__)
+        self.database = database
+        self.readers = readers
+        self._writer = None
+        self._readers = None
+        if readers > 0:
+            self._writer = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="db-writer")
+            self._readers = concurrent.futures.ThreadPoolExecutor(readers, thread_name_prefix="db-reader")
+
+    def _read_in_thread(self, func, *args, **kwargs):
+        if self.database.is_closed():
+            self.database.connect()
+            # A write by mistake fails instead of taking the write lock from the writer
+            self.database.execute_sql("PRAGMA query_only = 1")
+
+        return func(*args, **kwargs)
+
+    async def read(self, func, *args, **kwargs):
+        """
+        Runs `func(*args, **kwargs)` that only reads from the database.
+        """
+        if self._readers is None:
+            return func(*args, **kwargs)
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self._readers, functools.partial(self._read_in_thread, func, *args, **kwargs))
+
+    async def write(self, func, *args, **kwargs):
+        """
+        Runs `func(*args, **kwargs)` that writes to the database, after the writes submitted before it.
+        """
+        if self._writer is None:
+            return func(*args, **kwargs)
+
+        return await asyncio.get_running_loop().run_in_executor(self._writer, functools.partial(func, *args, **kwargs))
+
+    def close(self):
+        for executor in (self._writer, self._readers):
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+
+DB_EXECUTOR = DatabaseExecutor()
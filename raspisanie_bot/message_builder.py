@@ -9,14 +9,29 @@ class MessageBuilder:
     QUOTE_PRE = str.maketrans({'`': '\\`', '\\': '\\\\'})
     QUOTE_URL = str.maketrans({')': '\\)', '\\': '\\\\'})
 
-    __slots__ = ('_parts', )
+    __slots__ = ('_parts', '_variants')
 
     def __init__(self):
         self._parts = []
+        self._variants = []  # (index in _parts, key, alternative)
 
     def __str__(self):
         return ''.join(self._parts)
 
+    def render(self, active):
+        """
+        Joins the message with variants replaced by their alternatives where `active(key)` is true.
+        Only the variants are checked, so a built message can be cached and rendered cheaply for every send.
+        """
+        parts = self._parts
+        for index, key, alternative in self._variants:
+            if active(key):
+                if parts is self._parts:
+                    parts = parts.copy()
+                parts[index] = alternative
+
+        return ''.join(parts)
+
     @property
     def empty(self):
         return not self._parts
@@ -34,6 +49,13 @@ class MessageBuilder:
             start_time, end_time = start_time.start_time, start_time.end_time
         return self.time(start_time).text(" - ").time(end_time).raw(" ")
 
+    def variant(self, key, value, alternative) -> 'MessageBuilder':
+        """
+        Adds formatted `value`, replaced by formatted `alternative` on render() when `key` is active.
+        """
+        self._variants.append((len(self._parts), key, str(alternative)))
+        return self.raw(str(value))
+
     def raw(self, *value) -> 'MessageBuilder':
         self._parts.extend(value)
         return self
@@ -93,3 +115,7 @@ class MessageBuilder:
 
     def time(self, time):
         return self.text(time // 60, ':', format(time % 60, "02"))
+
+    def pair_number(self, pair):
+        # Set in code by render() while the pair is current
+        return self.variant(pair, MessageBuilder().text(pair.pair_number), MessageBuilder().code(pair.pair_number))
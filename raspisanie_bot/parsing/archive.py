@@ -0,0 +1,168 @@
+import asyncio
+import datetime
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from peewee import fn
+
+from .parsers import AsyncParser, Download, TimetableUpdater
+from ..database import ArchivedSource
+
+ARCHIVE_EXTENSIONS = {"timetable": ".htm", "call_schedule": ".htm", "cvp": ".pdf"}
+
+
+class NotArchivedError(Exception):
+    pass
+
+
+async def call_in_place(func, *args):
+    return func(*args)
+
+
+class SourceArchive:
+    """
+    Downloaded documents stored once per content hash as gzip files, with an index of fetches in the database.
+    """
+    __slots__ = ('LOG', 'directory', 'keep_days')
+
+    def __init__(self, directory, keep_days=None):
+        self.LOG = logging.getLogger(type(self).__name__)
+        self.directory = directory
+        self.keep_days = keep_days
+
+    def get_path(self, content_hash):
+        return self.directory / content_hash[:2] / f"{content_hash}.gz"
+
+    def index(self, url, kind, download):
+        """
+        :return: (ArchivedSource, content hashes still in use or None if no versions expired)
+        """
+        version = ArchivedSource.create(url=url, kind=kind, fetched_at=datetime.datetime.now(),
+                                        content_hash=download.content_hash, encoding=download.encoding,
+                                        etag=download.etag, last_modified=download.last_modified)
+        return version, self.get_used_hashes() if self.remove_expired() else None
+
+    async def store(self, url, kind, download, call_db=call_in_place):
+        """
+        :param call_db: Coroutine function running database writes, e.g. TimetableUpdater.call_db
+        """
+        # Indexed before writing, so removal of unused files from a concurrent update keeps it
+        since = time.time()
+        version, used = await call_db(self.index, url, kind, download)
+        if used is not None:
+            # Files are removed off the database thread
+            await asyncio.to_thread(self.remove_unused, used, since)
+
+        path = self.get_path(download.content_hash)
+        try:
+            # Touched, so removal of unused files that read the index before this version keeps it
+            os.utime(path)
+            return
+        except FileNotFoundError:
+            pass
+
+        try:
+            await asyncio.to_thread(self.write, path, download.file)
+        except BaseException:
+            await call_db(version.delete_instance)
+            raise
+
+        self.LOG.info("Archived %s as %s", url, path.name)
+
+    @staticmethod
+    def write(path, file):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(".tmp")
+
+        file.seek(0)
+        with gzip.open(temp_path, "wb", compresslevel=6) as fp:
+            shutil.copyfileobj(file, fp)
+
+        os.replace(temp_path, path)
+
+    def open(self, version):
+        file = tempfile.SpooledTemporaryFile(AsyncParser.DOWNLOAD_SPOOL_SIZE)
+
+        try:
+            with gzip.open(self.get_path(version.content_hash), "rb") as fp:
+                shutil.copyfileobj(fp, file)
+        except BaseException:
+            file.close()
+            raise
+
+        return Download(file, version.encoding, version.etag, version.last_modified, version.content_hash)
+
+    def read(self, version):
+        with gzip.open(self.get_path(version.content_hash), "rb") as fp:
+            return fp.read()
+
+    # noinspection PyMethodMayBeStatic
+    def versions(self, url=None, until=None):
+        query = ArchivedSource.select().order_by(ArchivedSource.fetched_at, ArchivedSource.rowid)
+        if url is not None:
+            query = query.where(ArchivedSource.url == url)
+        if until is not None:
+            query = query.where(ArchivedSource.fetched_at <= until)
+
+        return list(query)
+
+    def latest_versions(self, until=None):
+        return {i.url: i for i in self.versions(until=until)}
+
+    def remove_expired(self):
+        """
+        Removes expired versions from the index, their files are removed by remove_unused.
+        :return: Number of removed versions
+        """
+        if self.keep_days is None:
+            return 0
+
+        # The last version of every document is kept, so it can always be replayed
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=self.keep_days)
+        latest = ArchivedSource.select(fn.MAX(ArchivedSource.rowid)).group_by(ArchivedSource.url)
+        return ArchivedSource.delete() \
+            .where((ArchivedSource.fetched_at < cutoff) & ArchivedSource.rowid.not_in(latest)) \
+            .execute()
+
+    @staticmethod
+    def get_used_hashes():
+        return {i for i, in ArchivedSource.select(ArchivedSource.content_hash).distinct().tuples()}
+
+    def remove_unused(self, used, since):
+        """
+        :param used: Content hashes in the index
+        :param since: Time the hashes were read at, files written later are of versions indexed after it
+        """
+        removed = 0
+
+        for path in self.directory.glob("*/*.gz"):
+            if path.stem not in used and path.stat().st_mtime < since:
+                path.unlink()
+                removed += 1
+
+        if removed:
+            self.LOG.info("Removed %d archived documents", removed)
+
+
+class ArchiveUpdater(TimetableUpdater):
+    """
+    Takes documents from the archive instead of the site.
+    :param versions: url -> ArchivedSource to use
+    """
+
+    def __init__(self, finder_class, handler_class, source, versions, workers=0, **kwargs):
+        super().__init__(finder_class, handler_class, workers, **kwargs)
+        self.source = source
+        self.versions = versions
+
+    async def download_content(self, url, info=None):
+        version = self.versions.get(url)
+        if version is None:
+            raise NotArchivedError(f"{url} is not archived")
+
+        self.LOG.info("Replaying %s fetched at %s", url, version.fetched_at)
+        return await asyncio.to_thread(self.source.open, version)
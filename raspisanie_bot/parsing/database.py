@@ -1,74 +1,384 @@
+import collections
 import datetime
 
 import peewee
 
-from .parsers import Finder, Handler, SubpagesParsingHandler
-from ..config import feature_enabled, get_pair_name
-from ..database import Cabinet, Teacher, Group, Pair, PairTime, CVPItem
+from .parsers import CVPPageState, EntitySnapshot, Handler, SnapshotFinder, SourceInfo, SubpagesParsingHandler
+from ..config import feature_enabled
+from ..database import DATA_VERSION, VERSIONED_MODELS, Cabinet, Teacher, Group, Generation, Pair, PairTime, CVPItem, \
+    SourceState, SourcePage, SourceLink, db
 
+PairChange = collections.namedtuple('PairChange', ('action', 'date', 'pair_number', 'group', 'name', 'teachers',
+                                                   'cabinets'))
 
-class DatabaseFinder(Finder):
-    __slots__ = ()
+
+class DatabaseFinder(SnapshotFinder):
+    __slots__ = ('_loaded', '_group_models', '_teacher_models', '_cabinet_models', '_missing')
+
+    def __init__(self, parser):
+        super().__init__(parser)
+        self._loaded = False
+        self._group_models = None
+        self._teacher_models = None
+        self._cabinet_models = None
+        self._missing = None
+
+    def reset(self):
+        self._loaded = False
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+
+        self._group_models = {(i.course, i.group, i.subgroup): i for i in Group.select()}
+        self._teacher_models = {(i.surname, i.name, i.patronymic): i for i in Teacher.select().order_by(Teacher.rowid)}
+        self._cabinet_models = {i.number: i for i in Cabinet.select()}
+        self._missing = ([], [], [])  # groups, teachers, cabinets
+
+        self._loaded = True
+        self.load(self.snapshot())
+
+    def snapshot(self):
+        self._ensure_loaded()
+        return EntitySnapshot(tuple(self._group_models), tuple(self._teacher_models), tuple(self._cabinet_models),
+                              feature_enabled("create_missing_persist"))
+
+    def resolve_group(self, key):
+        group = self._group_models.get(key)
+        if group is None:
+            group = self._group_models[key] = Group(course=key[0], group=key[1], subgroup=key[2])
+            self._missing[0].append(group)
+
+        return group
+
+    def resolve_teacher(self, key):
+        teacher = self._teacher_models.get(key)
+        if teacher is None:
+            teacher = self._teacher_models[key] = Teacher(surname=key[0], name=key[1], patronymic=key[2])
+            self._missing[1].append(teacher)
+
+        return teacher
+
+    def resolve_cabinet(self, key):
+        cabinet = self._cabinet_models.get(key)
+        if cabinet is None:
+            cabinet = self._cabinet_models[key] = Cabinet(number=key)
+            self._missing[2].append(cabinet)
+
+        return cabinet
 
     def find_cabinet(self, text):
+        self._ensure_loaded()
         number = super().find_cabinet(text)
-        if number is None:
+        return None if number is None else self.resolve_cabinet(number)
+
+    def find_teacher(self, surname, name, patronymic):
+        self._ensure_loaded()
+        key = super().find_teacher(surname, name, patronymic)
+        return None if key is None else self.resolve_teacher(key)
+
+    def find_group(self, text):
+        self._ensure_loaded()
+        key = super().find_group(text)
+        return None if key is None else self.resolve_group(key)
+
+    def persist_missing(self):
+        if self._missing is None or not any(self._missing):
+            return
+
+        groups, teachers, cabinets = self._missing
+
+        with db.atomic():
+            for batch in peewee.chunked(groups, 100):
+                Group.insert_many(((i.course, i.group, i.subgroup) for i in batch),
+                                  fields=[Group.course, Group.group, Group.subgroup]).on_conflict_ignore().execute()
+
+            for batch in peewee.chunked(teachers, 100):
+                Teacher.insert_many(((i.surname, i.name, i.patronymic) for i in batch),
+                                    fields=[Teacher.surname, Teacher.name, Teacher.patronymic])\
+                    .on_conflict_ignore().execute()
+
+            for batch in peewee.chunked(cabinets, 100):
+                Cabinet.insert_many(((i.number, ) for i in batch), fields=[Cabinet.number]).on_conflict_ignore()\
+                    .execute()
+
+        if groups:
+            ids = {tuple(key): rowid for rowid, *key in
+                   Group.select(Group.rowid, Group.course, Group.group, Group.subgroup).tuples()}
+            for i in groups:
+                i.rowid = ids[(i.course, i.group, i.subgroup)]
+
+        if teachers:
+            ids = {tuple(key): rowid for rowid, *key in
+                   Teacher.select(Teacher.rowid, Teacher.surname, Teacher.name, Teacher.patronymic).tuples()}
+            for i in teachers:
+                i.rowid = ids[(i.surname, i.name, i.patronymic)]
+
+        self._missing = ([], [], [])
+
+
+class DatabaseHandler(Handler):
+    BUFFERED = False  # Collect records and write them with insert_many in one transaction per source document
+
+    __slots__ = ('_pairs', '_reset_dates', 'changes', '_cvp_dates', '_cvp_items', '_pair_times', '_staging',
+                 '_source_infos', '_source_pages')
+
+    def __init__(self, parser):
+        super().__init__(parser)
+        self._pairs = []  # (date, pair_number, group, name, teachers, cabinets)
+        self._reset_dates = set()
+        self.changes = []
+        self._cvp_dates = set()
+        self._cvp_items = []
+        self._pair_times = None
+        self._staging = None  # Generation written by the current staged update
+        self._source_infos = {}
+        self._source_pages = {}
+
+    @property
+    def source(self):
+        return self.parser.source_name
+
+    def _buffers(self):
+        return self.BUFFERED or self._staging is not None
+
+    def _buffers_timetable(self):
+        return self._buffers() or feature_enabled("incremental_update")
+
+    def _generation(self):
+        return Generation.of(self.source) if self._staging is None else self._staging
+
+    def _bump_data_version(self):
+        # Called after the rows are written: a message built on a reader thread during the write is not cached under
+        # the new version. Staged rows wait for publishing
+        if self._staging is None:
+            DATA_VERSION.bump()
+
+    def _remove(self, model, where):
+        where &= model.source == self.source
+        if self._staging is None:
+            model.delete().where(where).execute()
+            return
+
+        # Published rows stay for readers of the active generation
+        model.delete().where(where & (model.gen_from == self._staging)).execute()
+        model.update(gen_to=self._staging).where(where & model.gen_to.is_null()).execute()
+
+    def handle_new_update(self):
+        super().handle_new_update()
+
+        if not feature_enabled("staged_updates"):
+            return
+
+        active = Generation.of(self.source)
+        with db.atomic():
+            for model in VERSIONED_MODELS:
+                # Rows of an update that was not published
+                model.delete().where((model.source == self.source) & (model.gen_from > active)).execute()
+                model.update(gen_to=None).where((model.source == self.source) & (model.gen_to > active)).execute()
+
+        self._staging = active + 1
+        self._source_infos = {}
+        self._source_pages = {}
+
+    def handle_end_update(self, succeeded):
+        super().handle_end_update(succeeded)
+
+        if self._staging is None:
             return None
 
-        if feature_enabled("create_missing_persist"):
-            return Cabinet.get_or_create(number=number)[0]
-        return Cabinet.get_or_none(Cabinet.number == number)
+        generation, self._staging = self._staging, None
+        if succeeded and not self._is_generation_changed(generation):
+            # Nothing to publish: readers keep the active generation and the messages built from it
+            with db.atomic():
+                self._write_source_states()
+            self.parser.LOG.info("Generation %d of %s has no changes", generation, self.source)
+            return None
 
-    def find_teacher(self, surname, name, patronymic):
-        surname, name, patronymic = super().find_teacher(surname, name, patronymic)
-        surname = surname.capitalize()
-        name = name.capitalize()
-        patronymic = patronymic.capitalize()
+        error = "some documents failed" if not succeeded else self._validate_generation(generation)
+        if error is not None:
+            self.parser.LOG.error("Generation %d is not published: %s", generation, error)
+            return f"generation {generation} is not published: {error}"
 
-        if feature_enabled("create_missing_persist"):
-            return Teacher.get_or_create(surname=surname, name=name, patronymic=patronymic)[0]
-        return Teacher.get_or_none(Teacher.surname == surname, Teacher.name.startswith(name),
-                                   Teacher.patronymic.startswith(patronymic))
+        with db.atomic():
+            self._write_source_states()
+            Generation.publish(self.source, generation)
+        DATA_VERSION.bump()
 
-    def find_group(self, text):
-        group = super().find_group(text)
-        if group is None:
+        # Rows of the previous generation are kept for readers that have just read its number
+        for model in VERSIONED_MODELS:
+            model.delete().where((model.source == self.source) & (model.gen_to < generation)).execute()
+
+        self.parser.LOG.info("Generation %d of %s published", generation, self.source)
+        return None
+
+    def _write_source_states(self):
+        for url, info in self._source_infos.items():
+            self._write_source_info(url, info)
+        for url, pages in self._source_pages.items():
+            self._write_cvp_pages(url, pages)
+
+    def _is_generation_changed(self, generation):
+        # Rows inserted or retired by the staged update
+        return any(model.select().where((model.source == self.source) &
+                                        ((model.gen_from == generation) | (model.gen_to == generation))).exists()
+                   for model in VERSIONED_MODELS)
+
+    # noinspection PyMethodMayBeStatic
+    def _validate_generation(self, generation):
+        # Everything removed at once is more likely a broken document than an empty timetable
+        for model in VERSIONED_MODELS:
+            mine = model.select().where(model.source == self.source)
+            if mine.where(model.visible(generation - 1)).exists() and \
+                    not mine.where(model.visible(generation)).exists():
+                return f"all {model._meta.table_name} rows removed"
+
+        return None
+
+    def get_source_info(self, url):
+        state = SourceState.get_or_none((SourceState.source == self.source) & (SourceState.url == url))
+        if state is None:
             return None
 
-        if feature_enabled("create_missing_persist"):
-            return Group.get_or_create(course=group.course, group=group.group, subgroup=group.subgroup)[0]
-        return Group.get_or_none(Group.course == group.course, Group.group == group.group,
-                                 Group.subgroup == group.subgroup)
+        return SourceInfo(state.etag, state.last_modified, state.content_hash)
 
-    def find_pair(self, text):
-        text = super().find_pair(text)
-        return get_pair_name(text)
+    def handle_source_info(self, url, info):
+        super().handle_source_info(url, info)
 
+        if self._staging is None:
+            self._write_source_info(url, info)
+        else:
+            self._source_infos[url] = info
 
-class DatabaseHandler(Handler):
-    __slots__ = ()
+    def _write_source_info(self, url, info):
+        SourceState.replace(source=self.source, url=url, etag=info.etag, last_modified=info.last_modified,
+                            content_hash=info.content_hash).execute()
+
+    def get_source_links(self):
+        return {i.kind: i.url for i in SourceLink.select().where(SourceLink.source == self.source)}
+
+    def handle_cvp(self, link):
+        super().handle_cvp(link)
+        SourceLink.replace(source=self.source, kind="cvp", url=link).execute()
+
+    def handle_call_schedule(self, link):
+        super().handle_call_schedule(link)
+        SourceLink.replace(source=self.source, kind="call_schedule", url=link).execute()
+
+    def get_cvp_pages(self, url):
+        pages = {}
+        for i in SourcePage.select().where((SourcePage.source == self.source) & (SourcePage.url == url)):
+            dates = tuple(datetime.date.fromisoformat(d) for d in i.dates.split(',') if d)
+            pages[i.page] = CVPPageState(i.content_hash, dates)
+
+        return pages
+
+    def handle_cvp_pages(self, url, pages):
+        super().handle_cvp_pages(url, pages)
+
+        if self._staging is None:
+            self._write_cvp_pages(url, pages)
+        else:
+            self._source_pages[url] = pages
+
+    def _write_cvp_pages(self, url, pages):
+        rows = ((self.source, url, i, state.content_hash, ','.join(d.isoformat() for d in state.dates))
+                for i, state in enumerate(pages))
+
+        with db.atomic():
+            SourcePage.delete().where((SourcePage.source == self.source) & (SourcePage.url == url)).execute()
+
+            for batch in peewee.chunked(rows, 200):
+                SourcePage.insert_many(batch, fields=[SourcePage.source, SourcePage.url, SourcePage.page,
+                                                      SourcePage.content_hash, SourcePage.dates]).execute()
 
     def handle_new_cvp_date(self, date):
         super().handle_new_cvp_date(date)
-        CVPItem.delete().where(CVPItem.date == date).execute()
+
+        if self._buffers():
+            self._cvp_dates.add(date)
+        else:
+            self._remove(CVPItem, CVPItem.date == date)
 
     def handle_cvp_item(self, date, group, start, end):
         super().handle_cvp_item(date, group, start, end)
-        CVPItem.create(date=date, group=group, start_time=start, end_time=end)
+
+        if self._buffers():
+            self._cvp_items.append((date, group, start, end))
+        else:
+            self.parser.finder.persist_missing()
+            CVPItem.create(date=date, group=group, start_time=start, end_time=end, source=self.source,
+                           gen_from=self._generation())
+
+    def handle_end_cvp(self):
+        super().handle_end_cvp()
+
+        try:
+            if not self._buffers():
+                return
+
+            self.parser.finder.persist_missing()
+            generation = self._generation()
+            items = ((date, group.rowid, start, end, self.source, generation)
+                     for date, group, start, end in self._cvp_items)
+
+            with db.atomic():
+                if self._cvp_dates:
+                    self._remove(CVPItem, CVPItem.date.in_(list(self._cvp_dates)))
+
+                for batch in peewee.chunked(items, 200):
+                    CVPItem.insert_many(batch, fields=[CVPItem.date, CVPItem.group, CVPItem.start_time,
+                                                       CVPItem.end_time, CVPItem.source, CVPItem.gen_from]).execute()
+
+            self._cvp_dates = set()
+            self._cvp_items = []
+        finally:
+            self._bump_data_version()
 
     def handle_new_call_schedule(self):
         super().handle_new_call_schedule()
-        PairTime.delete().execute()
+
+        if self._buffers():
+            self._pair_times = []
+        else:
+            self._remove(PairTime, PairTime.pair_number.is_null(False))
 
     def handle_pair_time(self, pair, start, end):
         super().handle_pair_time(pair, start, end)
-        PairTime.create(pair_number=pair, start_time=start, end_time=end)
+
+        if self._buffers():
+            self._pair_times.append((pair, start, end))
+        else:
+            PairTime.create(pair_number=pair, start_time=start, end_time=end, source=self.source,
+                            gen_from=self._generation())
+
+    def handle_end_call_schedule(self):
+        super().handle_end_call_schedule()
+
+        try:
+            if not self._buffers() or self._pair_times is None:
+                return
+
+            generation = self._generation()
+            with db.atomic():
+                self._remove(PairTime, PairTime.pair_number.is_null(False))
+
+                for batch in peewee.chunked(((*i, self.source, generation) for i in self._pair_times), 300):
+                    PairTime.insert_many(batch, fields=[PairTime.pair_number, PairTime.start_time, PairTime.end_time,
+                                                        PairTime.source, PairTime.gen_from]).execute()
+
+            self._pair_times = None
+        finally:
+            self._bump_data_version()
 
     def handle_new_date(self, new_date, old_date):
         super().handle_new_date(new_date, old_date)
 
         if old_date is None:
-            Pair.delete().where(Pair.date == new_date).execute()
+            if self._buffers_timetable():
+                self._reset_dates.add(new_date)
+            else:
+                self._remove(Pair, Pair.date == new_date)
 
     def handle_parsed_pair(self, date, group, pair_number, pair, teachers, cabinets, subgroup, is_substitution):
         super().handle_parsed_pair(date, group, pair_number, pair, teachers, cabinets, subgroup, is_substitution)
@@ -76,7 +386,13 @@ class DatabaseHandler(Handler):
         if subgroup is not None:
             pair = f"{pair} ({subgroup} группа)"
 
-        pair = Pair(date=date, pair_number=pair_number, group=group, name=pair)
+        if self._buffers_timetable():
+            self._pairs.append((date, pair_number, group, pair, tuple(teachers), tuple(cabinets)))
+            return
+
+        self.parser.finder.persist_missing()
+        pair = Pair(date=date, pair_number=pair_number, group=group, name=pair, source=self.source,
+                    gen_from=self._generation())
         pair.save()
 
         try:
@@ -89,10 +405,155 @@ class DatabaseHandler(Handler):
         except peewee.IntegrityError:
             pass
 
+    def handle_end_timetable(self):
+        super().handle_end_timetable()
+
+        try:
+            if not self._buffers_timetable():
+                return
+
+            incremental = feature_enabled("incremental_update")
+            pairs = self._collect_pairs()
+            generation = self._generation()
+
+            with db.atomic():
+                if incremental:
+                    self.changes = self._diff_pairs(pairs, generation)
+                    self._apply_pair_changes(generation)
+                else:
+                    self._replace_pairs(pairs, generation)
+
+            self._pairs = []
+            self._reset_dates = set()
+
+            if incremental:
+                counts = collections.Counter(i.action for i in self.changes)
+                self.parser.LOG.info("Timetable changes: %d inserted, %d updated, %d deleted",
+                                     counts['insert'], counts['update'], counts['delete'])
+        finally:
+            self._bump_data_version()
+
+    def _collect_pairs(self):
+        self.parser.finder.persist_missing()
+
+        # (date, pair_number, group_id) -> (name, teacher_ids, cabinet_numbers)
+        return {
+            (date, pair_number, group.rowid): (name, tuple(sorted({i.rowid for i in teachers})),
+                                               tuple(sorted({i.number for i in cabinets})))
+            for date, pair_number, group, name, teachers, cabinets in self._pairs
+        }
+
+    def _replace_pairs(self, pairs, generation):
+        if self._reset_dates:
+            self._remove(Pair, Pair.date.in_(list(self._reset_dates)))
+
+        if not pairs:
+            return
+
+        for batch in peewee.chunked(pairs.items(), 200):
+            Pair.insert_many(((*key, value[0], self.source, generation) for key, value in batch),
+                             fields=[Pair.date, Pair.pair_number, Pair.group, Pair.name, Pair.source,
+                                     Pair.gen_from]).execute()
+
+        dates = list({key[0] for key in pairs})
+        rowids = {(date, pair_number, group_id): rowid for rowid, date, pair_number, group_id in
+                  Pair.select(Pair.rowid, Pair.date, Pair.pair_number, Pair.group)
+                  .where(Pair.date.in_(dates) & (Pair.source == self.source) & Pair.visible(generation)).tuples()}
+
+        pt = Pair.teachers.through_model
+        teachers = ((rowids[key], i) for key, value in pairs.items() for i in value[1])
+        for batch in peewee.chunked(teachers, 400):
+            pt.insert_many(batch, fields=[pt.pair, pt.teacher]).execute()
+
+        pc = Pair.cabinets.through_model
+        cabinets = ((rowids[key], i) for key, value in pairs.items() for i in value[2])
+        for batch in peewee.chunked(cabinets, 400):
+            pc.insert_many(batch, fields=[pc.pair, pc.cabinet]).execute()
+
+    def _load_stored_pairs(self, dates, generation):
+        stored = {}  # (date, pair_number, group_id) -> (rowid, name, teacher_ids, cabinet_numbers)
+        teachers = collections.defaultdict(set)
+        cabinets = collections.defaultdict(set)
+        where = Pair.date.in_(dates) & (Pair.source == self.source) & Pair.visible(generation)
+
+        pt = Pair.teachers.through_model
+        for pair_id, teacher_id in pt.select(pt.pair_id, pt.teacher_id).join(Pair).where(where).tuples():
+            teachers[pair_id].add(teacher_id)
+
+        pc = Pair.cabinets.through_model
+        for pair_id, cabinet_id in pc.select(pc.pair_id, pc.cabinet_id).join(Pair).where(where).tuples():
+            cabinets[pair_id].add(cabinet_id)
+
+        for rowid, date, pair_number, group_id, name in Pair.select(Pair.rowid, Pair.date, Pair.pair_number,
+                                                                    Pair.group, Pair.name).where(where).tuples():
+            stored[(date, pair_number, group_id)] = (rowid, name, tuple(sorted(teachers[rowid])),
+                                                     tuple(sorted(cabinets[rowid])))
+
+        return stored
+
+    def _diff_pairs(self, pairs, generation):
+        dates = self._reset_dates | {key[0] for key in pairs}
+        if not dates:
+            return []
+
+        stored = self._load_stored_pairs(list(dates), generation)
+        changes = []
+
+        for key, value in pairs.items():
+            old = stored.get(key)
+            if old is None:
+                changes.append(PairChange('insert', *key, *value))
+            elif old[1:] != value:
+                changes.append(PairChange('update', *key, *value))
+
+        for key, (_, name, teachers, cabinets) in stored.items():
+            if key not in pairs and key[0] in self._reset_dates:
+                changes.append(PairChange('delete', *key, name, teachers, cabinets))
+
+        return changes
+
+    def _apply_pair_changes(self, generation):
+        pt = Pair.teachers.through_model
+        pc = Pair.cabinets.through_model
+
+        for change in self.changes:
+            where = (Pair.date == change.date) & (Pair.pair_number == change.pair_number) & \
+                    (Pair.group == change.group)
+
+            if change.action == 'delete':
+                self._remove(Pair, where)
+                continue
+
+            if change.action == 'update' and self._staging is None:
+                rowid = Pair.select(Pair.rowid) \
+                    .where(where & (Pair.source == self.source) & Pair.visible(generation)).scalar()
+                Pair.update(name=change.name).where(Pair.rowid == rowid).execute()
+                pt.delete().where(pt.pair == rowid).execute()
+                pc.delete().where(pc.pair == rowid).execute()
+            else:
+                if change.action == 'update':
+                    # The published row stays for readers, the staged generation gets a new one
+                    self._remove(Pair, where)
+
+                rowid = Pair.insert(date=change.date, pair_number=change.pair_number, group=change.group,
+                                    name=change.name, source=self.source, gen_from=generation).execute()
+
+            if change.teachers:
+                pt.insert_many(((rowid, i) for i in change.teachers), fields=[pt.pair, pt.teacher]).execute()
+            if change.cabinets:
+                pc.insert_many(((rowid, i) for i in change.cabinets), fields=[pc.pair, pc.cabinet]).execute()
+
     def remove_old_data(self):
-        CVPItem.delete().where(CVPItem.date < datetime.date.today()).execute()
-        Pair.delete().where(Pair.date < datetime.date.today()).execute()
+        self._remove(CVPItem, CVPItem.date < datetime.date.today())
+        self._remove(Pair, Pair.date < datetime.date.today())
+        self._bump_data_version()
+
+
+class BufferedDatabaseHandler(DatabaseHandler):
+    BUFFERED = True
+
+    __slots__ = ()
 
 
-class UniversalHandler(DatabaseHandler, SubpagesParsingHandler):
+class UniversalHandler(BufferedDatabaseHandler, SubpagesParsingHandler):
     __slots__ = ()
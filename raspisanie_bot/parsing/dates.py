@@ -0,0 +1,87 @@
+import datetime
+import functools
+import re
+
+MONTHS = {
+    'янв': 1, 'фев': 2, 'мар': 3, 'апр': 4, 'мая': 5, 'май': 5, 'июн': 6,
+    'июл': 7, 'авг': 8, 'сен': 9, 'окт': 10, 'ноя': 11, 'дек': 12,
+}
+
+_WEEKDAY = '(?:понедельник|вторник|среда|четверг|пятница|суббота|воскресенье)'
+_MONTH = '(январ[яь]|феврал[яь]|марта?|апрел[яь]|ма[яй]|июн[яь]|июл[яь]|августа?|сентябр[яь]|октябр[яь]|ноябр[яь]' \
+         '|декабр[яь])'
+_WEEK_PARITY = '(?:числитель|знаменатель)'
+
+# "понедельник 15 марта 2022 г.", "15 марта (понедельник) числитель", "15 марта"
+TEXT_DATE_RE = re.compile(
+    f'(?:{_WEEKDAY},? )?(\\d{{1,2}}) {_MONTH}(?: (\\d{{4}})(?: ?(?:г\\.?|года))?)?'
+    f'(?:,? (?:{_WEEKDAY}|\\({_WEEKDAY}\\)|- {_WEEKDAY}))?'
+    f'(?:,? (?:{_WEEK_PARITY}|\\({_WEEK_PARITY}\\)))?[.,]*'
+)
+# "15.03.2022"
+NUMERIC_DATE_RE = re.compile('(\\d{1,2})\\.(\\d{1,2})\\.(\\d{4})(?: ?г\\.?)?')
+
+_date_data_parser = None
+
+
+def parse_known_date(line, today):
+    """
+    Parses the date formats published by the college without dateparser.
+    A date without a year is the nearest one after today (like dateparser's PREFER_DATES_FROM='future').
+    :param line: Text to parse
+    :param today: Current date
+    :return: Parsed date or None if the line is not a known date format
+    """
+    line = ' '.join(line.lower().split())
+
+    match = TEXT_DATE_RE.fullmatch(line)
+    if match is not None:
+        day, month, year = int(match.group(1)), MONTHS[match.group(2)[:3]], match.group(3)
+    else:
+        match = NUMERIC_DATE_RE.fullmatch(line)
+        if match is None:
+            return None
+
+        day, month, year = int(match.group(1)), int(match.group(2)), match.group(3)
+
+    try:
+        if year is not None:
+            return datetime.date(int(year), month, day)
+
+        date = datetime.date(today.year, month, day)
+        if date <= today:
+            date = datetime.date(today.year + 1, month, day)
+        return date
+
+    except ValueError:
+        return None
+
+
+def parse_date_dateparser(line):
+    global _date_data_parser
+    if _date_data_parser is None:
+        import dateparser
+
+        _date_data_parser = dateparser.DateDataParser(languages=['ru'], region='RU', settings={
+            'PREFER_DAY_OF_MONTH': 'first',
+            'PREFER_DATES_FROM': 'future',
+            'PARSERS': ['absolute-time']
+        })
+
+    res = _date_data_parser.get_date_data(line).date_obj
+    if res is None:
+        return None
+
+    return res.date()
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_date(line, today):
+    date = parse_known_date(line, today)
+    if date is None:
+        date = parse_date_dateparser(line)
+    return date
+
+
+def parse_date(line):
+    return _parse_date(line, datetime.date.today())
@@ -0,0 +1,145 @@
+import collections
+import functools
+import itertools
+import re
+
+PrefixRule = collections.namedtuple('PrefixRule', ('prefix', 'replace', 'join'))
+PatternRule = collections.namedtuple('PatternRule', ('pattern', 'replace'))
+
+REGEX_SPECIAL = frozenset('\\.^$*+?{}[]|()')
+DEFAULT_FLAGS = re.compile('').flags
+
+# "МДК 01 02" -> "МДК.01.02"
+DEFAULT_RULES = (
+    PrefixRule('МДК', 'МДК', '.'),
+    PrefixRule('МИДК', 'МИДК', '.'),
+)
+
+
+def parse_rules(rules):
+    """
+    :param rules: [{"prefix": ..., "replace": ..., "join": ...} or {"pattern": ..., "replace": ...}]
+    """
+    parsed = []
+    for i in rules:
+        if "prefix" in i:
+            parsed.append(PrefixRule(i["prefix"], i.get("replace", i["prefix"]), i.get("join")))
+        elif "pattern" in i:
+            parsed.append(PatternRule(re.compile(i["pattern"]), i["replace"]))
+        else:
+            raise ValueError(f"Pair name rule {i!r} has neither prefix nor pattern")
+
+    return parsed
+
+
+def get_first_char(pattern):
+    """
+    :return: The character every match of the pattern starts with or None if it is not known
+    """
+    source = pattern.pattern
+    if not source or pattern.flags & re.IGNORECASE or '|' in source or source[0] in REGEX_SPECIAL or \
+            source[1:2] in ('*', '?', '{'):
+        return None
+
+    return source[0]
+
+
+def is_combinable(pattern):
+    """
+    Whether the pattern can be a part of an alternation with others: its groups, backreferences and global inline
+    flags would clash with theirs.
+    """
+    return pattern.groups == 0 and pattern.flags == DEFAULT_FLAGS
+
+
+class PairNameRules:
+    """
+    Rewrites pair names in three steps, each done once however many rules there are:
+    the longest matching prefix rule (a trie), the first pattern rule matching the whole name (alternation regexes
+    of the patterns that may start with its first character, patterns with groups or flags are matched alone)
+    and exact replacements. Everything is compiled when the rules are created.
+    Results are cached per name, as the same names repeat in every timetable.
+    """
+    __slots__ = ('_trie', '_patterns', '_steps', '_any_steps', '_replacements', 'get')
+
+    CACHE_SIZE = 4096
+
+    def __init__(self, rules=DEFAULT_RULES, replacements=None):
+        self._trie = {}
+        self._patterns = [i for i in rules if type(i) is PatternRule]
+        self._replacements = replacements or {}
+
+        # Later rules with the same prefix override earlier ones, e.g. the defaults
+        for rule in rules:
+            if type(rule) is PrefixRule:
+                node = self._trie
+                for char in rule.prefix:
+                    node = node.setdefault(char, {})
+                node[None] = rule
+
+        by_char = collections.defaultdict(list)  # first character -> pattern indexes
+        any_char = []
+        for i, rule in enumerate(self._patterns):
+            char = get_first_char(rule.pattern)
+            (any_char if char is None else by_char[char]).append(i)
+
+        # first character of the name -> [(regex, rule index or None if the regex is combined)]
+        self._steps = {char: self.build_steps(sorted((*any_char, *indexes))) for char, indexes in by_char.items()}
+        self._any_steps = self.build_steps(any_char)
+
+        self.get = functools.lru_cache(maxsize=self.CACHE_SIZE)(self.apply)
+
+    @classmethod
+    def from_config(cls, rules, replacements):
+        return cls((*DEFAULT_RULES, *parse_rules(rules)), replacements)
+
+    def __call__(self, name):
+        return self.get(name)
+
+    def build_steps(self, indexes):
+        """
+        Runs of combinable patterns become one regex each, keeping the order of the rules.
+        """
+        steps = []
+        for combinable, run in itertools.groupby(indexes, lambda i: is_combinable(self._patterns[i].pattern)):
+            run = list(run)
+            if not combinable:
+                steps.extend((self._patterns[i].pattern, i) for i in run)
+            elif len(run) == 1:
+                steps.append((self._patterns[run[0]].pattern, run[0]))
+            else:
+                # Rules are told apart by the group of the match, the patterns themselves have none
+                steps.append((re.compile('|'.join(f'(?P<r{i}>{self._patterns[i].pattern.pattern})' for i in run)),
+                              None))
+
+        return steps
+
+    def find_prefix(self, name):
+        node, found = self._trie, None
+        for char in name:
+            node = node.get(char)
+            if node is None:
+                break
+            found = node.get(None, found)
+
+        return found
+
+    def apply(self, name):
+        rule = self.find_prefix(name)
+        if rule is not None:
+            rest = name[len(rule.prefix):]
+            if rule.join is None:
+                name = rule.replace + rest
+            else:
+                name = rule.replace + rule.join + rule.join.join(rest.split())
+
+        for regex, index in self._steps.get(name[:1], self._any_steps):
+            match = regex.fullmatch(name)
+            if match is not None:
+                if index is None:
+                    index = int(match.lastgroup[1:])
+                    match = self._patterns[index].pattern.fullmatch(name)
+                name = match.expand(self._patterns[index].replace)
+                break
+
+        return self._replacements.get(name, name)
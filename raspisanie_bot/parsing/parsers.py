@@ -1,24 +1,73 @@
+import asyncio
+import codecs
 import collections
+import concurrent.futures
+import contextlib
 import hashlib
 import io
+import itertools
 import logging
+import mmap
 import re
+import string
+import tempfile
+import time
 
 import aiohttp
-import dateparser
+import charset_normalizer
 # noinspection PyPackageRequirements
 import pdfminer.converter
 # noinspection PyPackageRequirements
 import pdfminer.layout
 # noinspection PyPackageRequirements
+import pdfminer.pdfdevice
+# noinspection PyPackageRequirements
+import pdfminer.pdfdocument
+# noinspection PyPackageRequirements
+import pdfminer.pdffont
+# noinspection PyPackageRequirements
 import pdfminer.pdfinterp
 # noinspection PyPackageRequirements
 import pdfminer.pdfpage
+# noinspection PyPackageRequirements
+import pdfminer.pdfparser
+# noinspection PyPackageRequirements
+import pdfminer.pdftypes
 from lxml import html
 
-from ..config import feature_enabled
+from .dates import parse_date
+from .pair_names import PairNameRules
+from ..config import CVP_ENGINE, DEFAULT_SOURCE, MAX_DOWNLOAD_SIZE, feature_enabled, get_pair_name
 
 GroupName = collections.namedtuple('GroupName', ('course', 'group', 'subgroup'))
+EntitySnapshot = collections.namedtuple('EntitySnapshot', ('groups', 'teachers', 'cabinets', 'create_missing'))
+SourceInfo = collections.namedtuple('SourceInfo', ('etag', 'last_modified', 'content_hash'))
+Download = collections.namedtuple('Download', ('file', 'encoding', 'etag', 'last_modified', 'content_hash'))
+ParsedCell = collections.namedtuple('ParsedCell', ('name', 'teachers', 'cabinets', 'subgroup', 'is_substitution'))
+TableCell = collections.namedtuple('TableCell', ('element', 'row', 'column'))
+PendingResult = collections.namedtuple('PendingResult', ('name', 'duration', 'error'))
+CVPPageState = collections.namedtuple('CVPPageState', ('content_hash', 'dates'))
+
+# Parsed records, see Handler.handle_record
+Link = collections.namedtuple('Link', ('name', 'link'))
+NewDate = collections.namedtuple('NewDate', ('date', 'previous'))
+ParsedPair = collections.namedtuple('ParsedPair', ('date', 'group', 'pair_number', 'name', 'teachers', 'cabinets',
+                                                   'subgroup', 'is_substitution'))
+CVPDate = collections.namedtuple('CVPDate', ('date', ))
+CVPSlot = collections.namedtuple('CVPSlot', ('date', 'group', 'start', 'end'))
+PairTimeRow = collections.namedtuple('PairTimeRow', ('pair_number', 'start', 'end'))
+
+RECORD_HANDLERS = {
+    Link: 'handle_link',
+    NewDate: 'handle_new_date',
+    ParsedPair: 'handle_parsed_pair',
+    CVPDate: 'handle_new_cvp_date',
+    CVPSlot: 'handle_cvp_item',
+    PairTimeRow: 'handle_pair_time',
+}
+
+DEFAULT_PAIR_NAMES = PairNameRules()
+MAP_MIN_SIZE = 1024 * 1024  # Smaller files are read instead of being memory-mapped
 
 
 class ParserBase:
@@ -29,11 +78,7 @@ class ParserBase:
 
     NOT_WORD_RE = re.compile('\\W+')
 
-    DATE_DATA_PARSER = dateparser.DateDataParser(languages=['ru'], region='RU', settings={
-        'PREFER_DAY_OF_MONTH': 'first',
-        'PREFER_DATES_FROM': 'future',
-        'PARSERS': ['absolute-time']
-    })
+    source_name = DEFAULT_SOURCE  # Rows written by the handler are tagged with it
 
     def __init__(self, finder_class, handler_class):
         self.LOG = logging.getLogger(type(self).__name__)
@@ -64,30 +109,47 @@ class ParserBase:
         end = int(match.group(3)) * 60 + int(match.group(4))
         return start, end, match.group(5)
 
+    # noinspection PyMethodMayBeStatic
     def parse_date(self, line):
-        res = self.DATE_DATA_PARSER.get_date_data(line).date_obj
-        if res is None:
-            return None
-
-        return res.date()
+        return parse_date(line)
 
     # noinspection PyMethodMayBeStatic
-    def parse_html(self, text):
-        return html.fromstring(text)
+    def parse_html(self, content, encoding=None):
+        if isinstance(content, str):
+            return html.fromstring(content)
+
+        with open_content(content) as fp:
+            return html.parse(fp, html.HTMLParser(encoding=encoding)).getroot()
 
 
 class CallScheduleParser(ParserBase):
-    def parse_call_schedule(self, text):
-        self.parse_call_schedule_page(self.parse_html(text))
+    def parse_call_schedule(self, content, encoding=None):
+        self.parse_call_schedule_page(self.parse_html(content, encoding))
 
     def parse_call_schedule_page(self, page):
+        self.apply_call_schedule(self.iter_call_schedule_page(page))
+
+    def apply_call_schedule(self, records):
+        self.handler.handle_new_call_schedule()
+
+        for record in records:
+            self.handler.handle_record(record)
+
+        self.handler.handle_end_call_schedule()
+
+    def iter_call_schedule(self, content, encoding=None):
+        return self.iter_call_schedule_page(self.parse_html(content, encoding))
+
+    def iter_call_schedule_page(self, page):
+        # Not a generator: a page without the table fails before the old schedule is replaced
         table = page.find(".//div[@id = 'main']//table")
 
         if table[0].tag == 'tbody':
             table = table[0]
 
-        self.handler.handle_new_call_schedule()
+        return self.iter_pair_times(table)
 
+    def iter_pair_times(self, table):
         for tr in table:
             col1 = tr[0].text_content()
             if col1.isspace():
@@ -98,59 +160,105 @@ class CallScheduleParser(ParserBase):
             if start is None:
                 self.LOG.warning("Time re not matches: %r", tr[1].text_content())
             else:
-                self.handler.handle_pair_time(pn, start, end)
+                yield PairTimeRow(pn, start, end)
 
 
 class CVPParser(ParserBase):
     NORM_GROUPS_RE = re.compile('[^\\dа-яА-Я-]+')
 
-    def parse_cvp(self, content: bytes):
+    def parse_cvp(self, content):
+        self.apply_cvp(self.iter_cvp(content))
+
+    def apply_cvp(self, records):
+        for record in records:
+            self.handler.handle_record(record)
+
+        self.handler.handle_end_cvp()
+
+    def iter_cvp(self, content, engine=None, pagenos=None):
+        for _, records in self.iter_cvp_pages(content, engine, pagenos):
+            yield from records
+
+    @staticmethod
+    def get_pdf_pages(fp):
+        # Without object cache streams of processed pages (images too) are not kept until the end of the document
+        document = pdfminer.pdfdocument.PDFDocument(pdfminer.pdfparser.PDFParser(fp), caching=False)
+        return pdfminer.pdfpage.PDFPage.create_pages(document)
+
+    def get_cvp_page_hashes(self, content):
+        with open_content(content) as fp:
+            return [hashlib.sha256(b''.join(pdfminer.pdftypes.stream_value(i).get_data() for i in page.contents))
+                    .hexdigest() for page in self.get_pdf_pages(fp)]
+
+    def iter_cvp_pages(self, content, engine=None, pagenos=None):
         rsrcmgr = pdfminer.pdfinterp.PDFResourceManager()
-        device = LinesConverter(rsrcmgr, self)
-        interpreter = pdfminer.pdfinterp.PDFPageInterpreter(rsrcmgr, device)
+        layout = LinesConverter(rsrcmgr, self)
+        layout_interpreter = pdfminer.pdfinterp.PDFPageInterpreter(rsrcmgr, layout)
 
-        with io.BytesIO(content) as fp:
-            for page in pdfminer.pdfpage.PDFPage.get_pages(fp):
-                interpreter.process_page(page)
+        text = None
+        if (engine or CVP_ENGINE) == 'text':
+            text = TextLinesConverter(rsrcmgr)
+            text_interpreter = pdfminer.pdfinterp.PDFPageInterpreter(rsrcmgr, text)
 
-    def parse_groups_list(self, text):
-        for group in self.NORM_GROUPS_RE.sub(' ', text).split():
-            group = self.finder.find_group(group)
-            if group is not None:
-                yield group
+        with open_content(content) as fp:
+            for pageno, page in enumerate(self.get_pdf_pages(fp)):
+                if pagenos is not None and pageno not in pagenos:
+                    continue
 
+                if text is not None:
+                    text_interpreter.process_page(page)
+                    records = list(self.iter_cvp_page(text.get_lines()))
 
-class LinesConverter(pdfminer.converter.PDFLayoutAnalyzer):
-    def __init__(self, rsrcmgr, parser):
-        super().__init__(rsrcmgr, laparams=pdfminer.layout.LAParams())
-        self.parser = parser
-        self._text = []
+                    slots = [i for i in records if type(i) is CVPSlot]
+                    if slots and all(i.date is not None for i in slots):
+                        yield pageno, records
+                        continue
 
-    def receive_layout(self, ltpage):
+                    self.LOG.warning("Text lines of CVP page %d have no dated items, using layout analysis", pageno + 1)
+
+                layout_interpreter.process_page(page)
+                yield pageno, layout.records
+                layout.records = []
+
+    def iter_cvp_page(self, lines):
         last_time = None
         date = None
 
-        for child in ltpage:
-            if not isinstance(child, pdfminer.layout.LTText):
-                continue
-
-            line = child.get_text().strip()
+        for line in lines:
+            line = line.strip()
             if not line or line.isdigit():
                 continue
 
             if line.startswith("на "):
                 line = line[2:].strip()
-                date = self.parser.parse_date(line)
-                self.parser.handler.handle_new_cvp_date(date)
+                date = self.parse_date(line)
+                yield CVPDate(date)
                 continue
 
-            start, end, line = self.parser.parse_time_period(line)
+            start, end, line = self.parse_time_period(line)
             if start is not None:
                 last_time = (start, end)
 
             if line and last_time is not None:
-                for group in self.parser.parse_groups_list(line):
-                    self.parser.handler.handle_cvp_item(date, group, *last_time)
+                for group in self.parse_groups_list(line):
+                    yield CVPSlot(date, group, *last_time)
+
+    def parse_groups_list(self, text):
+        for group in self.NORM_GROUPS_RE.sub(' ', text).split():
+            group = self.finder.find_group(group)
+            if group is not None:
+                yield group
+
+
+class LinesConverter(pdfminer.converter.PDFLayoutAnalyzer):
+    def __init__(self, rsrcmgr, parser):
+        super().__init__(rsrcmgr, laparams=pdfminer.layout.LAParams())
+        self.parser = parser
+        self.records = []
+
+    def receive_layout(self, ltpage):
+        self.records.extend(self.parser.iter_cvp_page(child.get_text() for child in ltpage
+                                                      if isinstance(child, pdfminer.layout.LTText)))
 
     # Removed for optimization
 
@@ -167,11 +275,85 @@ class LinesConverter(pdfminer.converter.PDFLayoutAnalyzer):
         pass
 
 
+class TextLinesConverter(pdfminer.pdfdevice.PDFTextDevice):
+    # Same as pdfminer.layout.LAParams defaults
+    LINE_OVERLAP = 0.5
+    CHAR_MARGIN = 2.0
+    WORD_MARGIN = 0.1
+
+    def __init__(self, rsrcmgr):
+        super().__init__(rsrcmgr)
+        self.chars = []  # (baseline, x, width, size, text)
+
+    def render_char(self, matrix, font, fontsize, scaling, rise, cid, ncs, graphicstate):
+        try:
+            text = font.to_unichr(cid)
+        except pdfminer.pdffont.PDFUnicodeNotDefined:
+            text = ''
+
+        adv = font.char_width(cid) * fontsize * scaling
+        a, b, c, d, e, f = matrix
+        self.chars.append((d * rise + f, c * rise + e, a * adv, abs(d) * fontsize, text))
+        return adv
+
+    def get_lines(self):
+        rows = []
+        for char in sorted(self.chars, key=lambda i: -i[0]):
+            if rows and rows[-1][0] - char[0] <= self.LINE_OVERLAP * max(char[3], rows[-1][1]):
+                rows[-1][2].append(char)
+            else:
+                rows.append((char[0], char[3], [char]))
+
+        self.chars.clear()
+
+        # Text separated by wide gaps goes to separate lines like text boxes of layout analysis
+        for _, _, chars in rows:
+            chars.sort(key=lambda i: i[1])
+            line = []
+            end = width = None
+
+            for _, x, char_width, _, text in chars:
+                if end is not None:
+                    gap = x - end
+                    if gap > self.CHAR_MARGIN * max(width, char_width):
+                        yield ''.join(line)
+                        line = []
+                    elif gap > self.WORD_MARGIN * max(width, char_width) and line and not line[-1].isspace() \
+                            and not text.isspace():
+                        line.append(' ')
+
+                line.append(text)
+                end = x + char_width
+                width = char_width
+
+            yield ''.join(line)
+
+
 class TimetableParser(ParserBase):
-    def parse_timetable(self, text):
-        self.parse_timetable_page(self.parse_html(text))
+    CELL_CACHE_SIZE = 4096
+
+    def __init__(self, finder_class, handler_class):
+        super().__init__(finder_class, handler_class)
+        self._cells = collections.OrderedDict()  # normalized cell text -> ParsedCell
+
+    def parse_timetable(self, content, encoding=None):
+        self.parse_timetable_page(self.parse_html(content, encoding))
 
     def parse_timetable_page(self, page):
+        self.apply_timetable(self.iter_timetable_page(page))
+
+    def apply_timetable(self, records):
+        for record in records:
+            self.handler.handle_record(record)
+
+        self.handler.handle_end_timetable()
+
+    def iter_timetable(self, content, encoding=None):
+        return self.iter_timetable_page(self.parse_html(content, encoding))
+
+    def iter_timetable_page(self, page):
+        # Parsed cells hold finder results, which are only valid until the finder is reset
+        self._cells.clear()
         date = None
 
         for i in page.body[0]:
@@ -182,20 +364,20 @@ class TimetableParser(ParserBase):
 
                 text = self.normalize_text(i.text_content())
                 if link:
-                    self.handler.handle_link(text, link)
+                    yield Link(text, link)
                 elif text:
                     new_date = self.parse_date(text.lower().replace('знаменатель', '').replace('числитель', ''))
                     if new_date is not None:
                         if new_date != date:
-                            self.handler.handle_new_date(new_date, date)
+                            yield NewDate(new_date, date)
 
                         date = new_date
 
             elif i.tag == 'div':
-                self.parse_table(date, i[0])
+                yield from self.iter_table(date, i[0])
 
             elif i.tag == 'table':
-                self.parse_table(date, i)
+                yield from self.iter_table(date, i)
 
             elif i.tag == 'font':
                 continue
@@ -203,16 +385,64 @@ class TimetableParser(ParserBase):
             else:
                 self.LOG.warning("Unhandled element in timetable: %r (text=%r)", i.tag, i.text_content())
 
-    def parse_table(self, date, table):
+    def get_span(self, td, name):
+        try:
+            return max(int(td.attrib.get(name, 1)), 1)
+        except ValueError:
+            return 1
+
+    def build_table_grid(self, rows):
+        """
+        Expands rowspan and colspan into a dense grid, spanned positions refer to the same TableCell.
+        :param rows: Table rows (tr elements)
+        :return: List of grid rows, positions not covered by any cell are None
+        """
+        grid = [[] for _ in rows]
+
+        for ri, tr in enumerate(rows):
+            ci = 0
+            for td in tr:
+                if td.tag not in ('td', 'th'):
+                    continue
+
+                row = grid[ri]
+                while ci < len(row) and row[ci] is not None:
+                    ci += 1
+
+                colspan = self.get_span(td, 'colspan')
+                cell = TableCell(td, ri, ci)
+
+                for target in grid[ri:ri + self.get_span(td, 'rowspan')]:
+                    if len(target) < ci + colspan:
+                        target.extend([None] * (ci + colspan - len(target)))
+
+                    for c in range(ci, ci + colspan):
+                        if target[c] is None:
+                            target[c] = cell
+
+                ci += colspan
+
+        return grid
+
+    def iter_table(self, date, table):
         if table[0].tag == 'tbody':
             table = table[0]
 
-        groups = [self.finder.find_group(gn.text_content()) for gn in table[0][1:]]
-        skipped = {}  # pair_no -> [gi]
+        grid = self.build_table_grid(table)
+
+        headers = {}  # header cell -> group
+        columns = []  # column -> group
+        for cell in grid[0][1:]:
+            if cell is not None and cell not in headers:
+                headers[cell] = self.finder.find_group(cell.element.text_content())
+            columns.append(headers.get(cell))
 
         prev_pair = None
-        for tr in table[1:]:
-            pair = self.finder.find_pair_number(tr[0].text_content())
+        for ri, row in enumerate(grid[1:], 1):
+            pair = None
+            if row and row[0] is not None and row[0].row == ri:
+                pair = self.finder.find_pair_number(row[0].element.text_content())
+
             if pair is None:
                 if prev_pair is None:
                     continue
@@ -221,172 +451,437 @@ class TimetableParser(ParserBase):
 
             prev_pair = pair
 
-            skipped.setdefault(pair, [])
-
-            curr_spans = 0
-            next_common_pair = 0
-            prev_text = None
-            for gi, group in enumerate(groups):
-                if gi in skipped[pair]:
-                    curr_spans += 1
+            cells = {}  # cell starting in this row -> groups it covers
+            for cell, group in zip(row[1:], columns):
+                # Cells spanned from previous rows belong to the pair they start in
+                if cell is None or cell.row != ri or group is None:
                     continue
 
-                if next_common_pair:
-                    next_common_pair -= 1
-                    curr_spans += 1
-                    if group is not None and prev_text is not None:
-                        self.parse_pair(date, group, pair, prev_text)
+                cell_groups = cells.setdefault(cell, [])
+                if group not in cell_groups:
+                    cell_groups.append(group)
+
+            for cell, cell_groups in cells.items():
+                parsed = self.parse_cell(cell.element.text_content())
+                if parsed is None:
                     continue
 
-                if gi + 1 - curr_spans >= len(tr):
-                    break
-                td = tr[gi + 1 - curr_spans]
+                for group in cell_groups:
+                    yield ParsedPair(date, group, pair, *parsed)
 
-                if 'rowspan' in td.attrib:
-                    for i in range(int(td.attrib['rowspan']) - 1):
-                        skipped.setdefault(pair + i + 1, []).append(gi)
+    def parse_cell(self, text):
+        key = ' '.join(self.NOT_WORD_RE.sub(' ', text).split())
+        if not key:
+            return None
 
-                if 'colspan' in td.attrib:
-                    next_common_pair = int(td.attrib['colspan']) - 1
+        parsed = self._cells.get(key)
+        if parsed is not None:
+            self._cells.move_to_end(key)
+            return parsed
 
-                if group is not None:
-                    prev_text = td.text_content()
-                    self.parse_pair(date, group, pair, prev_text)
+        parsed = self._cells[key] = self.tokenize_cell(key.split())
+        if len(self._cells) > self.CELL_CACHE_SIZE:
+            self._cells.popitem(last=False)
 
-    def parse_pair(self, date, group, pair_number, text):
-        array = self.NOT_WORD_RE.sub(' ', text).strip().split()
-        if not array:
-            return
+        return parsed
 
+    def tokenize_cell(self, tokens):
         teachers = []
         cabinets = []
         subgroup = None
         is_substitution = False
 
-        l_array = [i.lower() for i in array]
-
-        if 'зам' in l_array:
-            index = l_array.index('зам')
-            del array[index]
-            del l_array[index]
-
-            is_substitution = True
-
-        if 'ауд' in l_array:
-            index = l_array.index('ауд')
-            del array[index]
-            del l_array[index]
-
-            while index < len(array):
-                cabinet = self.finder.find_cabinet(array[index])
-                if cabinet is None:
-                    break
-
-                cabinets.append(cabinet)
-                del array[index]
-                del l_array[index]
-
-        if 'гр' in l_array:
-            index = l_array.index('гр')
-            if index > 1 and l_array[index - 1] == 'п':
-                try:
-                    subgroup = int(array[index - 2])
-                except ValueError:
-                    pass
-                else:
-                    del array[index]
-                    del array[index - 1]
-                    del array[index - 2]
-
-            elif index > 0 and l_array[index - 1][-1] == 'п':
-                try:
-                    subgroup = int(array[index - 1][:-1])
-                except ValueError:
-                    pass
-                else:
-                    del array[index]
-                    del array[index - 1]
-
-        index = 2
-        while index < len(array):
-            if len(array[index]) == 1 and len(array[index - 1]) == 1 \
-                    and array[index].isalpha() and array[index - 1].isalpha():
-                teacher = self.finder.find_teacher(array[index - 2], array[index - 1], array[index])
-                if teacher is not None:
-                    teachers.append(teacher)
-                    del array[index]
-                    del array[index - 1]
-                    del array[index - 2]
+        seen_cabinets = in_cabinets = seen_subgroup = False
+        pending = []  # last two words, may still be taken by the subgroup marker
+        words = []
+        floor = 0  # teachers are searched in words[floor:]
+
+        for token in tokens:
+            lower = token.lower()
+
+            # Only the first marker of each kind is special
+            if lower == 'зам' and not is_substitution:
+                is_substitution = True
+                continue
+
+            if in_cabinets:
+                cabinet = self.finder.find_cabinet(token)
+                if cabinet is not None:
+                    cabinets.append(cabinet)
                     continue
-            index += 1
 
-        pair = self.finder.find_pair(' '.join(array))
-        self.handler.handle_parsed_pair(date, group, pair_number, pair, teachers, cabinets, subgroup, is_substitution)
+                in_cabinets = False
+
+            if lower == 'ауд' and not seen_cabinets:
+                seen_cabinets = in_cabinets = True
+                continue
+
+            if lower == 'гр' and not seen_subgroup:
+                seen_subgroup = True
+
+                # "1 п гр"
+                if len(pending) == 2 and pending[1].lower() == 'п':
+                    try:
+                        subgroup = int(pending[0])
+                    except ValueError:
+                        pass
+                    else:
+                        pending.clear()
+                        continue
+
+                # "1п гр"
+                elif pending and pending[-1].lower()[-1] == 'п':
+                    try:
+                        subgroup = int(pending[-1][:-1])
+                    except ValueError:
+                        pass
+                    else:
+                        pending.pop()
+                        continue
+
+            pending.append(token)
+            if len(pending) > 2:
+                words.append(pending.pop(0))
+                floor = self.match_teacher(words, floor, teachers)
+
+        for word in pending:
+            words.append(word)
+            floor = self.match_teacher(words, floor, teachers)
+
+        return ParsedCell(self.finder.find_pair(' '.join(words)), tuple(teachers), tuple(cabinets), subgroup,
+                          is_substitution)
+
+    def match_teacher(self, words, floor, teachers):
+        # "Фамилия И О" at the end of words
+        if len(words) - floor >= 3 and len(words[-1]) == 1 and len(words[-2]) == 1 \
+                and words[-1].isalpha() and words[-2].isalpha():
+            teacher = self.finder.find_teacher(words[-3], words[-2], words[-1])
+            if teacher is not None:
+                teachers.append(teacher)
+                del words[-3:]
+                return len(words)
+
+        return floor
 
 
 class AsyncParser(ParserBase):
-    def __init__(self, finder_class, handler_class):
-        super().__init__(finder_class, handler_class)
-        self._sess = aiohttp.ClientSession()
-        self._pending = set()
+    DOWNLOAD_SPOOL_SIZE = MAP_MIN_SIZE  # Larger downloads are written to a temporary file
+    DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
-    def then(self, coro):
-        self._pending.add(coro)
+    def __init__(self, finder_class, handler_class, concurrency=2, timeout=None, session=None):
+        super().__init__(finder_class, handler_class)
+        # A session shared by updaters of several sources is closed by its owner
+        self._own_session = session is None
+        self._sess = aiohttp.ClientSession() if session is None else session
+        self._pending = {}
+        self.pending_concurrency = concurrency
+        self.pending_timeout = timeout
+
+    def then(self, coro, name=None):
+        name = coro.__qualname__ if name is None else name
+
+        # The latest link wins, e.g. the timetable replaces a subpage queued by the update schedule
+        for queued in [i for i, n in self._pending.items() if n == name]:
+            del self._pending[queued]
+            queued.close()
+
+        self._pending[coro] = name
+
+    async def _run_pending(self, coro, name, semaphore):
+        async with semaphore:
+            start = time.monotonic()
+            error = None
+
+            try:
+                await asyncio.wait_for(coro, self.pending_timeout)
+            except asyncio.TimeoutError as e:
+                self.LOG.error("%s timed out", name)
+                error = e
+            except Exception as e:
+                self.LOG.exception("%s failed", name)
+                error = e
+
+            duration = time.monotonic() - start
+
+        self.LOG.info("%s finished in %.2f s", name, duration)
+        return PendingResult(name, duration, error)
 
     async def process_pending(self):
+        results = []
+        semaphore = asyncio.Semaphore(self.pending_concurrency)
+
         while self._pending:
-            coro = self._pending.pop()
-            await coro
+            pending, self._pending = self._pending, {}
+            results.extend(await asyncio.gather(*(self._run_pending(coro, name, semaphore)
+                                                  for coro, name in pending.items())))
+
+        return results
 
     async def close(self):
-        await self._sess.close()
+        if self._own_session:
+            await self._sess.close()
+
+    async def download_content(self, url, info=None):
+        headers = {}
+        if info is not None:
+            if info.etag:
+                headers['If-None-Match'] = info.etag
+            if info.last_modified:
+                headers['If-Modified-Since'] = info.last_modified
+
+        async with self._sess.get(url, headers=headers) as r:
+            if r.status == 304:
+                return None
+
+            r.raise_for_status()
+            if r.content_length is not None and r.content_length > MAX_DOWNLOAD_SIZE:
+                raise DownloadTooLargeError(f"{url} has {r.content_length} bytes, limit is {MAX_DOWNLOAD_SIZE}")
+
+            file = tempfile.SpooledTemporaryFile(self.DOWNLOAD_SPOOL_SIZE)
+            content_hash = hashlib.sha256()
+
+            try:
+                async for chunk in r.content.iter_chunked(self.DOWNLOAD_CHUNK_SIZE):
+                    if file.tell() + len(chunk) > MAX_DOWNLOAD_SIZE:
+                        raise DownloadTooLargeError(f"{url} has more than {MAX_DOWNLOAD_SIZE} bytes")
+
+                    content_hash.update(chunk)
+                    file.write(chunk)
+            except BaseException:
+                file.close()
+                raise
+
+        return Download(file, self.get_download_encoding(r, file), r.headers.get('ETag'),
+                        r.headers.get('Last-Modified'), content_hash.hexdigest())
+
+    def get_download_encoding(self, response, file):
+        if response.charset is not None:
+            with contextlib.suppress(LookupError):
+                return codecs.lookup(response.charset).name
+
+        if not response.content_type.startswith('text/'):
+            return None
 
-    async def download_content(self, url):
-        async with self._sess.get(url) as r:
-            content = await r.read()
-            encoding = r.get_encoding()
+        # Same fallback as aiohttp uses, but only the beginning of the document is examined
+        file.seek(0)
+        match = charset_normalizer.from_bytes(file.read(self.DOWNLOAD_CHUNK_SIZE)).best()
+        return 'utf-8' if match is None else codecs.lookup(match.encoding).name
 
-        return content, encoding
 
-    async def download_bytes(self, url):
-        async with self._sess.get(url) as r:
-            return await r.read()
+class TimetableUpdater(AsyncParser, TimetableParser, CallScheduleParser, CVPParser):
+    # parse method -> (record generator, method applying records to the handler)
+    PARSE_METHODS = {
+        'parse_timetable': ('iter_timetable', 'apply_timetable'),
+        'parse_cvp': ('iter_cvp', 'apply_cvp'),
+        'parse_call_schedule': ('iter_call_schedule', 'apply_call_schedule'),
+    }
+
+    def __init__(self, finder_class, handler_class, workers=0, concurrency=2, timeout=None, archive=None,
+                 session=None, executor=None, source_name=DEFAULT_SOURCE, cvp_engine=None, db_executor=None):
+        super().__init__(finder_class, handler_class, concurrency, timeout, session)
+        self.forced = False
+        self.db_executor = db_executor
+        self._loop = None
+        self.workers = workers
+        self.archive = archive
+        self.source_name = source_name
+        self.cvp_engine = cvp_engine
+        if source_name != DEFAULT_SOURCE:
+            self.LOG = logging.getLogger(f"{type(self).__name__}.{source_name}")
+        self._own_executor = executor is None
+        if executor is None and workers > 0:
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+        self._executor = executor
 
-    async def download_text(self, url):
-        async with self._sess.get(url) as r:
-            return await r.text()
+    async def close(self):
+        await super().close()
+        if self._executor is not None and self._own_executor:
+            self._executor.shutdown(wait=False)
 
+    async def call_db(self, func, *args):
+        """
+        Runs a function writing through the handler or the finder, on the writer thread of the database executor.
+        """
+        if self.db_executor is None:
+            return func(*args)
 
-class TimetableUpdater(AsyncParser, TimetableParser, CallScheduleParser, CVPParser):
-    def __init__(self, finder_class, handler_class):
-        super().__init__(finder_class, handler_class)
-        self._last_tt_md5 = None
+        self._loop = asyncio.get_running_loop()
+        return await self.db_executor.write(func, *args)
+
+    def then(self, coro, name=None):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Called by the handler on the writer thread of the database executor, the queue belongs to the event loop.
+            # It is queued before call_db returns, so process_pending sees it
+            self._loop.call_soon_threadsafe(super().then, coro, name)
+            return
+
+        super().then(coro, name)
+
+    def reset_snapshot(self):
+        self.finder.reset()
+        return self.finder.snapshot()
+
+    async def run_parser(self, method, content, *args):
+        # Documents are parsed against a snapshot of the entities outside the database writer thread, which only
+        # applies the records, so writes of users do not wait for the parsing
+        iter_method, apply_method = self.PARSE_METHODS[method]
+        snapshot = await self.call_db(self.reset_snapshot)
+
+        if self._executor is None:
+            records = await asyncio.to_thread(parse_in_worker, iter_method, content, snapshot, *args)
+        else:
+            records = await asyncio.get_running_loop().run_in_executor(self._executor, parse_in_worker, iter_method,
+                                                                       read_content(content), snapshot, *args)
+
+        await self.call_db(getattr(self, apply_method), map(self.resolve_record, records))
+
+    async def parse_cvp_pages(self, content, pagenos):
+        snapshot = await self.call_db(self.finder.snapshot)
+        if self._executor is None:
+            return dict(await asyncio.to_thread(parse_in_worker, 'iter_cvp_pages', content, snapshot,
+                                                self.cvp_engine, pagenos))
+
+        content = read_content(content)
+        pagenos = sorted(pagenos)
+        loop = asyncio.get_running_loop()
+
+        results = await asyncio.gather(*(
+            loop.run_in_executor(self._executor, parse_in_worker, 'iter_cvp_pages', content, snapshot, self.cvp_engine,
+                                 set(pagenos[i::self.workers]))
+            for i in range(min(self.workers, len(pagenos)))
+        ))
+        return dict(itertools.chain.from_iterable(results))
+
+    def resolve_record(self, record):
+        if type(record) is ParsedPair:
+            return record._replace(group=self.finder.resolve_group(record.group),
+                                   teachers=tuple(self.finder.resolve_teacher(i) for i in record.teachers),
+                                   cabinets=tuple(self.finder.resolve_cabinet(i) for i in record.cabinets))
+
+        if type(record) is CVPSlot:
+            return record._replace(group=self.finder.resolve_group(record.group))
+
+        return record
+
+    async def download_if_changed(self, url, kind, force=False):
+        info = None if force else await self.call_db(self.handler.get_source_info, url)
+        download = await self.download_content(url, info)
+        if download is None:
+            self.LOG.info("%s not modified", url)
+            return None, None
+
+        new_info = SourceInfo(download.etag, download.last_modified, download.content_hash)
+        if info is not None and info.content_hash == new_info.content_hash:
+            download.file.close()
+            self.LOG.info("%s not changed", url)
+            await self.call_db(self.handler.handle_source_info, url, new_info)
+            return None, None
+
+        if self.archive is not None:
+            await self.archive.store(url, kind, download, self.call_db)
+
+        return download, new_info
+
+    async def update(self, link=None, force=False):
+        # The timetable and its subpages, the handler may publish them together.
+        # Without a link only the queued subpages are updated.
+        await self.call_db(self.handler.handle_new_update)
+
+        try:
+            results = []
+            if link is not None:
+                results.append(await self._run_pending(self.update_timetable(link, force), "Timetable",
+                                                       asyncio.Semaphore()))
+            results.extend(await self.process_pending())
+        except BaseException:
+            await self.call_db(self.handler.handle_end_update, False)
+            raise
+
+        rejected = await self.call_db(self.handler.handle_end_update, all(i.error is None for i in results))
+        if rejected is not None:
+            # Documents of an update that is not published are downloaded again, so they are failed too
+            error = GenerationRejectedError(rejected)
+            results = [i if i.error is not None else i._replace(error=error) for i in results]
+
+        return results
 
     async def update_timetable(self, link, force=False):
         self.LOG.info("Updating timetable started")
-        content, encoding = await self.download_content(link)
-
-        md5 = hashlib.md5(content).digest()
-        if self._last_tt_md5 == md5 and not force:
+        self.forced = force
+        download, info = await self.download_if_changed(link, 'timetable', force)
+        if download is None:
             self.LOG.info("Timetable not updated due to cache")
             return
 
-        if feature_enabled("remove_old_data"):
-            self.handler.remove_old_data()
+        with download.file:
+            if feature_enabled("remove_old_data"):
+                await self.call_db(self.handler.remove_old_data)
+
+            await self.run_parser('parse_timetable', download.file, download.encoding)
 
-        self.parse_timetable(content.decode(encoding))
-        self._last_tt_md5 = md5
+        await self.call_db(self.handler.handle_source_info, link, info)
 
         self.LOG.info("Timetable updated successfully")
 
-    async def update_cvp(self, link):
+    async def update_cvp(self, link, force=False):
         self.LOG.info("Updating CVP started")
-        self.parse_cvp(await self.download_bytes(link))
+        download, info = await self.download_if_changed(link, 'cvp', force)
+        if download is None:
+            self.LOG.info("CVP not updated due to cache")
+            return
+
+        with download.file, map_content(download.file) as content:
+            await self.update_cvp_pages(link, content, force)
+
+        await self.call_db(self.handler.handle_source_info, link, info)
         self.LOG.info("CVP updated successfully")
 
-    async def update_call_schedule(self, link):
+    async def update_cvp_pages(self, link, content, force=False):
+        await self.call_db(self.finder.reset)
+        # Reading every page of the PDF would stall the event loop
+        hashes = await asyncio.to_thread(self.get_cvp_page_hashes, content)
+        known = {} if force else await self.call_db(self.handler.get_cvp_pages, link)
+
+        pages = {}  # pageno -> records
+        pagenos = {i for i, content_hash in enumerate(hashes)
+                   if i not in known or known[i].content_hash != content_hash}
+
+        while pagenos:
+            pages.update(await self.parse_cvp_pages(content, pagenos))
+
+            # Items of a date are replaced together, so unchanged pages with the same dates are parsed again
+            dates = {i.date for records in pages.values() for i in records if type(i) is CVPDate}
+            pagenos = {i for i, state in known.items()
+                       if i < len(hashes) and i not in pages and dates.intersection(state.dates)}
+
+        self.LOG.info("Parsed %d of %d CVP pages", len(pages), len(hashes))
+
+        records = (record for i in sorted(pages) for record in pages[i])
+        await self.call_db(self.apply_cvp, map(self.resolve_record, records))
+
+        states = []
+        for i, content_hash in enumerate(hashes):
+            if i in pages:
+                dates = {record.date for record in pages[i] if type(record) is CVPDate and record.date is not None}
+                states.append(CVPPageState(content_hash, tuple(sorted(dates))))
+            else:
+                states.append(known[i])
+
+        await self.call_db(self.handler.handle_cvp_pages, link, states)
+
+    async def update_call_schedule(self, link, force=False):
         self.LOG.info("Updating call schedule started")
-        self.parse_call_schedule(await self.download_text(link))
+        download, info = await self.download_if_changed(link, 'call_schedule', force)
+        if download is None:
+            self.LOG.info("Call schedule not updated due to cache")
+            return
+
+        with download.file:
+            await self.run_parser('parse_call_schedule', download.file, download.encoding)
+
+        await self.call_db(self.handler.handle_source_info, link, info)
         self.LOG.info("Call schedule updated successfully")
 
 
@@ -396,6 +891,24 @@ class Finder:
     def __init__(self, parser):
         self.parser = parser
 
+    def reset(self):
+        pass
+
+    def snapshot(self):
+        return None
+
+    def persist_missing(self):
+        pass
+
+    def resolve_group(self, key):
+        return key
+
+    def resolve_teacher(self, key):
+        return key
+
+    def resolve_cabinet(self, key):
+        return key
+
     def find_group(self, text):
         return self.parser.parse_group_name(text)
 
@@ -412,13 +925,62 @@ class Finder:
         return surname, name, patronymic
 
     def find_pair(self, text):
-        if text.startswith('МДК'):
-            return 'МДК.' + '.'.join(text[3:].strip().split())
+        return DEFAULT_PAIR_NAMES(text)
+
+
+class SnapshotFinder(Finder):
+    # SQLite LIKE (used by peewee's startswith) folds case of ASCII letters only
+    ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+    __slots__ = ('_create_missing', '_groups', '_cabinets', '_teachers', '_teachers_by_surname')
+
+    def __init__(self, parser):
+        super().__init__(parser)
+        self.load(EntitySnapshot((), (), (), True))
+
+    def load(self, snapshot):
+        self._create_missing = snapshot.create_missing
+        self._groups = set(snapshot.groups)
+        self._cabinets = set(snapshot.cabinets)
+        self._teachers = {i: i for i in snapshot.teachers}  # also caches prefix matches
+        self._teachers_by_surname = collections.defaultdict(list)
+
+        for i in snapshot.teachers:
+            self._teachers_by_surname[i[0]].append(i)
+
+    def _find_teacher_by_prefix(self, surname, name, patronymic):
+        name = name.translate(self.ASCII_LOWER)
+        patronymic = patronymic.translate(self.ASCII_LOWER)
+
+        for i in self._teachers_by_surname.get(surname, ()):
+            if i[1].translate(self.ASCII_LOWER).startswith(name) \
+                    and i[2].translate(self.ASCII_LOWER).startswith(patronymic):
+                return i
 
-        if text.startswith('МИДК'):
-            return 'МИДК.' + '.'.join(text[4:].strip().split())
+    def find_cabinet(self, text):
+        number = super().find_cabinet(text)
+        if number is not None and (number in self._cabinets or self._create_missing):
+            return number
+
+    def find_teacher(self, surname, name, patronymic):
+        surname, name, patronymic = super().find_teacher(surname, name, patronymic)
+        key = (surname.capitalize(), name.capitalize(), patronymic.capitalize())
+
+        if self._create_missing:
+            return key
+
+        if key not in self._teachers:
+            self._teachers[key] = self._find_teacher_by_prefix(*key)
+        return self._teachers[key]
+
+    def find_group(self, text):
+        group = super().find_group(text)
+        if group is not None and (group in self._groups or self._create_missing):
+            return group
 
-        return text
+    def find_pair(self, text):
+        # Configured rules include the default ones
+        return get_pair_name(text)
 
 
 class Handler:
@@ -427,6 +989,19 @@ class Handler:
     def __init__(self, parser):
         self.parser = parser
 
+    def get_source_info(self, url):
+        return None
+
+    def handle_source_info(self, url, info):
+        pass
+
+    def get_source_links(self):
+        # kind -> url of subpages linked from the timetable
+        return {}
+
+    def handle_record(self, record):
+        getattr(self, RECORD_HANDLERS[type(record)])(*record)
+
     def handle_link(self, name, link):
         name = name.lower()
         if name == "график питания студентов в столовой":
@@ -440,12 +1015,21 @@ class Handler:
     def handle_cvp(self, link):
         pass
 
+    def get_cvp_pages(self, url):
+        return {}
+
+    def handle_cvp_pages(self, url, pages):
+        pass
+
     def handle_new_cvp_date(self, date):
         pass
 
     def handle_cvp_item(self, date, group, start: int, end: int):
         pass
 
+    def handle_end_cvp(self):
+        pass
+
     # ==== CS ====
 
     def handle_call_schedule(self, link):
@@ -457,6 +1041,9 @@ class Handler:
     def handle_pair_time(self, pair, start: int, end: int):
         pass
 
+    def handle_end_call_schedule(self):
+        pass
+
     # ==== TT ====
 
     def handle_new_date(self, new_date, old_date):
@@ -467,19 +1054,93 @@ class Handler:
                            is_substitution: bool):
         pass
 
+    def handle_end_timetable(self):
+        pass
+
     def remove_old_data(self):
         pass
 
+    # ==== Update of all documents ====
+
+    def handle_new_update(self):
+        pass
+
+    def handle_end_update(self, succeeded: bool):
+        # Returns why the update is not published, None if it is
+        return None
+
 
 class SubpagesParsingHandler(Handler):
     __slots__ = ()
 
     def handle_cvp(self, link):
         if feature_enabled("cvp_parse"):
-            self.parser.then(self.parser.update_cvp(link))
+            self.parser.then(self.parser.update_cvp(link, self.parser.forced), "CVP")
 
     def handle_call_schedule(self, link):
-        self.parser.then(self.parser.update_call_schedule(link))
+        self.parser.then(self.parser.update_call_schedule(link, self.parser.forced), "Call schedule")
+
+
+class DocumentParser(TimetableParser, CallScheduleParser, CVPParser):
+    pass
+
+
+class DownloadTooLargeError(Exception):
+    pass
+
+
+class GenerationRejectedError(Exception):
+    pass
+
+
+def open_content(content):
+    # Parsers take bytes or a seekable binary file (a spooled download or its memory map)
+    if isinstance(content, (bytes, bytearray)):
+        return io.BytesIO(content)
+
+    content.seek(0)
+    return contextlib.nullcontext(content)
+
+
+@contextlib.contextmanager
+def map_content(content):
+    # A downloaded file is memory-mapped instead of being read into memory. A spooled one up to MAP_MIN_SIZE is still
+    # in memory and is read, since fileno() would write it to disk. An empty file can not be mapped
+    if isinstance(content, (bytes, bytearray)):
+        yield content
+        return
+
+    if content.seek(0, io.SEEK_END) <= MAP_MIN_SIZE:
+        yield read_content(content)
+        return
+
+    try:
+        fileno = content.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        yield content
+        return
+
+    content.flush()
+    with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as view:
+        yield view
+
+
+def read_content(content):
+    if isinstance(content, (str, bytes, bytearray)):
+        return content
+
+    content.seek(0)
+    return content.read()
+
+
+def parse_in_worker(method, content, snapshot, *args):
+    if snapshot is None:
+        parser = DocumentParser(Finder, Handler)
+    else:
+        parser = DocumentParser(SnapshotFinder, Handler)
+        parser.finder.load(snapshot)
+
+    return list(getattr(parser, method)(content, *args))
 
 
 def parse_group_name(text: str):
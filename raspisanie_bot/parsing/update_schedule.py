@@ -0,0 +1,97 @@
+import collections
+import datetime
+import logging
+import random
+
+UpdateProfile = collections.namedtuple('UpdateProfile', ('name', 'start', 'end', 'scale'))
+UpdateDecision = collections.namedtuple('UpdateDecision', ('time', 'kind', 'delay', 'reason'))
+
+SOURCE_KINDS = ("timetable", "cvp", "call_schedule")
+
+
+def parse_profiles(profiles):
+    """
+    :param profiles: [{"name": ..., "from": "HH:MM", "to": "HH:MM", "scale": ...}], a range may wrap midnight
+    """
+    return [UpdateProfile(i.get("name", f"{i['from']}-{i['to']}"), datetime.time.fromisoformat(i["from"]),
+                          datetime.time.fromisoformat(i["to"]), i["scale"]) for i in profiles]
+
+
+class UpdateSchedule:
+    """
+    Time of the next update of every document kind.
+    Intervals are scaled by the time-of-day profile, failures are retried with exponential backoff and jitter.
+    """
+    __slots__ = ('LOG', 'intervals', 'profiles', 'retry_delay', 'retry_max_delay', 'now', 'due', 'failures',
+                 'decisions')
+
+    DECISIONS_KEPT = 50
+
+    def __init__(self, intervals, profiles=(), retry_delay=30, retry_max_delay=3600, now=datetime.datetime.now,
+                 name=None):
+        self.LOG = logging.getLogger(type(self).__name__ if name is None else f"{type(self).__name__}.{name}")
+        self.intervals = intervals
+        self.profiles = profiles
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.now = now
+        self.due = dict.fromkeys(intervals)  # kind -> datetime, None is due now
+        self.failures = collections.Counter()
+        self.decisions = collections.deque(maxlen=self.DECISIONS_KEPT)
+
+    def get_profile(self, time):
+        for profile in self.profiles:
+            if profile.start <= profile.end:
+                if profile.start <= time < profile.end:
+                    return profile
+            elif time >= profile.start or time < profile.end:
+                return profile
+
+        return None
+
+    def get_interval(self, kind, now):
+        profile = self.get_profile(now.time())
+        if profile is None:
+            return self.intervals[kind], f"interval {self.intervals[kind]} s"
+
+        return self.intervals[kind] * profile.scale, \
+            f"interval {self.intervals[kind]} s × {profile.scale} in {profile.name}"
+
+    def get_retry_delay(self, kind):
+        # Equal jitter: at least half of the backoff, so retries of a long outage stay spread out
+        limit = min(self.retry_max_delay, self.retry_delay * 2 ** (self.failures[kind] - 1))
+        return limit / 2 + random.uniform(0, limit / 2), f"failure {self.failures[kind]}, backoff {limit:.0f} s"
+
+    def schedule(self, kind, succeeded, reason=None):
+        now = self.now()
+
+        if succeeded:
+            self.failures[kind] = 0
+            delay, why = self.get_interval(kind, now)
+
+            # A profile starting earlier with a shorter interval is not waited out
+            for profile in self.profiles:
+                start = datetime.datetime.combine(now.date(), profile.start)
+                if start <= now:
+                    start += datetime.timedelta(days=1)
+
+                if (start - now).total_seconds() < delay and self.intervals[kind] * profile.scale < delay:
+                    delay, why = (start - now).total_seconds(), f"{profile.name} starts at {profile.start:%H:%M}"
+        else:
+            self.failures[kind] += 1
+            delay, why = self.get_retry_delay(kind)
+
+        if reason is not None:
+            why = f"{reason}, {why}"
+
+        self.due[kind] = now + datetime.timedelta(seconds=delay)
+        self.decisions.append(UpdateDecision(now, kind, delay, why))
+        self.LOG.info("Next %s update in %.0f s: %s", kind, delay, why)
+
+    def get_due(self):
+        now = self.now()
+        return [kind for kind, due in self.due.items() if due is None or due <= now]
+
+    def next_delay(self, now, first):
+        # Trigger of the scheduler job, now is given by the scheduler clock
+        return max(0.0, min((due - now).total_seconds() if due is not None else 0.0 for due in self.due.values()))
@@ -1,75 +1,148 @@
-import asyncio
+import concurrent.futures
+import datetime
 import logging
 
-from async_utils import CancelableTimer
+import aiohttp
+
+from async_utils import Once
+from .archive import SourceArchive
 from .database import DatabaseFinder, UniversalHandler
-from .parsers import TimetableUpdater
+from .parsers import GenerationRejectedError, PendingResult, TimetableUpdater
+from .update_schedule import SOURCE_KINDS, UpdateSchedule, parse_profiles
 from .. import config
-
-
-class UpdateService:
-    def __init__(self):
-        self.LOG = logging.getLogger(type(self).__name__)
-        self.updater = None
-        self._do_force_update = False
-        self._task = None
-        self._stopping = False
-        self.timer = CancelableTimer()
-
-    async def run(self):
-        self.updater = TimetableUpdater(DatabaseFinder, UniversalHandler)
-        self.LOG.info("Starting first update...")
-        force = True
-
-        while not self._stopping:
-            try:
-                await self.updater.update_timetable(config.TIMETABLE_URL, force=force)
-                await self.updater.process_pending()
-            except asyncio.CancelledError:
-                break
-
-            except Exception:
-                self.LOG.exception("Update failed")
-                delay = 30
-
-            else:
-                delay = config.UPDATE_INTERVAL
-
-            if self._do_force_update:
-                self._do_force_update = False
-                self.LOG.info("Re-running force update")
-                force = True
+from ..db_executor import DB_EXECUTOR
+from ..render_cache import RENDER_CACHE
+
+
+# Names of the updater's tasks
+TASK_KINDS = {"Timetable": "timetable", "CVP": "cvp", "Call schedule": "call_schedule"}
+
+
+class SourceUpdate:
+    """
+    Update pipeline of one timetable source in SOURCES: its updater, schedule and scheduler job.
+    """
+    __slots__ = ('LOG', 'name', 'url', 'updater', 'schedule')
+
+    def __init__(self, source, updater, now=datetime.datetime.now):
+        self.name = source["name"]
+        self.url = source["url"]
+        self.LOG = logging.getLogger(f"{type(self).__name__}.{self.name}")
+        self.updater = updater
+        self.schedule = UpdateSchedule({**config.UPDATE_INTERVALS, **source.get("intervals", {})},
+                                       parse_profiles(source.get("profiles", config.UPDATE_PROFILES)),
+                                       config.UPDATE_RETRY_DELAY, config.UPDATE_RETRY_MAX, now, self.name)
+
+    @property
+    def job_name(self):
+        return f"{UpdateService.JOB_PREFIX}{self.name}"
+
+    async def update_due(self, force=False):
+        kinds = list(SOURCE_KINDS) if force else self.schedule.get_due()
+        if not kinds:
+            return
+
+        self.LOG.info("Starting %s update of %s", "force" if force else "scheduled", ", ".join(kinds))
+        await self.update(kinds, force)
+
+    async def update(self, kinds, force=False):
+        reasons = {}
+
+        # A failure of any step is a failure of every requested kind, so the schedule backs off
+        try:
+            links = await self.updater.call_db(self.updater.handler.get_source_links)
+
+            for kind in kinds:
+                if kind == "timetable":
+                    continue
+
+                if kind not in links:
+                    reasons[kind] = "not linked yet"
+                elif kind == "cvp" and not config.feature_enabled("cvp_parse"):
+                    reasons[kind] = "cvp_parse disabled"
+                elif kind == "cvp":
+                    self.updater.then(self.updater.update_cvp(links[kind], force), "CVP")
+                else:
+                    self.updater.then(self.updater.update_call_schedule(links[kind], force), "Call schedule")
+
+            results = await self.updater.update(self.url if "timetable" in kinds else None, force)
+        except Exception as e:
+            self.LOG.exception("Update failed")
+            results = [PendingResult(name, 0, e) for name, kind in TASK_KINDS.items() if kind in kinds]
+
+        failed = [i.name for i in results if i.error is not None]
+        if failed:
+            self.LOG.warning("Failed to update: %s", ", ".join(failed))
+
+        for result in results:
+            kind = TASK_KINDS.get(result.name)
+            if kind is None:
                 continue
 
-            if self._stopping:
-                break
+            # Not due or not known before, but queued by the changed timetable
+            reason = None
+            if reasons.pop(kind, None) is not None or kind not in kinds:
+                reason = "linked from the timetable"
+            if isinstance(result.error, GenerationRejectedError):
+                reason = str(result.error) if reason is None else f"{reason}, {result.error}"
+            self.schedule.schedule(kind, result.error is None, reason)
 
-            self.LOG.info("Sleeping for %s seconds", delay)
-            await self.timer.sleep(delay)
+        # Skipped, checked again after the usual interval
+        for kind, reason in reasons.items():
+            self.schedule.schedule(kind, True, reason)
 
-            if self._stopping:
-                break
 
-            force = self._do_force_update
-            self._do_force_update = False
-            if force:
-                self.LOG.info("Starting force update")
-            else:
-                self.LOG.info("Starting by timer")
-
-        self.LOG.info("Stopping update service")
-        await self.updater.close()
-
-    def force_update(self):
-        self._do_force_update = True
-        self.timer.cancel()
-
-    def stop(self, cancel_current=True):
-        self._stopping = True
-        self.timer.cancel()
-        if cancel_current and self._task is not None:
-            self._task.cancel()
+class UpdateService:
+    """
+    Updates all timetable sources concurrently, as separate scheduler jobs sharing one connection pool and one set
+    of parser processes.
+    """
+    JOB_PREFIX = "update:"  # Forced by run_now(job_name, force=True)
+    WARM_UP_JOB = "render_warm_up"
+
+    def __init__(self, scheduler):
+        self.LOG = logging.getLogger(type(self).__name__)
+        self.scheduler = scheduler
+        self.sources = {}  # name -> SourceUpdate
+        self._session = None
+        self._executor = None
 
     def start(self):
-        self._task = asyncio.get_event_loop().create_task(self.run(), name=type(self).__name__)
-        return self._task
+        # Invalid pair name rules stop the bot here instead of failing every update
+        config.get_pair_name_rules()
+
+        archive = None
+        if config.feature_enabled("archive_sources"):
+            archive = SourceArchive(config.ARCHIVE_DIR, config.ARCHIVE_KEEP_DAYS)
+
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=config.HTTP_CONNECTIONS))
+        if config.PARSE_WORKERS > 0:
+            self._executor = concurrent.futures.ProcessPoolExecutor(config.PARSE_WORKERS)
+
+        for source in config.SOURCES:
+            updater = TimetableUpdater(DatabaseFinder, UniversalHandler, config.PARSE_WORKERS,
+                                       config.PENDING_CONCURRENCY, config.PENDING_TIMEOUT, archive, self._session,
+                                       self._executor, source["name"], source.get("cvp_engine"), DB_EXECUTOR)
+            pipeline = self.sources[source["name"]] = SourceUpdate(source, updater, self.scheduler.clock)
+            # The schedule is the job's trigger, so it runs when the earliest document of the source is due
+            self.scheduler.add(pipeline.job_name, self.update_source, pipeline.schedule, pipeline)
+
+        self.LOG.info("Updating %d sources: %s", len(self.sources), ", ".join(self.sources))
+
+    async def update_source(self, pipeline, force=False):
+        await pipeline.update_due(force)
+
+        if config.feature_enabled("render_warm_up"):
+            # Replaces a pending warm-up, so sources updated together are rendered once
+            self.scheduler.add(self.WARM_UP_JOB, RENDER_CACHE.warm_up, Once())
+
+    async def close(self):
+        self.scheduler.cancel(self.WARM_UP_JOB)
+        for pipeline in self.sources.values():
+            self.scheduler.cancel(pipeline.job_name)
+            await pipeline.updater.close()
+
+        if self._session is not None:
+            await self._session.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
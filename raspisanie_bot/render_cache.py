@@ -0,0 +1,125 @@
+import asyncio
+import collections
+import logging
+
+from .config import RENDER_CACHE_SIZE
+from .database import DATA_VERSION
+from .db_executor import DB_EXECUTOR
+from .schedule import PAIR_TIMES, is_current, local_now
+
+
+class RenderCache:
+    """
+    LRU cache of built schedule messages by (kind, key), valid while DATA_VERSION is unchanged.
+    The current pair is highlighted when a message is rendered for sending, so it is not a part of the cache key. It is
+    looked up in the minute table of the pair times, the same one /time uses.
+    Messages are built on reader threads of the database executor, the cache itself is used from the event loop only.
+    """
+    __slots__ = ('LOG', 'size', 'clock', 'executor', 'pair_times', 'hits', 'misses', 'evictions', '_entries',
+                 '_renderers')
+
+    def __init__(self, size=RENDER_CACHE_SIZE, clock=local_now, executor=DB_EXECUTOR, pair_times=PAIR_TIMES):
+        self.LOG = logging.getLogger(type(self).__name__)
+        self.size = size
+        self.clock = clock
+        self.executor = executor
+        self.pair_times = pair_times
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()  # (kind, key) -> (data version, MessageBuilder)
+        self._renderers = {}  # kind -> (build, keys)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def register(self, kind, build, keys=None):
+        """
+        :param build: Function of the key returning a MessageBuilder with the current pair numbers as variants
+        :param keys: Function returning all keys of the kind to warm up, None to skip the kind
+        """
+        self._renderers[kind] = (build, keys)
+
+    def _lookup(self, kind, key):
+        entry = self._entries.get((kind, key))
+        if entry is None or entry[0] != DATA_VERSION.value:
+            return None
+
+        self._entries.move_to_end((kind, key))
+        return entry[1]
+
+    def get(self, kind, key):
+        """
+        Cached message or the one built in place.
+        """
+        message = self._lookup(kind, key)
+        if message is not None:
+            self.hits += 1
+            return message
+
+        self.misses += 1
+        version = DATA_VERSION.value
+        return self._store(kind, key, version, self._renderers[kind][0](key))
+
+    async def fetch(self, kind, key):
+        """
+        Cached message or the one built on a reader thread.
+        """
+        message = self._lookup(kind, key)
+        if message is not None:
+            self.hits += 1
+            return message
+
+        self.misses += 1
+        version = DATA_VERSION.value
+        return self._store(kind, key, version, await self.executor.read(self._renderers[kind][0], key))
+
+    async def render(self, kind, key, now=None):
+        message = await self.fetch(kind, key)
+        pair_times = self.pair_times.get_built()
+        if pair_times is None:
+            pair_times = await self.executor.read(self.pair_times.snapshot)
+
+        if now is None:
+            now = self.clock()
+        return message.render(lambda pair: is_current(pair, now, pair_times))
+
+    def _store(self, kind, key, version, message):
+        # Built from data older than the current version, e.g. while an update was written, is not kept
+        if self.size <= 0 or version != DATA_VERSION.value:
+            return message
+
+        self._entries[(kind, key)] = (version, message)
+        self._entries.move_to_end((kind, key))
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+        return message
+
+    async def warm_up(self, kinds=None):
+        """
+        Builds stale messages of all keys of the kinds on a reader thread, one at a time.
+        """
+        built = 0
+        for kind, (build, keys) in self._renderers.items():
+            if keys is None or kinds is not None and kind not in kinds:
+                continue
+
+            for key in await self.executor.read(keys):
+                entry = self._entries.get((kind, key))
+                if entry is None or entry[0] != DATA_VERSION.value:
+                    version = DATA_VERSION.value
+                    self._store(kind, key, version, await self.executor.read(build, key))
+                    built += 1
+                    # Lets commands run between messages when the executor runs in place
+                    await asyncio.sleep(0)
+
+        self.LOG.info("Warmed up %d messages, %d cached", built, len(self._entries))
+        return built
+
+    def clear(self):
+        self._entries.clear()
+
+
+RENDER_CACHE = RenderCache()
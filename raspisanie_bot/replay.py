@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+import datetime
+import pathlib
+import sys
+import tempfile
+
+from . import config
+from .database import MODELS, CVPItem, Generation, Pair, PairTime, db, preload_persistent
+from .parsing.archive import ARCHIVE_EXTENSIONS, ArchiveUpdater, SourceArchive
+from .parsing.database import DatabaseFinder, UniversalHandler
+
+
+class ReplayHandler(UniversalHandler):
+    __slots__ = ()
+
+    def remove_old_data(self):
+        # Archived documents are usually older than today, their data is what is being replayed
+        pass
+
+
+def use_database(path):
+    db.init(str(path))
+    db.create_tables(MODELS)
+    preload_persistent()
+
+
+def list_versions(args):
+    for version in SourceArchive(config.ARCHIVE_DIR).versions(args.url):
+        print(f"{version.fetched_at:%Y-%m-%d %H:%M:%S}  {version.kind:<13}  {version.content_hash[:12]}  {version.url}")
+
+
+async def replay_versions(url, versions, workers, source_name):
+    updater = ArchiveUpdater(DatabaseFinder, ReplayHandler, SourceArchive(config.ARCHIVE_DIR), versions, workers,
+                             source_name=source_name)
+
+    try:
+        return await updater.update(url, force=True)
+    finally:
+        await updater.close()
+
+
+def replay(args):
+    # The index is read from the working database before switching to the replay one
+    versions = SourceArchive(config.ARCHIVE_DIR).latest_versions(args.at)
+    db.close()
+
+    if args.url not in versions:
+        sys.exit(f"{args.url} is not archived")
+
+    with tempfile.TemporaryDirectory() as directory:
+        use_database(args.output or pathlib.Path(directory) / "replay.sqlite")
+        results = asyncio.run(replay_versions(args.url, versions, args.workers, args.source))
+
+        for result in results:
+            print(f"{result.name}: {'ok' if result.error is None else repr(result.error)}")
+        generation = Generation.current()
+        print(f"{Pair.select().where(Pair.visible(generation)).count()} pairs, "
+              f"{CVPItem.select().where(CVPItem.visible(generation)).count()} CVP items, "
+              f"{PairTime.select().where(PairTime.visible(generation)).count()} pair times")
+        db.close()
+
+
+def export(args):
+    archive = SourceArchive(config.ARCHIVE_DIR)
+    directory = pathlib.Path(args.directory)
+    exported = set()
+
+    for version in archive.versions(args.url):
+        if version.content_hash in exported:
+            continue
+
+        content = archive.read(version)
+        if version.kind != "cvp" and version.encoding is not None:
+            content = content.decode(version.encoding).encode()
+
+        path = directory / version.kind / \
+            f"{version.fetched_at:%Y%m%d-%H%M%S}-{version.content_hash[:12]}{ARCHIVE_EXTENSIONS[version.kind]}"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        exported.add(version.content_hash)
+
+    print(f"{len(exported)} documents exported to {directory}")
+
+
+def main():
+    ap = argparse.ArgumentParser(prog="python -m raspisanie_bot.replay")
+    sp = ap.add_subparsers(dest="command", required=True)
+
+    p = sp.add_parser("list", help="List archived documents")
+    p.add_argument("--url", help="Only versions of this document")
+    p.set_defaults(func=list_versions)
+
+    p = sp.add_parser("run", help="Parse archived documents as the update service would, without network access")
+    p.add_argument("--url", default=config.TIMETABLE_URL, help="Timetable page to start from")
+    p.add_argument("--at", type=datetime.datetime.fromisoformat,
+                   help="Use documents as they were at this time (YYYY-MM-DD HH:MM), latest by default")
+    p.add_argument("--output", help="Database file to write to. Temporary database is used by default")
+    p.add_argument("--workers", type=int, default=0, help="Number of parser processes")
+    p.add_argument("--source", default=config.DEFAULT_SOURCE, help="Source name the parsed rows are tagged with")
+    p.set_defaults(func=replay)
+
+    p = sp.add_parser("export", help="Write archived documents to a directory usable by benchmark corpus and golden")
+    p.add_argument("directory")
+    p.add_argument("--url", help="Only versions of this document")
+    p.set_defaults(func=export)
+
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import collections
+import datetime
+import zoneinfo
+
+from peewee import JOIN
+
+from .config import DEFAULT_SOURCE, TIMEZONE
+from .database import DATA_VERSION, CVPItem, Generation, Group, Pair, PairTime, Teacher
+
+# teachers are short names, cabinets are numbers, start_time and end_time are None without a call schedule
+PairRow = collections.namedtuple('PairRow', ('date', 'pair_number', 'name', 'group', 'teachers', 'cabinets',
+                                             'start_time', 'end_time', 'source'))
+CVPRow = collections.namedtuple('CVPRow', ('date', 'start_time', 'end_time'))
+PairTimeRow = collections.namedtuple('PairTimeRow', ('source', 'pair_number', 'start_time', 'end_time'))
+
+MINUTES_PER_DAY = 24 * 60
+
+TeacherLink = Pair.teachers.through_model
+CabinetLink = Pair.cabinets.through_model
+
+
+def group_filter(group):
+    return Pair.group == group
+
+
+def teacher_filter(teacher):
+    return Pair.rowid.in_(TeacherLink.select(TeacherLink.pair_id).where(TeacherLink.teacher_id == teacher))
+
+
+def cabinet_filter(cabinet):
+    return Pair.rowid.in_(CabinetLink.select(CabinetLink.pair_id).where(CabinetLink.cabinet_id == cabinet))
+
+
+def get_pairs(where, generation=None):
+    """
+    Pairs with their times, groups, teachers and cabinets in three queries, however many pairs there are.
+    :param where: Filter of pairs, e.g. group_filter()
+    :return: [PairRow] ordered by date and pair number
+    """
+    if generation is None:
+        generation = Generation.current()
+    where = where & Pair.visible(generation)
+
+    teachers = collections.defaultdict(list)
+    for pair_id, surname, name, patronymic in TeacherLink\
+            .select(TeacherLink.pair_id, Teacher.surname, Teacher.name, Teacher.patronymic)\
+            .join(Teacher)\
+            .where(TeacherLink.pair_id.in_(Pair.select(Pair.rowid).where(where)))\
+            .order_by(TeacherLink.pair_id, TeacherLink.teacher_id)\
+            .tuples():
+        teachers[pair_id].append(Teacher.format_short_name(surname, name, patronymic))
+
+    cabinets = collections.defaultdict(list)
+    for pair_id, number in CabinetLink\
+            .select(CabinetLink.pair_id, CabinetLink.cabinet_id)\
+            .where(CabinetLink.pair_id.in_(Pair.select(Pair.rowid).where(where)))\
+            .order_by(CabinetLink.pair_id, CabinetLink.cabinet_id)\
+            .tuples():
+        cabinets[pair_id].append(number)
+
+    pair_time = (PairTime.pair_number == Pair.pair_number) & (PairTime.source == Pair.source) & \
+        PairTime.visible(generation)
+
+    return [PairRow(date, pair_number, name, Group.format_string_value(course, group, subgroup),
+                    tuple(teachers.get(rowid, ())), tuple(cabinets.get(rowid, ())), start_time, end_time, source)
+            for rowid, date, pair_number, name, course, group, subgroup, start_time, end_time, source in Pair
+            .select(Pair.rowid, Pair.date, Pair.pair_number, Pair.name, Group.course, Group.group, Group.subgroup,
+                    PairTime.start_time, PairTime.end_time, Pair.source)
+            .join(Group)
+            .switch(Pair)
+            .join(PairTime, JOIN.LEFT_OUTER, on=pair_time)
+            .where(where)
+            .order_by(Pair.date, Pair.pair_number)
+            .tuples()]
+
+
+def get_cvp_items(group, generation=None):
+    if generation is None:
+        generation = Generation.current()
+
+    return [CVPRow(*i) for i in CVPItem
+            .select(CVPItem.date, CVPItem.start_time, CVPItem.end_time)
+            .where((CVPItem.group == group) & CVPItem.visible(generation))
+            .order_by(CVPItem.date)
+            .tuples()]
+
+
+_timezone = zoneinfo.ZoneInfo(TIMEZONE) if TIMEZONE else None
+
+
+def local_now():
+    """
+    Time in TIMEZONE, the local time of the server by default. A request takes one snapshot of it.
+    """
+    return datetime.datetime.now(_timezone)
+
+
+def get_minute(now):
+    return now.hour * 60 + now.minute
+
+
+def is_current(row, now, pair_times):
+    """
+    :param pair_times: PairTimeSnapshot, the current pair is looked up in its minute table
+    """
+    current = pair_times.at(now, row.source)[0]
+    return current is not None and current.pair_number == row.pair_number and row.date == now.date()
+
+
+class PairTimeSnapshot(collections.namedtuple('PairTimeSnapshot', ('version', 'pair_times', 'minutes'))):
+    """
+    Pair times of one data version, never changed after it is built.
+    pair_times: {source: (PairTimeRow, ...)} by pair number, minutes: {source: [(current, next)] by minute of the day}
+    """
+    __slots__ = ()
+
+    def at(self, now, source=DEFAULT_SOURCE):
+        """
+        :return: (current pair, next pair), PairTimeRow or None each
+        """
+        minutes = self.minutes.get(source)
+        if minutes is None:
+            return None, None
+
+        return minutes[get_minute(now)]
+
+
+class PairTimeTable:
+    """
+    Pair times of all sources and the (current pair, next pair) of every minute of the day.
+    Checked on the first lookup after the data version changes, then looked up without queries. Minutes are built
+    again only for sources with changed pair times, so updates without a new call schedule cost one query.
+    Readers on several threads may build it at once, each build is published whole by one assignment.
+    """
+    __slots__ = ('clock', '_snapshot')
+
+    def __init__(self, clock=local_now):
+        self.clock = clock
+        self._snapshot = PairTimeSnapshot(None, {}, {})
+
+    @staticmethod
+    def build_minutes(pair_times):
+        minutes = []
+        for minute in range(MINUTES_PER_DAY):
+            current = next((i for i in pair_times if i.start_time <= minute < i.end_time), None)
+            upcoming = min((i for i in pair_times if minute < i.start_time), key=lambda i: i.start_time, default=None)
+            minutes.append((current, upcoming))
+        return minutes
+
+    def get_built(self):
+        """
+        :return: PairTimeSnapshot of the current data version, None if it is not built yet
+        """
+        snapshot = self._snapshot
+        return snapshot if snapshot.version == DATA_VERSION.value else None
+
+    def snapshot(self):
+        """
+        Pair times of the current data version, queried if they are not built yet.
+        """
+        previous = self._snapshot
+        if previous.version == DATA_VERSION.value:
+            return previous
+
+        version = DATA_VERSION.value
+        pair_times = collections.defaultdict(list)
+        for row in PairTime\
+                .select(PairTime.source, PairTime.pair_number, PairTime.start_time, PairTime.end_time)\
+                .where(PairTime.visible(Generation.current()))\
+                .order_by(PairTime.source, PairTime.pair_number)\
+                .tuples():
+            pair_times[row[0]].append(PairTimeRow(*row))
+
+        pair_times = {source: tuple(rows) for source, rows in pair_times.items()}
+        snapshot = self._snapshot = PairTimeSnapshot(
+            version, pair_times, {source: previous.minutes[source] if previous.pair_times.get(source) == rows
+                                  else self.build_minutes(rows) for source, rows in pair_times.items()})
+        return snapshot
+
+    def get_pair_times(self):
+        """
+        :return: {source: (PairTimeRow, ...)} ordered by source and pair number
+        """
+        return self.snapshot().pair_times
+
+    def at(self, now=None, source=DEFAULT_SOURCE):
+        """
+        :return: (current pair, next pair), PairTimeRow or None each
+        """
+        return self.snapshot().at(self.clock() if now is None else now, source)
+
+
+PAIR_TIMES = PairTimeTable()
@@ -1,56 +1,70 @@
 from aiogram.dispatcher.storage import BaseStorage
 
 from .database import StorageState, StorageData, db
+from .db_executor import DB_EXECUTOR
 
 
 class SQLiteStorage(BaseStorage):
+    def __init__(self, executor=DB_EXECUTOR):
+        self.executor = executor
+
+    @staticmethod
+    def _get_state(sid):
+        ss = StorageState.get_or_none(StorageState.id == sid)
+        return None if ss is None else ss.state
+
+    @staticmethod
+    def _set_state(sid, state):
+        ss = StorageState.get_or_create(id=sid)[0]
+        ss.state = state
+        ss.save()
+
+    @staticmethod
+    def _get_data(did):
+        return {sd.key: sd.value for sd in StorageData.select().where(StorageData.id == did)}
+
+    @staticmethod
+    def _update_data(did, data, replace):
+        with db.atomic():
+            if replace:
+                StorageData.delete().where(StorageData.id == did).execute()
+
+            for key, value in data.items():
+                sd = StorageData.get_or_create(id=did, key=key, defaults=dict(value=value))[0]
+                sd.value = value
+                sd.save()
+
     async def get_state(self, *, chat=None, user=None, default=None):
         chat, user = self.check_address(chat=chat, user=user)
-        ss = StorageState.get_or_none(StorageState.id == f"{chat}:{user}")
-        if ss is None:
+        state = await self.executor.read(self._get_state, f"{chat}:{user}")
+        if state is None:
             return self.resolve_state(default)
-        return ss.state
+        return state
 
     async def set_state(self, *, chat=None, user=None, state=None):
         if state is None:
             return await self.reset_state(chat=chat, user=user, with_data=False)
 
         chat, user = self.check_address(chat=chat, user=user)
-        ss = StorageState.get_or_create(id=f"{chat}:{user}")[0]
-        ss.state = self.resolve_state(state)
-        ss.save()
+        await self.executor.write(self._set_state, f"{chat}:{user}", self.resolve_state(state))
 
     async def reset_state(self, *, chat=None, user=None, with_data=True):
         chat, user = self.check_address(chat=chat, user=user)
-        StorageState.delete().where(StorageState.id == f"{chat}:{user}").execute()
+        await self.executor.write(StorageState.delete().where(StorageState.id == f"{chat}:{user}").execute)
 
         if with_data:
             await self.reset_data(chat=chat, user=user)
 
     async def get_data(self, *, chat=None, user=None, default=None):
         chat, user = self.check_address(chat=chat, user=user)
-
-        data = {}
-        with db.atomic():
-            for sd in StorageData.select().where(StorageData.id == f"{chat}:{user}"):
-                data[sd.key] = sd.value
-
-        return data
+        return await self.executor.read(self._get_data, f"{chat}:{user}")
 
     async def set_data(self, *, chat=None, user=None, data=None):
         if data is None:
             data = {}
 
         chat, user = self.check_address(chat=chat, user=user)
-        did = f"{chat}:{user}"
-
-        with db.atomic():
-            StorageData.delete().where(StorageData.id == did).execute()
-
-            for key, value in data.items():
-                sd = StorageData.get_or_create(id=did, key=key, defaults=dict(value=value))[0]
-                sd.value = value
-                sd.save()
+        await self.executor.write(self._update_data, f"{chat}:{user}", data, True)
 
     async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
         if data is None:
@@ -59,17 +73,11 @@ class SQLiteStorage(BaseStorage):
         data.update(**kwargs)
 
         chat, user = self.check_address(chat=chat, user=user)
-        did = f"{chat}:{user}"
-
-        with db.atomic():
-            for key, value in data.items():
-                sd = StorageData.get_or_create(id=did, key=key, defaults=dict(value=value))[0]
-                sd.value = value
-                sd.save()
+        await self.executor.write(self._update_data, f"{chat}:{user}", data, False)
 
     async def reset_data(self, *, chat=None, user=None):
         chat, user = self.check_address(chat=chat, user=user)
-        StorageData.delete().where(StorageData.id == f"{chat}:{user}").execute()
+        await self.executor.write(StorageData.delete().where(StorageData.id == f"{chat}:{user}").execute)
 
     async def close(self):
         pass
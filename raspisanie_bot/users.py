@@ -0,0 +1,98 @@
+import collections
+import datetime
+import logging
+
+from .config import USER_CACHE_SIZE, feature_enabled
+from .database import User, db
+from .db_executor import DB_EXECUTOR
+
+
+class UserRegistry:
+    """
+    LRU cache of User rows by telegram id: a message of a known user reads it without queries, and only real changes
+    are written. With the track_last_seen feature the time of the last message is written in batches by flush().
+    Users are used from the event loop only, their rows are read and written on the writer thread of the executor.
+    """
+    __slots__ = ('LOG', 'size', 'executor', 'hits', 'misses', '_users', '_has_users', '_seen')
+
+    def __init__(self, size=USER_CACHE_SIZE, executor=DB_EXECUTOR):
+        self.LOG = logging.getLogger(type(self).__name__)
+        self.size = size
+        self.executor = executor
+        self.hits = 0
+        self.misses = 0
+        self._users = collections.OrderedDict()  # telegram id -> User
+        self._has_users = None  # Whether the first user, who becomes an admin, is created. Used on the writer thread
+        self._seen = {}  # telegram id -> datetime of the last message not written yet
+
+    def __len__(self):
+        return len(self._users)
+
+    def _load(self, telegram_user):
+        user = User.from_telegram(telegram_user, self._has_users)
+        self._has_users = True
+        return user
+
+    async def get(self, telegram_user):
+        """
+        :return: User of the telegram user, created on the first message
+        """
+        user = self._users.get(telegram_user.id)
+        if user is not None:
+            self.hits += 1
+            self._users.move_to_end(telegram_user.id)
+        else:
+            self.misses += 1
+            user = await self.executor.write(self._load, telegram_user)
+            # Another message of the same user may have loaded it meanwhile, both get the same row
+            user = self._users.setdefault(telegram_user.id, user)
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+
+        if feature_enabled("track_last_seen"):
+            self._seen[telegram_user.id] = datetime.datetime.now()
+
+        return user
+
+    async def save(self, user):
+        """
+        Writes changed fields of the user, if there are any.
+        """
+        if not user.is_dirty():
+            return
+
+        try:
+            await self.executor.write(user.save)
+        except BaseException:
+            # The cached row has changes that are not in the database
+            self._users.pop(user.rowid, None)
+            raise
+
+    @staticmethod
+    def write_last_seen(seen):
+        with db.atomic():
+            for rowid, last_seen in seen.items():
+                User.update(last_seen=last_seen).where(User.rowid == rowid).execute()
+
+    async def flush(self):
+        """
+        Writes last message times collected since the previous flush in one transaction.
+        """
+        seen, self._seen = self._seen, {}
+        if not seen:
+            return
+
+        try:
+            await self.executor.write(self.write_last_seen, seen)
+        except BaseException:
+            # Written with the next flush, unless the users have sent newer messages
+            self._seen = {**seen, **self._seen}
+            raise
+
+        self.LOG.debug("Written last seen time of %d users", len(seen))
+
+    def clear(self):
+        self._users.clear()
+
+
+USERS = UserRegistry()
@@ -0,0 +1,57 @@
+import unittest
+
+from raspisanie_bot.parsing.pair_names import PairNameRules
+
+
+def make_rules(rules, replacements=None):
+    return PairNameRules.from_config(rules, replacements or {})
+
+
+class PairNameRulesTest(unittest.TestCase):
+    def assertNames(self, engine, expected):
+        self.assertEqual({name: engine(name) for name in expected}, expected)
+
+    def test_default_prefixes(self):
+        self.assertNames(make_rules([]), {"МДК 01 02": "МДК.01.02", "МИДК 3 1": "МИДК.3.1", "Физика": "Физика"})
+
+    def test_longest_prefix(self):
+        engine = make_rules([{"prefix": "ПМ", "replace": "ПМ", "join": "."},
+                             {"prefix": "ПМ 01", "replace": "Модуль 1"}])
+        self.assertNames(engine, {"ПМ 02 1": "ПМ.02.1", "ПМ 01 практика": "Модуль 1 практика"})
+
+    def test_first_matching_pattern(self):
+        # Patterns without groups are combined into one regex, which must keep the order of the rules
+        engine = make_rules([{"pattern": "абв", "replace": "АБВ"}, {"pattern": "аб", "replace": "АБ"},
+                             {"pattern": "а.*", "replace": "А"}, {"pattern": "абв", "replace": "never"}])
+        self.assertNames(engine, {"абв": "АБВ", "аб": "АБ", "аг": "А", "бв": "бв"})
+
+    def test_groups(self):
+        engine = make_rules([{"pattern": "(\\d+) (\\d+)", "replace": "\\2-\\1"},
+                             {"pattern": "(?P<x>а\\d)", "replace": "\\g<x>!"},
+                             {"pattern": "(?P<x>а\\w)", "replace": "[\\g<x>]"},
+                             {"pattern": "аб", "replace": "АБ"}])
+        self.assertNames(engine, {"1 2": "2-1", "а1": "а1!", "аб": "[аб]", "аг": "[аг]"})
+
+    def test_backreference(self):
+        engine = make_rules([{"pattern": "\\d(x)(\\d)\\2", "replace": "repeated"},
+                             {"pattern": "\\d.*", "replace": "d"}])
+        self.assertNames(engine, {"1x22": "repeated", "1x23": "d"})
+
+    def test_inline_flags(self):
+        # The flag of the first pattern must not apply to the ones after it
+        engine = make_rules([{"pattern": "(?i)мдк", "replace": "МДК"}, {"pattern": "м\\w+", "replace": "М"},
+                             {"pattern": "пм|ПМ", "replace": "?"}, {"pattern": "пм", "replace": "ПМ"}])
+        self.assertNames(engine, {"мдк": "МДК", "Мдк": "МДК", "мир": "М", "Мир": "Мир", "пм": "?",
+                                  "МДК 01 02": "МДК.01.02"})
+
+    def test_replacements_after_rules(self):
+        engine = make_rules([{"pattern": "Физ.*", "replace": "Физика"}], {"Физика": "Физ-ра"})
+        self.assertNames(engine, {"Физкультура": "Физ-ра", "Физика": "Физ-ра", "Химия": "Химия"})
+
+    def test_invalid_rule(self):
+        with self.assertRaises(ValueError):
+            make_rules([{"replace": "x"}])
+
+
+if __name__ == '__main__':
+    unittest.main()